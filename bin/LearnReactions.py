@@ -7,6 +7,7 @@ import shutil
 import sys
 
 from nanoreactor import Nanoreactor
+from nanoreactor.stream import NanoreactorStream
 
 
 # ==========================#
@@ -60,13 +61,39 @@ add_argument(parser, '-M', '--save_molecules', help='Extract stable molecules as
              action='store_true')
 add_argument(parser, '-N', '--neutralize', help='Extract nearby molecules to neutralize the system',
              action='store_true')
-add_argument(parser, '--pbc', help='Simple periodic boundary support, specify cubic NVT box size in Angstrom.',
-             default=0, type=float)
+add_argument(parser, '--pbc', nargs='+', default=[0], type=float,
+             help='Periodic box in Angstrom: cubic box length, three box lengths, three lengths and three angles, '
+                  'or nine box vector components.  Without this option, boxes are read from the trajectory if present '
+                  '(e.g. extended XYZ Lattice="..." comments).')
 add_argument(parser, '--align', action='store_true', help='Align molecules and reactions prior to output.')
 add_argument(parser, '--radii', type=str, nargs="+", default=["Na", "0.0", "K", "0.0"],
              help='Custom atomic radii for bond detection.')
 add_argument(parser, '--plot', action='store_true',
              help='Save interatomic distance or bond order time series to files.')
+add_argument(parser, '--nproc', type=int, default=1,
+             help='Number of processes used to search for reaction events.')
+add_argument(parser, '--lpmethod', type=str, default='fft', choices=['fft', 'overlap-save', 'sosfiltfilt'],
+             help='Low-pass filter method; overlap-save and sosfiltfilt use less time and memory for very long trajectories.')
+add_argument(parser, '--cache', action='store_true',
+             help='Keep a binary copy of the parsed coordinate and charge/spin files for faster reruns.')
+add_argument(parser, '--vizformat', type=str, default='text', choices=['text', 'binary', 'both'],
+             help='Format of the color, bond, charge and spin data for reactions.vmd; binary files only store the frames where the data changes.')
+add_argument(parser, '--checkpoint', type=str, default=None, metavar='DIR',
+             help='Save the filtered time series and global graphs to this directory and reuse them when rerunning with the same inputs and filter parameters.')
+add_argument(parser, '--profile', type=str, default=None, metavar='FILE',
+             help='Append the wall time, CPU time, memory usage and result counts of each analysis stage to this JSON lines file.')
+add_argument(parser, '--memtop', type=int, default=0,
+             help='With --profile, also record the memory allocated by each stage and its largest N allocation sites (slower).')
+add_argument(parser, '--cprofile', type=str, default=None, metavar='FILE',
+             help='Run the analysis stages under cProfile and write the statistics to this file.')
+add_argument(parser, '--follow', action='store_true',
+             help='Analyze the trajectory while the MD simulation is still writing it.')
+add_argument(parser, '--poll', type=float, default=60.0,
+             help='With --follow, the number of seconds between checks for new frames.')
+add_argument(parser, '--stop', dest='stopfile', type=str, default=None,
+             help='With --follow, stop after this file is created (e.g. when the MD simulation has finished).')
+add_argument(parser, '--idle', type=float, default=None,
+             help='With --follow, stop if no new frames arrive for this many seconds.')
 
 print("LearnReactions.py called with the following arguments:")
 print((' '.join(sys.argv)))
@@ -82,12 +109,21 @@ def main():
         if os.path.exists(args.qsin + '.bz2'):
             print(("%s doesn't exist - unzipping %s.bz2" % (args.qsin, args.qsin)))
             os.system('bunzip2 %s.bz2' % args.qsin)
-    RS = Nanoreactor(
-        **dict(args._get_kwargs()))  # _get_kwargs takes the ArgumentParser object and turns it into a dictionary
-    RS.Output()
+    kwargs = dict(args._get_kwargs())  # _get_kwargs takes the ArgumentParser object and turns it into a dictionary
+    follow = kwargs.pop('follow')
+    stream_args = dict(interval=kwargs.pop('poll'), stopfile=kwargs.pop('stopfile'), timeout=kwargs.pop('idle'))
+    if follow:
+        RS = NanoreactorStream(**kwargs)
+        RS.follow(**stream_args)
+    else:
+        RS = Nanoreactor(**kwargs)
+        RS.Output()
     shutil.copyfile(os.environ['PATH'].split(os.pathsep)[0] + '/reactions.vmd', './reactions.vmd')
+    exts = {'text': ['.dat'], 'binary': ['.bin'], 'both': ['.dat', '.bin']}[args.vizformat]
+    vizFiles = [name + ext for ext in exts for name in ['color', 'bonds', 'charge', 'spin']]
     print((
-            "Reaction product identification finished.  color.dat and bonds.dat generated.  Now run: vmd -e reactions.vmd -args %s" % args.xyzin))
+            "Reaction product identification finished.  %s and %s generated.  Now run: vmd -e reactions.vmd -args %s"
+            % (', '.join(vizFiles[:-1]), vizFiles[-1], args.xyzin)))
 
 
 if __name__ == "__main__":
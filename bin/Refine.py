@@ -13,7 +13,8 @@ import numpy as np
 from nanoreactor.molecule import Elements, Molecule, extract_int
 from nanoreactor.output import logger
 # Utility functions and classes used to be a part of this script
-from nanoreactor.rxndb import Trajectory, create_work_queue, get_trajectory_home, parse_input_files, wq_reactor
+from nanoreactor.rxndb import (Trajectory, create_batches, create_local_queue, create_result_cache, create_status_db,
+                               create_work_queue, get_trajectory_home, parse_input_files, wq_reactor)
 
 
 # ==================================================#
@@ -39,6 +40,22 @@ def parse_command():
     parser.add_argument('--subsample', type=int, default=10, help='Frame interval for subsampling trajectories')
     parser.add_argument('-p', '--port', type=int, default=0,
                         help='Port number for the Work Queue master; leave blank to run locally')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Number of calculations to run at the same time when running locally, each using '
+                             'OMP_NUM_THREADS cores; the default is the number of CPU cores divided by OMP_NUM_THREADS')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Folder for storing calculation results, which are reused when the same calculation '
+                             '(same input geometry, method, basis, charge and multiplicity) comes up again; '
+                             'it may be shared between runs')
+    parser.add_argument('--status_files', action='store_true',
+                        help='Keep the calculation statuses in a .status file in each calculation folder instead of '
+                             'the .status.db database in the current folder (which imports the .status files when created)')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='Run geometry optimizations in batches of this size, one task per batch; '
+                             'useful when the molecules are small and the optimizations are quick')
+    parser.add_argument('--batch_parallel', type=int, default=1,
+                        help='Number of optimizations in a batch that run at the same time, '
+                             'sharing the cores of the task')
     parser.add_argument('--methods', type=str, nargs='+', default=['b3lyp'],
                         help='Which electronic structure method to use. '
                              'Provide 2 names if you want the final TS refinement + IRC to use a different method.')
@@ -125,6 +142,14 @@ def main():
         # print "Created WQ"
         # print WQ
         # sys.exit()
+    else:
+        # Otherwise the calculations are run in parallel on this machine.
+        create_local_queue(args.jobs)
+    if not args.status_files:
+        create_status_db()
+    if args.batch > 0:
+        create_batches(args.batch, args.batch_parallel)
+    cache = create_result_cache(args.cache) if args.cache is not None else None
     # Obtain a list of dynamics trajectory files.
     trajectory_fnms = parse_input_files(args.input)
     # Pre-process files to modify spins if inappropriate
@@ -153,12 +178,13 @@ def main():
         Trajectories[xyzname].launch()
         # Enter the reactor loop once in a while so we don't waste
         # time during the setup phase.
-        if (args.port != 0) and ((time.time() - t0) > 60):
+        if (time.time() - t0) > 60:
             wq_reactor(wait_time=1, iters=10)
             t0 = time.time()
     # Enter the reactor loop.
-    if args.port != 0:
-        wq_reactor()
+    wq_reactor()
+    if cache is not None:
+        cache.report()
 
 
 if __name__ == "__main__":
@@ -9,6 +9,8 @@ from itertools import islice
 
 import numpy as np
 
+from nanoreactor.nanoreactor import bondorder_keys, read_bondorder_blocks
+
 """
 In a folder that looks like this:
 chunk_0000
@@ -36,54 +38,61 @@ def load_bondorder(boin, thre, traj_length):
     Load a bondorder.list file.
 
     This file format only lists bond orders above a threshold (typically 0.1)
-    in each frame. Thus, the returned data takes the form of a sparse array.
+    in each frame. Thus, the returned data takes the form of a sparse array
+    in coordinate (COO) format sorted by atom pair and then by frame.
 
-    Copied from nanoreactor.py to lessen dependency
+    The file is read with read_bondorder_blocks() from nanoreactor.py
 
     Parameters
     ----------
     boin : str
         Name of the bond_order.list file
     thre : float
-        Floating
+        Only keep atom pairs whose bond order exceeds this value in at least one frame
     traj_length : int
         Length of the trajectory
 
     Returns
     -------
-    OrderedDict
-        Dictionary that maps zero-indexed atom pairs (a1, a2) to numpy array
-        containing the bond order between a1, a2 for each frame.
-        Keys only include a2 > a1
+    pairs : np.ndarray
+        Array of shape (n_pairs, 2) of zero-indexed atom pairs (a1, a2), sorted, with a2 > a1
+    frames : np.ndarray
+        Frame number of each nonzero entry
+    pidx : np.ndarray
+        Pair index (row of pairs) of each nonzero entry
+    values : np.ndarray
+        Bond order of each nonzero entry
     """
-    boMode = 0
-    boFrame = -1
-    boSparse = OrderedDict()
+    frames = []
     keys = []
-    for ln, line in enumerate(open(boin).readlines()):
-        if boMode == 0:
-            nbo = int(line.strip())
-            boLine = ln
-            boMode = 1
-            boFrame += 1
-        elif boMode == 1:
-            if ln > boLine + 1:
-                s = line.split()
-                a1 = int(s[0])
-                a2 = int(s[1])
-                bo = float(s[2])
-                a1, a2 = sorted((a1, a2))
-                if a1 != a2:
-                    if (a1, a2) not in boSparse:
-                        boSparse[(a1, a2)] = np.zeros(traj_length, dtype=float)
-                        keys.append((a1, a2))
-                    boSparse[(a1, a2)][boFrame] = bo
-                if ln == boLine + nbo + 1:
-                    boMode = 0
-    sortkeys = sorted(keys)
-    boSparse_sorted = OrderedDict([(k, boSparse[k]) for k in sortkeys if np.max(boSparse[k]) > thre])
-
-    return boSparse_sorted
+    values = []
+    for blk_frames, entries in read_bondorder_blocks(boin):
+        nodiag, blk_keys = bondorder_keys(entries)
+        # Zero bond orders are treated as missing entries when comparing consecutive frames
+        nonzero = entries[nodiag, 2] != 0.0
+        keys.append(blk_keys[nonzero])
+        frames.append(blk_frames[nodiag][nonzero])
+        values.append(entries[nodiag, 2][nonzero])
+    frames = np.concatenate(frames) if frames else np.zeros(0, dtype=int)
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.zeros(0, dtype=float)
+    if len(frames) > 0 and frames[-1] >= traj_length:
+        raise RuntimeError('%s contains more frames than the trajectory (%i)' % (boin, traj_length))
+    ukeys, pidx = np.unique(keys, return_inverse=True)
+    pidx = pidx.reshape(-1)
+    # Sort by pair then frame; if a pair is listed twice in a frame, keep the last value
+    order = np.lexsort((np.arange(len(pidx)), frames, pidx))
+    frames, pidx, values = frames[order], pidx[order], values[order]
+    last = np.append((pidx[1:] != pidx[:-1]) | (frames[1:] != frames[:-1]), True)
+    frames, pidx, values = frames[last], pidx[last], values[last]
+    # Drop the pairs that never exceed the threshold
+    pmax = np.zeros(len(ukeys))
+    np.maximum.at(pmax, pidx, values)
+    keep = pmax > thre
+    newidx = np.cumsum(keep) - 1
+    entries = keep[pidx]
+    pairs = np.array([ukeys >> 32, ukeys & 0xffffffff], dtype=int).T.reshape(-1, 2)[keep]
+    return pairs, frames[entries], newidx[pidx[entries]], values[entries]
 
 
 class Chunk(object):
@@ -256,22 +265,21 @@ class Chunk(object):
 def bo_frame_change(traj_length):
     fbo = os.path.join("gathered", "bond_order.list")
     if not os.path.exists(fbo): return
-    boSparse_sorted = load_bondorder(fbo, 0.1, traj_length)
-    dm_all = None
-    for k, v in list(boSparse_sorted.items()):
-        amask = np.ma.array(v, mask=(v == 0.0))
-        am_fut = amask[1:]
-        am_now = amask[:-1]
-        dm = np.ma.abs(am_fut - am_now)
-        if dm_all is None:
-            dm_all = dm.copy()
-        else:
-            dm_all = np.ma.vstack((dm_all, dm.copy()))
-    maxVals = np.ma.max(dm_all, axis=0)
-    maxArgs = np.ma.argmax(dm_all, axis=0)
-    pairs = list(boSparse_sorted.keys())
-    pair1 = np.array([pairs[i][0] for i in maxArgs])
-    pair2 = np.array([pairs[i][1] for i in maxArgs])
+    pairs, frames, pidx, values = load_bondorder(fbo, 0.1, traj_length)
+    # Bond order changes between consecutive frames where the pair is listed in both frames
+    consec = (pidx[1:] == pidx[:-1]) & (frames[1:] == frames[:-1] + 1)
+    dframe = frames[:-1][consec]
+    dpair = pidx[:-1][consec]
+    dval = np.abs(values[1:] - values[:-1])[consec]
+    # For each frame, the largest change (ties go to the first pair in sorted order)
+    order = np.lexsort((dpair, -dval, dframe))
+    first = order[np.append(True, dframe[order][1:] != dframe[order][:-1])]
+    maxVals = np.zeros(traj_length - 1)
+    maxArgs = np.zeros(traj_length - 1, dtype=int)
+    maxVals[dframe[first]] = dval[first]
+    maxArgs[dframe[first]] = dpair[first]
+    pair1 = pairs[maxArgs, 0]
+    pair2 = pairs[maxArgs, 1]
 
     maxVals = np.append(maxVals, 0)
     pair1 = np.append(pair1, 0)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Run a batch of Q-Chem geometry optimizations in one task, to avoid paying
+the start-up cost of a separate task for each small molecule.
+
+The batch file (written by rxndb) contains the method, basis set and number of
+cycles shared by the optimizations, and the folder, charge and multiplicity of
+each one.  Each optimization runs in its own folder and writes optimize.log and
+optimize.tar.bz2 there, exactly as if optimize-geometry.py had been run in that folder.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import runpy
+import sys
+import traceback
+
+# Use the optimization code of optimize-geometry.py in the same folder.
+opt = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'optimize-geometry.py'),
+                     run_name='optimize_geometry')
+
+
+def parse_user_input():
+    # Parse user input - run at the beginning.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('batch', type=str, help='JSON file listing the optimizations (required)')
+    parser.add_argument('--parallel', type=int, default=1,
+                        help='Number of optimizations to run at the same time; '
+                             'the OMP_NUM_THREADS cores are divided between them')
+    args, sys.argv = parser.parse_known_args(sys.argv[1:])
+    return args
+
+
+def run_item(job):
+    """
+    Run one optimization of the batch in its own folder.  This is called in a new
+    process for each optimization, because the optimization ends by calling sys.exit.
+    """
+    item, method, basis, cycles, cores = job
+    os.chdir(item['home'])
+    os.environ['OMP_NUM_THREADS'] = str(cores)
+    # Send all output of this optimization, including that of Q-Chem, to its log file.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log = os.open('optimize.log', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    status = 0
+    try:
+        try:
+            opt['click']()
+            opt['optimize']('initial.xyz', item['charge'], item['mult'], method, basis, cycles=cycles)
+        except SystemExit:
+            raise
+        except Exception:
+            # Archive whatever was produced, so the calculation shows up as failed rather than missing
+            traceback.print_exc()
+            status = 1
+        opt['tarexit'](status)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 0
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return item['home'], status
+
+
+def main():
+    args = parse_user_input()
+    with open(args.batch) as f:
+        batch = json.load(f)
+    # Divide the cores of the task between the optimizations running at the same time.
+    cores = max(1, int(os.environ.get('OMP_NUM_THREADS', 1)) // args.parallel)
+    jobs = [(item, batch['method'], batch['basis'], batch.get('cycles', 100), cores) for item in batch['items']]
+    # Each optimization runs in a forked process, so the modules are only imported once.
+    pool = multiprocessing.get_context('fork').Pool(args.parallel, maxtasksperchild=1)
+    for home, status in pool.imap(run_item, jobs):
+        print("%s : %s" % (home, "finished" if status == 0 else "failed (exit status %i)" % status))
+    pool.close()
+    pool.join()
+
+
+if __name__ == "__main__":
+    main()
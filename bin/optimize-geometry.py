@@ -97,13 +97,13 @@ def QCOptIC(*args, **kwargs):
         tarexit()
 
 
-def main():
-    # Get user input.
-    args = parse_user_input()
-    # Start timer.
-    click()
+def optimize(initial, charge, mult, method, basis, cycles=100):
+    """
+    Run the geometry optimization and write the results to optimize.xyz and optimize.pop
+    in the current folder (also used by optimize-batch.py).
+    """
     # Run Q-Chem geometry optimization.
-    M = QCOptIC(args.initial, args.charge, args.mult, args.method, args.basis, cycles=args.cycles)
+    M = QCOptIC(initial, charge, mult, method, basis, cycles=cycles)
     # Select frames where the energy is monotonically decreasing.
     M = M[monotonic_decreasing(M.qm_energies)]
     # Write optimization results to file.
@@ -111,6 +111,14 @@ def main():
     # Write Mulliken charge and spin populations to file.
     QS = M.get_populations()
     QS.write('optimize.pop', ftype='xyz')
+
+
+def main():
+    # Get user input.
+    args = parse_user_input()
+    # Start timer.
+    click()
+    optimize(args.initial, args.charge, args.mult, args.method, args.basis, cycles=args.cycles)
     # Archive and exit.
     tarexit()
 
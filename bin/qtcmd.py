@@ -48,6 +48,9 @@ parser.add_argument('--tera', type=str, default='/home/leeping/opt/terachem/curr
                     help='Specify absolute path of TeraChem executable.')
 parser.add_argument('--hold', type=int, default=0,
                     help='Specify the job number used to hold the submitted job (not necessary if submitting by hand).')
+parser.add_argument('--learn', type=str, default=None,
+                    help='Run LearnReactions.py --follow on each chunk while the MD is running; '
+                         'the value is passed as extra arguments, e.g. --learn "-s 0.5 -t 100".')
 
 print("\n#=========================================#")
 print("#     Nanoreactor MD launching script     #")
@@ -170,6 +173,17 @@ hold = ""
 if args.hold > 0:
     hold = "#SBATCH -d afterany:%i\n" % args.hold
 
+# Streaming reaction learning alongside the MD; it finishes after TeraChem creates the stop file.
+learnarg = ""
+learn_start = ""
+learn_stop = ""
+if args.learn is not None:
+    learnarg = ' --learn "%s"' % args.learn
+    learn_start = ("rm -f scr/.md_done\n"
+                   "LearnReactions.py scr/coors.xyz -B scr/bond_order.list --follow --stop scr/.md_done %s > learn.log 2>&1 &\n"
+                   % args.learn)
+    learn_stop = "touch scr/.md_done\nwait\n"
+
 # Crash if the job already exists in the queue.
 # Currently doesn't work because recently deleted jobs are still reported by qstat -j.
 # Crash = True
@@ -374,7 +388,7 @@ echo $next_chunk > .chunk
 #|        Submit the next job         |#
 #======================================#
 if (( chunk < 200 )) ; then
-    python {scriptname} --auto --hold $SLURM_JOB_ID --gpus {gpus} --name "{jobname}" --time {time} --tera {tera}
+    python {scriptname} --auto --hold $SLURM_JOB_ID --gpus {gpus} --name "{jobname}" --time {time} --tera {tera}{learnarg}
 fi
 #======================================#
 #|  Go into the temporary directory   |#
@@ -409,8 +423,8 @@ fi
 #======================================#
 #|    Now do what needs to be done!   |#
 #======================================#
-terachem run.in > run.out 2> run.err
-# If the job finishes or crashes for some reason, then the next job should be deleted.
+{learn_start}terachem run.in > run.out 2> run.err
+{learn_stop}# If the job finishes or crashes for some reason, then the next job should be deleted.
 next_dnm=$(printf "chunk_%04i" $next_chunk)
 submitted_job=$(tail -1 ../$next_dnm/.submit.txt | awk '{{print $NF}}')
 scancel $submitted_job
@@ -423,5 +437,6 @@ terapath = os.path.dirname(os.path.dirname(args.tera))
 print(cwd)
 with open('sbatch.sh', 'w') as f: print(
     fout.format(jobname=jobname, cwd=cwd, hold=hold, scriptname=__file__, time=args.time, gpus=args.gpus,
-                mem=args.gpus * 8000, terapath=terapath, tera=args.tera), file=f)
+                mem=args.gpus * 8000, terapath=terapath, tera=args.tera, learnarg=learnarg,
+                learn_start=learn_start, learn_stop=learn_stop), file=f)
 os.system('sbatch sbatch.sh | tee .submit.txt')
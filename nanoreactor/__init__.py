@@ -1,5 +1,5 @@
-__all__ = ['angle', 'chemistry', 'contact', 'dihedral', 'internal', 'molecule', 'nanoreactor', 'nifty', 'qchem',
-           'viterbi']
+__all__ = ['angle', 'benchmark', 'chemistry', 'contact', 'dihedral', 'internal', 'molecule', 'nanoreactor', 'nifty',
+           'profiling', 'qchem', 'stream', 'viterbi']
 
 from .molecule import Molecule
 from .nanoreactor import Nanoreactor
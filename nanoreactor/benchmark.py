@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the nanoreactor analysis on synthetic reactive trajectories.
+
+The trajectories consist of small molecules (C, O and H atoms) jiggling on a lattice.
+In a reaction event an atom moves to a different molecule, and bond flickers briefly
+stretch a bond without breaking it, which the low-pass filter should remove.  For each
+trajectory the inputs of LearnReactions.py are written (coors.xyz, charge-spin.txt and
+bond_order.list), so the analysis can be run based on either distances or bond orders.
+
+Each stage of the analysis (load_bondorder, Molecule.read_xyz0, measureDistances,
+tsFilter, makeGlobalGraphs, makeMoleculeGraphs, findReactionEvents, ...) is timed
+separately using the profiling records of Nanoreactor (see profiling.py), and every
+case runs in a fresh process so that the peak memory usage is not shared between cases.
+
+Usage
+-----
+python -m nanoreactor.benchmark --natoms 60 120 240 --nframes 2000
+python -m nanoreactor.benchmark --save baseline.json
+python -m nanoreactor.benchmark --baseline baseline.json
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .nanoreactor import Nanoreactor
+
+# Names of the profiled stages in the report
+StageNames = OrderedDict([('Molecule.__init__', 'read_xyz0'),
+                          ('Molecule', 'read_xyz0 (charge-spin)'),
+                          ('load_bondorder', 'load_bondorder'),
+                          ('Nanoreactor.measureDistances', 'measureDistances'),
+                          ('Nanoreactor.tsFilter', 'tsFilter'),
+                          ('Nanoreactor.makeGlobalGraphs', 'makeGlobalGraphs'),
+                          ('Nanoreactor.makeMoleculeGraphs', 'makeMoleculeGraphs'),
+                          ('Nanoreactor.analyzeIsomers', 'analyzeIsomers'),
+                          ('Nanoreactor.findReactionEvents', 'findReactionEvents')])
+
+# Settings of the analysis; the synthetic bonds are 1.1 Angstrom and molecules are 4 Angstrom apart
+Settings = dict(dt_fs=0.5, learntime=10.0, cutoff=200.0)
+BondOrderThreshold = 0.3
+
+
+def synthetic_trajectory(odir, natoms=60, nframes=2000, nevents=6, flicker=0.002, seed=0):
+    """
+    Write a synthetic reactive trajectory to coors.xyz, charge-spin.txt and bond_order.list.
+
+    Parameters
+    ----------
+    odir : str
+        Output directory
+    natoms : int
+        Number of atoms, in molecules of two and three atoms
+    nframes : int
+        Number of frames
+    nevents : int
+        Number of reaction events, where one atom moves from one molecule to another
+    flicker : float
+        Probability per atom and frame of stretching all of the atom's bonds by 1 Angstrom for three frames
+    seed : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    list
+        Frames of the reaction events
+    """
+    rng = np.random.RandomState(seed)
+    if not os.path.exists(odir):
+        os.makedirs(odir)
+    # Assign atoms to molecules of two and three atoms
+    sizes = []
+    while sum(sizes) < natoms:
+        sizes.append(min(2 + len(sizes) % 2, natoms - sum(sizes)))
+    nmol = len(sizes)
+    elems = list(itertools.chain(*[['C', 'O', 'H'][:n] for n in sizes]))
+    owner = np.repeat(np.arange(nmol), sizes)
+    offsets = []
+    for n in sizes:
+        v = rng.randn(3)
+        v *= 0.55 / np.linalg.norm(v)
+        offsets += [v, -v, np.array([0.0, 0.0, 1.1])][:n]
+    offsets = np.array(offsets)
+    # Molecules sit on a cubic lattice and take a bounded random walk around their lattice sites
+    grid = int(np.ceil(nmol ** (1.0 / 3)))
+    centers = np.array(list(itertools.product(range(grid), repeat=3))[:nmol], dtype=float) * 4.0 + 2.0
+    walk = np.clip(np.cumsum(rng.randn(nframes, nmol, 3) * 0.01, axis=0), -0.5, 0.5)
+    # Reaction events change the molecule that an atom belongs to
+    margin = min(200, nframes // 4)
+    events = sorted(rng.choice(np.arange(margin, nframes - margin), nevents, replace=False).tolist())
+    owner_t = np.tile(owner, (nframes, 1))
+    for frame in events:
+        owner_t[frame:, rng.randint(natoms)] = rng.randint(nmol)
+    xyz = (centers + walk)[np.arange(nframes)[:, np.newaxis], owner_t] + offsets + rng.randn(nframes, natoms, 3) * 0.03
+    # Moving atoms travel smoothly to their new molecule over 30 frames
+    for frame in events:
+        for a in np.flatnonzero(owner_t[frame] != owner_t[frame - 1]):
+            x0 = xyz[frame - 1, a].copy()
+            x1 = xyz[min(frame + 30, nframes - 1), a].copy()
+            for s in range(min(30, nframes - frame)):
+                xyz[frame + s, a] = x0 + (x1 - x0) * (s + 1) / 31.0
+    # Bond flickers
+    for frame, a in zip(*np.nonzero(rng.rand(nframes, natoms) < flicker)):
+        xyz[frame:frame + 3, a] += 1.0
+
+    fmt = '\n'.join(['%-2s' % e.replace('%', '%%') + ' % .6f % .6f % .6f' for e in elems])
+    with open(os.path.join(odir, 'coors.xyz'), 'w') as f:
+        for frame in range(nframes):
+            f.write('%i\nframe %i\n' % (natoms, frame))
+            f.write(fmt % tuple(xyz[frame].ravel().tolist()) + '\n')
+    pops = np.zeros((nframes, natoms, 3))
+    pops[:, :, 0] = rng.randn(nframes, natoms) * 0.2
+    pops[:, :, 1] = rng.randn(nframes, natoms) * 0.1
+    with open(os.path.join(odir, 'charge-spin.txt'), 'w') as f:
+        for frame in range(nframes):
+            f.write('%i\nframe %i\n' % (natoms, frame))
+            f.write(fmt % tuple(pops[frame].ravel().tolist()) + '\n')
+    # Bond orders decay exponentially with distance from 1.1 Angstrom
+    with open(os.path.join(odir, 'bond_order.list'), 'w') as f:
+        for frame in range(nframes):
+            pairs = cKDTree(xyz[frame]).query_pairs(2.2, output_type='ndarray')
+            dx = np.linalg.norm(xyz[frame, pairs[:, 0]] - xyz[frame, pairs[:, 1]], axis=1)
+            bo = np.minimum(np.exp(-(dx - 1.1) / 0.25), 2.5)
+            keep = bo > 0.1
+            # The order of the two atoms in each pair is arbitrary in the bond order files
+            swap = rng.rand(keep.sum()) < 0.5
+            pairs = pairs[keep]
+            pairs[swap] = pairs[swap][:, ::-1]
+            f.write('%i\nframe %i\n' % (len(pairs), frame))
+            f.writelines(['%i %i %.4f\n' % (a, b, o) for (a, b), o in zip(pairs.tolist(), bo[keep].tolist())])
+    return events
+
+
+def case_key(mode, natoms, nframes, nevents, flicker, seed):
+    """ Return a string identifying a benchmark case. """
+    return '%s-N%i-F%i-E%i-f%g-s%i' % (mode, natoms, nframes, nevents, flicker, seed)
+
+
+def run_case(case):
+    """
+    Run the analysis of one synthetic trajectory and collect the timings and results.
+    (intended to be called in a fresh process by run_benchmarks)
+
+    Parameters
+    ----------
+    case : dict
+        Contains the trajectory directory 'tdir', the analysis 'mode' ('dx' or 'bo'), and 'nproc'
+
+    Returns
+    -------
+    OrderedDict
+        Wall time of each stage, peak memory usage and a summary of the results
+    """
+    os.chdir(case['tdir'])
+    profile = 'profile-%s.jsonl' % case['mode']
+    if os.path.exists(profile):
+        os.remove(profile)
+    kwargs = dict(Settings, xyzin='coors.xyz', qsin='charge-spin.txt', boin='bond_order.list', printlvl=-1,
+                  profile=profile, nproc=case['nproc'])
+    if case['mode'] == 'bo':
+        kwargs['bothre'] = BondOrderThreshold
+    R = Nanoreactor(**kwargs)
+    with open(profile) as f:
+        records = [json.loads(line) for line in f]
+    out = OrderedDict()
+    out['stages'] = OrderedDict([(StageNames.get(r['stage'], r['stage']), r['wall']) for r in records])
+    out['peak_rss_mb'] = max([r['peak_rss_mb'] or 0.0 for r in records])
+    # Summary of the results, to check that optimizations do not change them
+    results = OrderedDict()
+    results['global_graphs'] = len(R.global_graphs)
+    results['molecules'] = len(R.MolIDs)
+    results['isomers'] = len(R.Isomers)
+    results['events'] = len(R.Events)
+    results['events_sha1'] = hashlib.sha1('\n'.join(R.EventIDs).encode('utf-8')).hexdigest()
+    out['results'] = results
+    return out
+
+
+def run_benchmarks(workdir, natoms=[60], nframes=[2000], nevents=6, flicker=0.002, seed=0, modes=['dx', 'bo'],
+                   repeat=1, nproc=1, printlvl=0):
+    """
+    Generate the synthetic trajectories (if they don't exist already) and run the benchmark cases.
+
+    Parameters
+    ----------
+    workdir : str
+        Directory containing the synthetic trajectories
+    natoms, nframes : list
+        Numbers of atoms and frames; all combinations are run
+    nevents, flicker, seed :
+        Passed to synthetic_trajectory()
+    modes : list
+        Run the analysis using distances ('dx') and/or bond orders ('bo')
+    repeat : int
+        Number of times each case is run; the shortest time of each stage is reported
+    nproc : int
+        Number of processes used by the analysis
+    printlvl : int
+        Print progress if >= 0
+
+    Returns
+    -------
+    OrderedDict
+        Maps case keys (see case_key) to the output of run_case, plus the case parameters
+    """
+    Results = OrderedDict()
+    ctx = multiprocessing.get_context('spawn')
+    for na, nf in itertools.product(natoms, nframes):
+        tdir = os.path.abspath(os.path.join(workdir, case_key('traj', na, nf, nevents, flicker, seed)))
+        if not os.path.exists(os.path.join(tdir, 'bond_order.list')):
+            if printlvl >= 0:
+                print("Generating synthetic trajectory with %i atoms and %i frames in %s" % (na, nf, tdir))
+            synthetic_trajectory(tdir + '.tmp', na, nf, nevents, flicker, seed)
+            os.replace(tdir + '.tmp', tdir)
+        for mode in modes:
+            key = case_key(mode, na, nf, nevents, flicker, seed)
+            runs = []
+            for i in range(repeat):
+                # A fresh process for each run so the peak memory usage is measured separately
+                with ctx.Pool(1) as pool:
+                    runs.append(pool.apply(run_case, (dict(tdir=tdir, mode=mode, nproc=nproc),)))
+            out = runs[0]
+            for stage in out['stages']:
+                out['stages'][stage] = min([r['stages'][stage] for r in runs])
+            out['params'] = OrderedDict([('mode', mode), ('natoms', na), ('nframes', nf)])
+            Results[key] = out
+            if printlvl >= 0:
+                print("%-32s total %8.3f s, peak RSS %8.1f MB, %i events" % (
+                    key, sum(out['stages'].values()), out['peak_rss_mb'], out['results']['events']))
+    return Results
+
+
+def print_table(Results):
+    """ Print the time of each stage for every benchmark case. """
+    stages = list(OrderedDict.fromkeys(itertools.chain(*[r['stages'].keys() for r in Results.values()])))
+    width = max([len(k) for k in Results.keys()] + [4])
+    print()
+    print("Wall time of each stage (s)")
+    print("%-*s " % (width, "case") + ' '.join(["%18s" % s[:18] for s in stages]) + " %10s" % "peak MB")
+    for key, out in Results.items():
+        print("%-*s " % (width, key) + ' '.join(
+            ["%18s" % ("%.3f" % out['stages'][s] if s in out['stages'] else '-') for s in stages]) +
+              " %10.1f" % out['peak_rss_mb'])
+
+
+def scaling_exponents(Results):
+    """
+    Fit the time of each stage to a power of the number of atoms and of the number of frames.
+
+    Returns
+    -------
+    OrderedDict
+        Maps (mode, 'natoms' or 'nframes', stage) to the exponent from a least-squares fit of
+        log(time) against log(size), for each set of cases that differ only in that size
+    """
+    Exponents = OrderedDict()
+    for dim, other in [('natoms', 'nframes'), ('nframes', 'natoms')]:
+        groups = OrderedDict()
+        for out in Results.values():
+            p = out['params']
+            groups.setdefault((p['mode'], p[other]), []).append(out)
+        for (mode, fixed), outs in groups.items():
+            if len(outs) < 2:
+                continue
+            sizes = np.log([o['params'][dim] for o in outs])
+            for stage in outs[0]['stages']:
+                times = [o['stages'].get(stage, 0.0) for o in outs]
+                if min(times) <= 0.0:
+                    continue
+                Exponents[(mode, '%s (%s=%i)' % (dim, other, fixed), stage)] = np.polyfit(sizes, np.log(times), 1)[0]
+    return Exponents
+
+
+def compare_baseline(Results, Baseline, tolerance=1.5):
+    """
+    Compare the benchmark results with a baseline saved by a previous run.
+
+    Parameters
+    ----------
+    Results, Baseline : dict
+        Output of run_benchmarks()
+    tolerance : float
+        Report a slowdown if a stage takes longer than this factor times the baseline
+
+    Returns
+    -------
+    bool
+        True if all results agree with the baseline and there are no slowdowns
+    """
+    ok = True
+    print()
+    print("Comparison with baseline (time / baseline time)")
+    for key, out in Results.items():
+        if key not in Baseline:
+            print("%s : not in baseline" % key)
+            continue
+        base = Baseline[key]
+        if out['results'] != base['results']:
+            ok = False
+            print("%s : \x1b[91mresults differ\x1b[0m from baseline: %s vs. %s" % (
+                key, json.dumps(out['results']), json.dumps(base['results'])))
+        ratios = []
+        for stage, t in out['stages'].items():
+            if stage not in base['stages'] or base['stages'][stage] <= 0.0:
+                continue
+            ratio = t / base['stages'][stage]
+            # Ignore very short stages, which are dominated by noise
+            slow = ratio > tolerance and t - base['stages'][stage] > 0.05
+            ok = ok and not slow
+            ratios.append("%s %s%.2f%s" % (stage, "\x1b[91m" if slow else "", ratio, "\x1b[0m" if slow else ""))
+        print("%s : %s" % (key, ', '.join(ratios)))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--natoms', type=int, nargs='+', default=[60], help='Numbers of atoms. Default: 60')
+    parser.add_argument('--nframes', type=int, nargs='+', default=[2000], help='Numbers of frames. Default: 2000')
+    parser.add_argument('--nevents', type=int, default=6, help='Number of reaction events. Default: 6')
+    parser.add_argument('--flicker', type=float, default=0.002,
+                        help='Bond flicker probability per atom and frame. Default: 0.002')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the trajectories. Default: 0')
+    parser.add_argument('--modes', type=str, nargs='+', default=['dx', 'bo'], choices=['dx', 'bo'],
+                        help='Analyze distances and/or bond orders. Default: dx bo')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of each case (fastest is reported). Default: 1')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of processes used by the analysis. Default: 1')
+    parser.add_argument('--workdir', type=str, default='nanoreactor-benchmark',
+                        help='Directory for the synthetic trajectories. Default: nanoreactor-benchmark')
+    parser.add_argument('--save', type=str, default=None, help='Save the results to this JSON file.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Compare the results with a JSON file saved by --save; the exit status is nonzero '
+                             'if the results differ or a stage is slower.')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Slowdown factor relative to the baseline that is reported as a failure. Default: 1.5')
+    args = parser.parse_args()
+
+    Results = run_benchmarks(args.workdir, args.natoms, args.nframes, args.nevents, args.flicker, args.seed,
+                             args.modes, args.repeat, args.nproc)
+    print_table(Results)
+    Exponents = scaling_exponents(Results)
+    if Exponents:
+        print()
+        print("Scaling exponents (time ~ size^x)")
+        for (mode, dim, stage), x in Exponents.items():
+            print("%-3s %-28s %-24s %6.2f" % (mode, dim, stage, x))
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(Results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            Baseline = json.load(f, object_pairs_hook=OrderedDict)
+        if not compare_baseline(Results, Baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
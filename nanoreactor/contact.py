@@ -1,130 +1,245 @@
 '''
-Wrappers to C functions for computing the geometry at each frame of
-a trajectory
+Distances and displacement vectors between pairs of atoms at each frame
+of a trajectory
+
+The work is split into chunks over frames and atom pairs, so the temporary
+arrays stay small no matter how long the trajectory is.  The chunks are computed
+in place in preallocated buffers and run on a pool of threads (NumPy releases
+the GIL), or by a compiled kernel if numba is installed.
 '''
-import _contact_wrap
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    # Optional; the NumPy implementation is used instead
+    numba = None
+    prange = range
 
-def atom_distances(xyzlist, atom_contacts):
-    '''
-    For each frame in xyzlist, compute the (euclidean) distance between
-    pairs of atoms whos indices are given in contacts.
+# Approximate number of displacement vectors computed in one chunk
+CHUNK_SIZE = 2 ** 16
 
-    xyzlist should be a traj_length x num_atoms x num_dims array
-    of type float64
 
-    contacts should be a num_contacts x 2 array where each row
-    gives the indices of 2 atoms whos distance you care to monitor.
+def minimum_image(dxyz, box):
+    '''
+    Apply the minimum image convention to displacement vectors.
 
-    Returns: traj_length x num_contacts array of euclidean distances
+    dxyz should be a traj_length x num_vectors x 3 array of displacement vectors.
 
-    Note:
-    For nice wrappers around this, see the prepare_trajectory method
-    of various metrics in metrics.py
-    '''
+    box should be a traj_length x 3 array of rectilinear box lengths, or a
+    traj_length x 3 x 3 array whose rows are the box vectors A, B, C of each frame.
 
-    # check shapes
+    Returns: traj_length x num_vectors x 3 array of the shortest periodic
+    images of the displacement vectors
+    '''
+    box = np.asarray(box)
+    if box.ndim == 2:
+        return dxyz - box[:, np.newaxis, :] * np.round(dxyz / box[:, np.newaxis, :])
+    frac = np.einsum('fni,fij->fnj', dxyz, np.linalg.inv(box))
+    frac -= np.round(frac)
+    dxyz = np.einsum('fni,fij->fnj', frac, box)
+    # In a skewed box the image inside the centered unit cell is not always the shortest one,
+    # so the images in the neighboring cells are checked as well.
+    best = dxyz.copy()
+    dr2 = np.sum(dxyz ** 2, axis=2)
+    for shift in itertools.product((-1, 0, 1), repeat=3):
+        if not any(shift): continue
+        trial = dxyz + np.einsum('i,fij->fj', shift, box)[:, np.newaxis, :]
+        trial2 = np.sum(trial ** 2, axis=2)
+        shorter = trial2 < dr2
+        best[shorter] = trial[shorter]
+        dr2[shorter] = trial2[shorter]
+    return best
+
+
+def _contact_kernel(xyz, a1, a2, box, consts, dr, dx):
+    '''
+    Loop version of _numpy_chunk, compiled by numba if it is installed.
+    box has zero rows if there is no periodic box and dx has zero rows if the
+    displacements are not needed.  consts contains 0, 0.5 and 1 in the same precision
+    as xyz and box, so the operations are done in the order and precision of _numpy_chunk.
+    '''
+    zero, half, one = consts[0], consts[1], consts[2]
+    for f in prange(xyz.shape[0]):
+        for p in range(a1.shape[0]):
+            r2 = zero
+            for k in range(3):
+                if box.shape[0] > 0:
+                    b = box[f, k]
+                    d = (xyz[f, a2[p], k] / b) % one - (xyz[f, a1[p], k] / b) % one
+                    d = ((d + half) % one - half) * b
+                else:
+                    d = xyz[f, a2[p], k] - xyz[f, a1[p], k]
+                if dx.shape[0] > 0:
+                    dx[f, p, k] = d
+                r2 += d * d
+            dr[f, p] = np.sqrt(r2)
+
+
+if numba is not None:
+    _contact_kernel = numba.njit(parallel=True, cache=True)(_contact_kernel)
+
+
+def _numpy_chunk(xyz, contacts, box, dr, dx, dtype):
+    '''
+    Compute the distances for one chunk of frames and pairs, writing the results into dr,
+    and the displacements into dx if it is not None.
+    '''
+    sel = xyz.astype(dtype, copy=False)
+    if box is not None and box.ndim == 2:
+        # Place all atoms in the box [0, xbox); [0, ybox); [0, zbox) in fractional coordinates
+        sel = np.divide(sel, box[:, np.newaxis, :], out=np.empty(sel.shape, dtype=dtype), casting='unsafe')
+        np.mod(sel, 1.0, out=sel, casting='unsafe')
+    disp = np.take(sel, contacts[:, 1], axis=1, out=dx)
+    disp -= np.take(sel, contacts[:, 0], axis=1)
+    if box is not None and box.ndim == 2:
+        # Minimum image convention, then convert back to Cartesian coordinates
+        disp += 0.5
+        np.mod(disp, 1.0, out=disp)
+        disp -= 0.5
+        np.multiply(disp, box[:, np.newaxis, :], out=disp, casting='unsafe')
+    elif box is not None:
+        disp[:] = minimum_image(disp, box)
+    dr2 = np.square(disp[:, :, 0], out=dr)
+    dr2 += disp[:, :, 1] ** 2
+    dr2 += disp[:, :, 2] ** 2
+    np.sqrt(dr2, out=dr2)
+
+
+def _contact_engine(xyzlist, atom_contacts, box, displace, dtype, out, chunk, nthreads):
+    '''
+    Shared implementation of atom_distances and atom_displacements.
+    '''
+    xyzlist = np.asarray(xyzlist)
     traj_length, num_atoms, num_dims = xyzlist.shape
     if not num_dims == 3:
         raise ValueError("xyzlist must be an n x m x 3 array")
-    try:
-        num_contacts, width = atom_contacts.shape
-        assert width is 2
-    except (AttributeError, ValueError, AssertionError):
+    atom_contacts = np.asarray(atom_contacts)
+    if atom_contacts.ndim != 2 or atom_contacts.shape[1] != 2:
         raise ValueError('contacts must be an n x 2 array')
-
-    if not np.all(np.unique(atom_contacts) < num_atoms):
+    if atom_contacts.size > 0 and (atom_contacts.max() >= num_atoms or atom_contacts.min() < 0):
         raise ValueError('Atom contacts goes larger than num_atoms')
-
-    # check type
-    if xyzlist.dtype != np.float64:
-        xyzlist = np.float64(xyzlist)
-    if atom_contacts.dtype != np.int32:
-        atom_contacts = np.int32(atom_contacts)
-
-    # make sure contiguous
-    if not xyzlist.flags.contiguous:
-        warnings.warn("xyzlist is not contiguous: copying", RuntimeWarning)
-        xyzlist = np.copy(xyzlist)
-    if not atom_contacts.flags.contiguous:
-        warnings.warn("contacts is not contiguous: copying", RuntimeWarning)
-        contacts = np.copy(contacts)
-
-    results = np.zeros((traj_length, num_contacts), dtype=np.float64)
-
-    _contact_wrap.atomic_contact_wrap(xyzlist, atom_contacts, results)
-
-    return results
-
-
-def atom_displacements(xyzlist, atom_contacts):
+    if box is not None:
+        box = np.asarray(box, dtype=np.float64)
+        if box.shape not in ((traj_length, 3), (traj_length, 3, 3)):
+            raise ValueError('box must be a traj_length x 3 or traj_length x 3 x 3 array')
+    if dtype is None:
+        # Single precision positions are kept in single precision
+        dtype = np.result_type(xyzlist.dtype, np.float32)
+    dtype = np.dtype(dtype)
+    if box is not None and box.ndim == 2:
+        # Rectilinear boxes are applied in the precision of the calculation
+        box = box.astype(dtype, copy=False)
+    num_contacts = len(atom_contacts)
+
+    if out is None:
+        dr = np.empty((traj_length, num_contacts), dtype=dtype)
+        dx = np.empty((traj_length, num_contacts, 3), dtype=dtype) if displace else None
+    else:
+        dr, dx = out if displace else (out, None)
+
+    if numba is not None and (box is None or box.ndim == 2):
+        if nthreads is not None:
+            numba.set_num_threads(max(1, min(nthreads, numba.config.NUMBA_NUM_THREADS)))
+        a1 = np.ascontiguousarray(atom_contacts[:, 0], dtype=np.int64)
+        a2 = np.ascontiguousarray(atom_contacts[:, 1], dtype=np.int64)
+        consts = np.array([0.0, 0.5, 1.0], dtype=dtype)
+        # The positions are converted to dtype (if needed) one chunk of frames at a time
+        frame_block = max(1, chunk // max(1, num_atoms))
+        for f0 in range(0, traj_length, frame_block):
+            f1 = min(f0 + frame_block, traj_length)
+            _contact_kernel(xyzlist[f0:f1].astype(dtype, copy=False), a1, a2,
+                            np.zeros((0, 3), dtype=dtype) if box is None else box[f0:f1], consts, dr[f0:f1],
+                            dx[f0:f1] if displace else np.zeros((0, 0, 3), dtype=dtype))
+        return (dr, dx) if displace else dr
+
+    # Chunks of pairs, then chunks of frames, so that each chunk has about (chunk) displacement vectors
+    pair_block = max(1, min(num_contacts, chunk))
+    frame_block = max(1, chunk // pair_block)
+    blocks = [(f, min(f + frame_block, traj_length), p, min(p + pair_block, num_contacts))
+              for p in range(0, num_contacts, pair_block) for f in range(0, traj_length, frame_block)]
+
+    def run(block):
+        f0, f1, p0, p1 = block
+        # With a single chunk of pairs, the displacements are written straight into the output
+        if dx is None:
+            dx_chunk = None
+        elif p0 == 0 and p1 == num_contacts:
+            dx_chunk = dx[f0:f1]
+        else:
+            dx_chunk = np.empty((f1 - f0, p1 - p0, 3), dtype=dtype)
+        _numpy_chunk(xyzlist[f0:f1], atom_contacts[p0:p1], None if box is None else box[f0:f1],
+                     dr[f0:f1, p0:p1], dx_chunk, dtype)
+        if dx_chunk is not None and dx_chunk.base is not dx:
+            dx[f0:f1, p0:p1] = dx_chunk
+
+    if nthreads is None:
+        nthreads = os.cpu_count() or 1
+    if nthreads > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(min(nthreads, len(blocks))) as pool:
+            list(pool.map(run, blocks))
+    else:
+        for block in blocks:
+            run(block)
+    return (dr, dx) if displace else dr
+
+
+def atom_distances(xyzlist, atom_contacts, box=None, dtype=None, out=None, chunk=CHUNK_SIZE, nthreads=None):
     '''
     For each frame in xyzlist, compute the (euclidean) distance between
     pairs of atoms whos indices are given in contacts.
 
-    xyzlist should be a traj_length x num_atoms x num_dims array
-    of type float64
+    xyzlist should be a traj_length x num_atoms x num_dims array; it is not copied.
 
     contacts should be a num_contacts x 2 array where each row
     gives the indices of 2 atoms whos distance you care to monitor.
 
-    Returns: traj_length x num_contacts array of euclidean distances
+    box (optional) should be a traj_length x 3 array of rectilinear box lengths
+    or a traj_length x 3 x 3 array of box vectors, for minimum image distances.
 
-    Note:
-    For nice wrappers around this, see the prepare_trajectory method
-    of various metrics in metrics.py
-    '''
+    dtype is the floating point type of the calculation and the result; by default
+    float32 positions give float32 distances and anything else gives float64.
 
-    # check shapes
-    traj_length, num_atoms, num_dims = xyzlist.shape
-    if not num_dims == 3:
-        raise ValueError("xyzlist must be an n x m x 3 array")
-    try:
-        num_contacts, width = atom_contacts.shape
-        assert width is 2
-    except (AttributeError, ValueError, AssertionError):
-        raise ValueError('contacts must be an n x 2 array')
+    out (optional) is a traj_length x num_contacts array that receives the result.
 
-    if not np.all(np.unique(atom_contacts) < num_atoms):
-        raise ValueError('Atom contacts goes larger than num_atoms')
+    chunk is the approximate number of pairs times frames computed at a time, and
+    nthreads the number of threads (by default, the number of CPUs).
 
-    # check type
-    if xyzlist.dtype != np.float64:
-        xyzlist = np.float64(xyzlist)
-    if atom_contacts.dtype != np.int32:
-        atom_contacts = np.int32(atom_contacts)
+    Returns: traj_length x num_contacts array of euclidean distances
+    '''
+    return _contact_engine(xyzlist, atom_contacts, box, False, dtype, out, chunk, nthreads)
 
-    # make sure contiguous
-    if not xyzlist.flags.contiguous:
-        warnings.warn("xyzlist is not contiguous: copying", RuntimeWarning)
-        xyzlist = np.copy(xyzlist)
-    if not atom_contacts.flags.contiguous:
-        warnings.warn("contacts is not contiguous: copying", RuntimeWarning)
-        contacts = np.copy(contacts)
 
-    results_dr = np.zeros((traj_length, num_contacts), dtype=np.float64)
-    results_dx = np.zeros((traj_length, num_contacts, 3), dtype=np.float64)
+def atom_displacements(xyzlist, atom_contacts, box=None, dtype=None, out=None, chunk=CHUNK_SIZE, nthreads=None):
+    '''
+    For each frame in xyzlist, compute the (euclidean) distance and the displacement
+    vector between pairs of atoms whos indices are given in contacts.
 
-    _contact_wrap.atomic_displacement_wrap(xyzlist, atom_contacts, results_dr, results_dx)
+    The arguments are the same as for atom_distances, except that out (optional)
+    is a 2-tuple of traj_length x num_contacts and traj_length x num_contacts x 3 arrays.
 
-    return results_dr, results_dx
+    Returns: traj_length x num_contacts array of euclidean distances, and
+    traj_length x num_contacts x 3 array of displacement vectors (second atom minus first)
+    '''
+    return _contact_engine(xyzlist, atom_contacts, box, True, dtype, out, chunk, nthreads)
 
 
-def residue_distances(xyzlist, residue_membership, residue_contacts):
+def residue_distances(xyzlist, residue_membership, residue_contacts, box=None):
     '''
     For each frame in xyzlist, and for each pair of residues in the
     array contact, compute the distance between the closest pair of
     atoms such that one of them belongs to each residue.
 
     xyzlist should be a traj_length x num_atoms x num_dims array
-    of type float64
 
     residue_membership should be a list of lists where
     residue_membership[i] gives the list of atomindices
-    that belong to residue i. residue_membership should NOT
-    be a numpy 2D array unless you really mean that all of
-    the residues have the same number of atoms
+    that belong to residue i.
 
     residue_contacts should be a 2D numpy array of shape num_contacts x 2 where
     each row gives the indices of the two RESIDUES who you are interested
@@ -134,39 +249,16 @@ def residue_distances(xyzlist, residue_membership, residue_contacts):
     the distance between the pair of atoms, one from residue_membership[residue_contacts[j,0]]
     and one from residue_membership[residue_contacts[j,1]] that are closest.
     '''
-
-    traj_length, num_atoms, num_dims = xyzlist.shape
-    if not num_dims == 3:
-        raise ValueError("xyzlist must be n x m x 3")
-    try:
-        num_contacts, width = residue_contacts.shape
-        assert width is 2
-    except (AttributeError, ValueError, AssertionError):
+    residue_contacts = np.asarray(residue_contacts)
+    if residue_contacts.ndim != 2 or residue_contacts.shape[1] != 2:
         raise ValueError('residue_contacts must be an n x 2 array')
-
-    # check type
-    if xyzlist.dtype != np.float64:
-        xyzlist = np.float64(xyzlist)
-    if residue_contacts.dtype != np.int32:
-        residue_contacts = np.int32(residue_contacts)
-
-    # check contiguous
-    if not xyzlist.flags.contiguous:
-        warnings.warn("xyzlist is not contiguous: copying", RuntimeWarning)
-        xyzlist = np.copy(xyzlist)
-    if not residue_contacts.flags.contiguous:
-        warnings.warn("contacts is not contiguous: copying", RuntimeWarning)
-        residue_contacts = np.copy(residue_contacts)
-
-    num_residues = len(residue_membership)
-    residue_widths = np.array([len(r) for r in residue_membership], dtype=np.int32)
-    max_residue_width = max(residue_widths)
-    residue_membership_array = -1 * np.ones((num_residues, max_residue_width), dtype=np.int32)
-    for i in range(num_residues):
-        residue_membership_array[i, 0:residue_widths[i]] = np.array(residue_membership[i], dtype=np.int32)
-
-    results = np.zeros((traj_length, num_contacts), np.float64)
-
-    _contact_wrap.closest_contact_wrap(xyzlist, residue_membership_array, residue_widths, residue_contacts, results)
-
-    return results
+    # All atom pairs of each residue pair, followed by a minimum over each group of pairs
+    groups = [np.array(list(itertools.product(residue_membership[r1], residue_membership[r2])), dtype=int).reshape(-1, 2)
+              for r1, r2 in residue_contacts]
+    sizes = np.array([len(g) for g in groups], dtype=int)
+    if np.any(sizes == 0):
+        raise ValueError('Residues must contain at least one atom')
+    if len(groups) == 0:
+        return np.zeros((len(xyzlist), 0))
+    dr = atom_distances(xyzlist, np.concatenate(groups), box=box)
+    return np.minimum.reduceat(dr, np.cumsum(sizes) - sizes, axis=1)
@@ -1,4 +1,6 @@
 import copy
+import functools
+import hashlib
 import imp
 import itertools
 import json
@@ -6,7 +8,7 @@ import os
 import re
 import sys
 import sysconfig
-from collections import Counter, OrderedDict, namedtuple
+from collections import Counter, OrderedDict, defaultdict, namedtuple
 from ctypes import *
 from datetime import date
 
@@ -15,6 +17,8 @@ from numpy import arccos, cos, sin
 from numpy.linalg import multi_dot
 from pkg_resources import parse_version
 
+from .contact import atom_displacements, atom_distances
+
 # For Python 3 compatibility
 from itertools import zip_longest as zip_longest
 
@@ -168,6 +172,8 @@ AtomVariableNames = {'elem', 'partial_charge', 'atomname', 'atomtype', 'tinkersu
 # mult       = The spin multiplicity of the molecule
 MetaVariableNames = {'fnm', 'ftype', 'qcrems', 'qctemplate', 'qcerr', 'charge', 'mult', 'bonds', 'topology',
                      'molecules'}
+# Frame variables that are arrays along the atom axis in each frame
+AtomFrameVariableNames = {'xyzs', 'qm_grads', 'qm_mulliken_charges', 'qm_mulliken_spins'}
 # Variable names relevant to quantum calculations explicitly
 QuantumVariableNames = {'qcrems', 'qctemplate', 'charge', 'mult', 'qcsuf', 'qm_ghost', 'qm_bondorder'}
 # Superset of all variable names.
@@ -491,6 +497,88 @@ def BuildLatticeFromVectors(v1, v2, v3):
                v * a * b * c)
 
 
+def graph_hash(G, iterations=3):
+    """
+    Return a canonical hash of a molecular graph using Weisfeiler-Lehman relabeling
+    of the element labels.  Isomorphic graphs (with matching elements) always have
+    the same hash, so the hash can be used to rule out most non-isomorphic graphs
+    before doing a full isomorphism check.  The hash is built with hashlib so it is
+    reproducible across Python processes.
+
+    Parameters
+    ----------
+    G : nx.Graph
+        Graph whose nodes have an 'e' attribute containing the element
+    iterations : int
+        Number of relabeling iterations
+
+    Returns
+    -------
+    str
+        Hexadecimal digest
+    """
+    labels = dict([(n, str(d.get('e'))) for n, d in G.nodes(data=True)])
+    counts = [sorted(labels.values())]
+    for it in range(iterations):
+        labels = dict([(n, hashlib.md5(('%s(%s)' % (labels[n], ','.join(sorted([labels[m] for m in G.neighbors(n)]))))
+                                       .encode('utf-8')).hexdigest()[:16]) for n in labels])
+        counts.append(sorted(labels.values()))
+    return hashlib.md5(';'.join([','.join(c) for c in counts]).encode('utf-8')).hexdigest()
+
+
+class IsomerRegistry(object):
+    """
+    Registry of unique isomers (molecular graphs) indexed by their canonical graph hash.
+    Looking up a graph compares it only against the registered isomers with the same hash,
+    so the full isomorphism check is only needed on hash collisions.
+
+    The position of an isomer in the registry is its isomer index, and isomers are
+    never removed, so indices remain valid for the lifetime of the registry.
+    """
+
+    def __init__(self):
+        # List of registered graphs; position in this list is the isomer index
+        self.graphs = []
+        # Dictionary that maps graph hashes to isomer indices
+        self.buckets = defaultdict(list)
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def __getitem__(self, iidx):
+        return self.graphs[iidx]
+
+    def __iter__(self):
+        return iter(self.graphs)
+
+    def __contains__(self, G):
+        return self.find(G) is not None
+
+    @staticmethod
+    def key(G):
+        """ Return the graph hash of G, using the cached value if G keeps one (see HashedGraph). """
+        return G.wl_hash() if hasattr(G, 'wl_hash') else graph_hash(G)
+
+    def find(self, G, ghash=None):
+        """ Return the isomer index of a graph, or None if it is not registered. """
+        if ghash is None:
+            ghash = self.key(G)
+        for iidx in self.buckets.get(ghash, []):
+            if self.graphs[iidx] == G:
+                return iidx
+        return None
+
+    def add(self, G):
+        """ Return the isomer index of a graph, registering it if it is new. """
+        ghash = self.key(G)
+        iidx = self.find(G, ghash)
+        if iidx is None:
+            iidx = len(self.graphs)
+            self.graphs.append(G)
+            self.buckets[ghash].append(iidx)
+        return iidx
+
+
 # ===========================#
 # |   Connectivity graph    |#
 # |  Good for doing simple  |#
@@ -500,7 +588,40 @@ try:
     import networkx as nx
 
 
-    class MyG(nx.Graph):
+    class HashedGraph(nx.Graph):
+        """
+        Graph that keeps its graph_hash() once computed, until its nodes or edges change.
+        The element labels should be set when the nodes are added (as in build_topology),
+        because changing node attributes afterwards does not reset the stored hash.
+        """
+
+        def wl_hash(self):
+            """ Return the Weisfeiler-Lehman hash of the graph, computing it only if the graph has changed. """
+            state = (self.number_of_nodes(), self.number_of_edges())
+            cached = self.__dict__.get('_wl_hash')
+            if cached is None or cached[0] != state:
+                cached = (state, graph_hash(self))
+                self.__dict__['_wl_hash'] = cached
+            return cached[1]
+
+
+    def _resets_hash(method):
+        # Wrap a method of nx.Graph that changes the nodes or edges, so the stored hash is dropped
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            self.__dict__.pop('_wl_hash', None)
+            return method(self, *args, **kwargs)
+
+        return wrapper
+
+
+    for _name in ['add_node', 'add_nodes_from', 'remove_node', 'remove_nodes_from', 'add_edge', 'add_edges_from',
+                  'add_weighted_edges_from', 'remove_edge', 'remove_edges_from', 'update', 'clear', 'clear_edges']:
+        if hasattr(nx.Graph, _name):
+            setattr(HashedGraph, _name, _resets_hash(getattr(nx.Graph, _name)))
+
+
+    class MyG(HashedGraph):
         def __init__(self):
             super(MyG, self).__init__()
             self.Alive = True
@@ -514,8 +635,11 @@ try:
             return nx.is_isomorphic(self, other, node_match=nodematch)
 
         def __hash__(self):
-            """ The hash function is something we can use to discard two things that are obviously not equal.  Here we neglect the hash. """
-            return 1
+            """ The hash function is something we can use to discard two things that are obviously not equal.
+            Here we use the Weisfeiler-Lehman hash of the element-labelled graph, so that dictionaries and
+            Counters of graphs only check isomorphism when the hashes collide.  It is computed once per graph
+            (see HashedGraph). """
+            return int(self.wl_hash()[:15], 16)
 
         def L(self):
             """ Return a list of the sorted atom numbers in this graph. """
@@ -1072,7 +1196,8 @@ def AtomContact(xyz, pairs, box=None, displace=False):
     pairs : list
         List of 2-tuples of atom indices
     box : np.ndarray, optional
-        N_frames*3 (2D) array of periodic box vectors
+        N_frames*3 (2D) array of rectilinear periodic box lengths, or
+        N_frames*3*3 (3D) array of triclinic box vectors (see contact.minimum_image)
         If you only have a single set of positions, pass in box[np.newaxis, :]
     displace : bool
         If True, also return N_frames*N_pairs*3 array of displacement vectors
@@ -1080,36 +1205,96 @@ def AtomContact(xyz, pairs, box=None, displace=False):
     Returns
     -------
     np.ndarray
-        N_pairs*N_frames (2D) array of minimum image convention distances
+        N_frames*N_pairs (2D) array of minimum image convention distances
     np.ndarray (optional)
         if displace=True, N_frames*N_pairs*3 array of displacement vectors
     """
-    # Obtain atom selections for atom pairs
-    parray = np.array(pairs)
-    sel1 = parray[:, 0]
-    sel2 = parray[:, 1]
-    xyzpbc = xyz.copy()
-    # Minimum image convention: Place all atoms in the box
-    # [0, xbox); [0, ybox); [0, zbox)
-    if box is not None:
-        xyzpbc /= box[:, np.newaxis, :]
-        xyzpbc = xyzpbc % 1.0
-    # Obtain atom selections for the pairs to be computed
-    # These are typically longer than N but shorter than N^2.
-    xyzsel1 = xyzpbc[:, sel1, :]
-    xyzsel2 = xyzpbc[:, sel2, :]
-    # Calculate xyz displacement
-    dxyz = xyzsel2 - xyzsel1
-    # Apply minimum image convention to displacements
-    if box is not None:
-        dxyz = np.mod(dxyz + 0.5, 1.0) - 0.5
-        dxyz *= box[:, np.newaxis, :]
-    dr2 = np.sum(dxyz ** 2, axis=2)
-    dr = np.sqrt(dr2)
+    # The distances are computed in chunks without copying the positions (see contact.py)
+    pairs = np.array(pairs, dtype=int).reshape(-1, 2)
     if displace:
-        return dr, dxyz
+        return atom_displacements(xyz, pairs, box=box)
     else:
-        return dr
+        return atom_distances(xyz, pairs, box=box)
+
+
+def cell_list_pairs(xyz, cutoff, box=None):
+    """
+    Find the pairs of atoms that may be closer than a cutoff distance using a cell list.
+
+    The atoms are binned into cells that are at least (cutoff) wide and sorted by cell.
+    The atoms in each occupied cell are paired with those in the same cell and in the
+    13 neighboring cells of a half shell, so that each pair of neighboring cells is visited once.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        N_atoms*3 (2D) array of atomic positions
+    cutoff : float
+        Distance cutoff
+    box : np.ndarray, optional
+        3 rectilinear box lengths, or 3*3 array whose rows are the box vectors,
+        for pairs under periodic boundary conditions
+
+    Returns
+    -------
+    np.ndarray
+        N_pairs*2 array of atom pairs (a1, a2) with a2 > a1, in sorted order, containing
+        all pairs whose (minimum image) distance is below the cutoff
+    """
+    na = len(xyz)
+    if na < 100:
+        # Checking all pairs is faster than building the cell list for small systems
+        return np.array(np.triu_indices(na, 1), dtype=int).T.reshape(-1, 2)
+    if box is None:
+        periodic = False
+        origin = np.min(xyz, axis=0)
+        ncell = np.floor((np.max(xyz, axis=0) - origin) / cutoff).astype(np.int64) + 1
+        cell = np.floor_divide(xyz - origin, cutoff).astype(np.int64)
+    else:
+        periodic = True
+        box = np.asarray(box, dtype=float)
+        vectors = np.diag(box) if box.ndim == 1 else box
+        # Cells are bins of the fractional coordinates; each is at least (cutoff) wide
+        # because the number of bins is limited by the distance between opposite faces of the box.
+        widths = abs(np.linalg.det(vectors)) / np.linalg.norm(np.cross(vectors[[1, 2, 0]], vectors[[2, 0, 1]]), axis=1)
+        ncell = np.maximum(1, np.floor(widths / cutoff)).astype(np.int64)
+        frac = xyz.dot(np.linalg.inv(vectors))
+        cell = np.floor_divide((frac - np.floor(frac)) * ncell, 1.0).astype(np.int64)
+    np.clip(cell, 0, ncell - 1, out=cell)
+    # Sort the atoms by cell; each occupied cell owns a contiguous range of the sorted atoms
+    ids = np.ravel_multi_index(cell.T, ncell)
+    order = np.argsort(ids, kind='stable')
+    cells, start, count = np.unique(ids[order], return_index=True, return_counts=True)
+    coords = np.array(np.unravel_index(cells, ncell)).T
+    # Pairs of occupied cells (c1, c2) related by the zero offset or one of the half-shell offsets
+    c1, c2 = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        if offset < (0, 0, 0): continue
+        nbr = coords + offset
+        if periodic:
+            nbr %= ncell
+            valid = np.ones(len(nbr), dtype=bool)
+        else:
+            valid = np.all((nbr >= 0) & (nbr < ncell), axis=1)
+            nbr[~valid] = 0
+        nids = np.ravel_multi_index(nbr.T, ncell)
+        pos = np.minimum(np.searchsorted(cells, nids), len(cells) - 1)
+        found = np.flatnonzero(valid & (cells[pos] == nids))
+        c1.append(found)
+        c2.append(pos[found])
+    c1 = np.concatenate(c1)
+    c2 = np.concatenate(c2)
+    # All combinations of the atoms in each pair of cells
+    sizes = count[c1] * count[c2]
+    block = np.repeat(np.arange(len(c1)), sizes)
+    k = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    k1, k2 = np.divmod(k, count[c2][block])
+    keep = (c1[block] != c2[block]) | (k1 < k2)
+    a1 = order[start[c1][block][keep] + k1[keep]]
+    a2 = order[start[c2][block][keep] + k2[keep]]
+    # Small periodic boxes can reach the same pair of cells through more than one offset
+    keys = np.unique(np.minimum(a1, a2).astype(np.int64) * na + np.maximum(a1, a2))
+    return np.array([keys // na, keys % na], dtype=int).T.reshape(-1, 2)
 
 
 # ===================================#
@@ -1432,6 +1617,41 @@ class Molecule(object):
             self.Data[key] = value
         return super(Molecule, self).__setattr__(key, value)
 
+    def xyz_array(self):
+        """
+        Return the coordinates as a single (frames, atoms, 3) array.
+
+        If the frames are consecutive views into one array (as when loaded from an
+        xyz cache), that array is returned without copying; otherwise the frames are
+        copied into a new array.
+        """
+        xyzs = self.xyzs
+        base = xyzs[0].base if len(xyzs) > 0 else None
+        if isinstance(base, np.ndarray) and base.ndim == 3 and len(base) == len(xyzs):
+            addr = base.__array_interface__['data'][0]
+            if all([x.base is base and x.__array_interface__['data'][0] == addr + i * base.strides[0]
+                    for i, x in enumerate(xyzs)]):
+                return base
+        return np.array(xyzs)
+
+    def view(self, frames=None, atoms=None):
+        """
+        Return a lazy selection of frames and atoms (see MoleculeView).
+
+        Parameters
+        ----------
+        frames : int, slice, list or np.ndarray, optional
+            Frames to be selected; defaults to all frames
+        atoms : int, list or np.ndarray, optional
+            Atoms to be selected; defaults to all atoms
+
+        Returns
+        -------
+        MoleculeView
+            Selection that refers to this Molecule until it is materialized
+        """
+        return MoleculeView(self, frames, atoms)
+
     def __deepcopy__(self, memo):
         """ Custom deepcopy method because Python 3.6 appears to have changed its behavior """
         New = Molecule()
@@ -1495,12 +1715,11 @@ class Molecule(object):
         if isinstance(key, int) or isinstance(key, slice) or isinstance(key, np.ndarray) or isinstance(key, list):
             if isinstance(key, int):
                 key = [key]
+            # Only the selected frames are copied
+            frames = np.arange(len(self))[key]
             New = Molecule()
             for k in self.FrameKeys:
-                if k == 'boxes':
-                    New.Data[k] = [j for i, j in enumerate(self.Data[k]) if i in np.arange(len(self))[key]]
-                else:
-                    New.Data[k] = list(np.array(copy.deepcopy(self.Data[k]))[key])
+                New.Data[k] = [copy.deepcopy(self.Data[k][i]) for i in frames]
             for k in self.AtomKeys | self.MetaKeys:
                 New.Data[k] = copy.deepcopy(self.Data[k])
             New.top_settings = copy.deepcopy(self.top_settings)
@@ -1749,8 +1968,7 @@ class Molecule(object):
                 if os.path.islink(fnm):
                     os.unlink(fnm)
                 outfile = open(fnm, 'w')
-            for line in Answer:
-                print(line, file=outfile)
+            outfile.writelines('%s\n' % (line,) for line in Answer)
             outfile.close()
 
     # =====================================#
@@ -1908,7 +2126,7 @@ class Molecule(object):
         if isinstance(atomslice, list):
             atomslice = np.array(atomslice)
         New = Molecule()
-        for key in self.FrameKeys | self.MetaKeys:
+        for key in (self.FrameKeys - AtomFrameVariableNames) | self.MetaKeys:
             New.Data[key] = copy.deepcopy(self.Data[key])
         for key in self.AtomKeys:
             if key == 'tinkersuf':  # Tinker suffix is a bit tricky
@@ -1927,12 +2145,10 @@ class Molecule(object):
                 New.Data['tinkersuf'] = NewSuf[:]
             else:
                 New.Data[key] = list(np.array(self.Data[key])[atomslice])
-        for key in self.FrameKeys:
-            if key in ['xyzs', 'qm_grads', 'qm_mulliken_charges', 'qm_mulliken_spins']:
-                New.Data[key] = [self.Data[key][i][atomslice] for i in range(len(self))]
+        for key in self.FrameKeys & AtomFrameVariableNames:
+            New.Data[key] = [self.Data[key][i][atomslice] for i in range(len(self))]
         if 'bonds' in self.Data:
-            New.Data['bonds'] = [(list(atomslice).index(b[0]), list(atomslice).index(b[1])) for b in self.bonds if
-                                 (b[0] in atomslice and b[1] in atomslice)]
+            New.Data['bonds'] = select_bonds(self.bonds, atomslice)
         New.top_settings = self.top_settings
         if build_topology:
             New.build_topology(force_bonds=False)
@@ -2067,7 +2283,28 @@ class Molecule(object):
     def build_bonds(self):
         """ Build the bond connectivity graph. """
         sn = self.top_settings['topframe']
-        toppbc = self.top_settings['toppbc']
+        self.Data['bonds'] = self.find_bonds([sn])[0]
+        # Update topology settings with what we learned
+        self.top_settings['toppbc'] = self.top_settings['toppbc'] and hasattr(self, 'boxes')
+        self.built_bonds = True
+
+    def find_bonds(self, frames=None):
+        """
+        Find the bonds from interatomic distances in any number of frames, using the
+        settings in self.top_settings (except topframe).  Two atoms are bonded if they are
+        closer than the sum of their covalent radii times Fac, or closer than 1 Angstrom.
+
+        Parameters
+        ----------
+        frames : list, optional
+            Frame numbers; the default is all frames
+
+        Returns
+        -------
+        list
+            For each frame, the sorted list of bonds as 2-tuples of atom indices (a1, a2) with a2 > a1
+        """
+        toppbc = self.top_settings['toppbc'] and hasattr(self, 'boxes')
         Fac = self.top_settings['Fac']
         mindist = 1.0  # Any two atoms that are closer than this distance are bonded.
         # Create an atom-wise list of covalent radii.
@@ -2075,155 +2312,30 @@ class Molecule(object):
         R = np.array(
             [self.top_settings['radii'].get(i, (Radii[Elements.index(i) - 1] if i in Elements else 0.0)) for i in
              self.elem])
-        # Create a list of 2-tuples corresponding to combinations of atomic indices using a grid algorithm.
-        mins = np.min(self.xyzs[sn], axis=0)
-        maxs = np.max(self.xyzs[sn], axis=0)
-        # Grid size in Angstrom.  This number is optimized for speed in a 15,000 atom system (united atom pentadecane).
-        gsz = 6.0
-        if hasattr(self, 'boxes'):
-            xmin = 0.0
-            ymin = 0.0
-            zmin = 0.0
-            xmax = self.boxes[sn].a
-            ymax = self.boxes[sn].b
-            zmax = self.boxes[sn].c
-            if any([i != 90.0 for i in [self.boxes[sn].alpha, self.boxes[sn].beta, self.boxes[sn].gamma]]):
-                logger.warning("Warning: Topology building will not work with broken molecules in nonorthogonal cells.")
-                toppbc = False
-        else:
-            xmin = mins[0]
-            ymin = mins[1]
-            zmin = mins[2]
-            xmax = maxs[0]
-            ymax = maxs[1]
-            zmax = maxs[2]
-            toppbc = False
-
-        xext = xmax - xmin
-        yext = ymax - ymin
-        zext = zmax - zmin
-
-        if toppbc:
-            gszx = xext / int(xext / gsz)
-            gszy = yext / int(yext / gsz)
-            gszz = zext / int(zext / gsz)
-        else:
-            gszx = gsz
-            gszy = gsz
-            gszz = gsz
-
-        # Run algorithm to determine bonds.
-        # Decide if we want to use the grid algorithm.
-        use_grid = toppbc or (np.min([xext, yext, zext]) > 2.0 * gsz)
-        if use_grid:
-            # Inside the grid algorithm.
-            # 1) Determine the left edges of the grid cells.
-            # Note that we leave out the rightmost grid cell,
-            # because this may cause spurious partitionings.
-            xgrd = np.arange(xmin, xmax - gszx, gszx)
-            ygrd = np.arange(ymin, ymax - gszy, gszy)
-            zgrd = np.arange(zmin, zmax - gszz, gszz)
-            # 2) Grid cells are denoted by a three-index tuple.
-            gidx = list(itertools.product(list(range(len(xgrd))), list(range(len(ygrd))), list(range(len(zgrd)))))
-            # 3) Build a dictionary which maps a grid cell to itself plus its neighboring grid cells.
-            # Two grid cells are defined to be neighbors if the differences between their x, y, z indices are at most 1.
-            gngh = OrderedDict()
-            amax = np.array(gidx[-1])
-            amin = np.array(gidx[0])
-            n27 = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
-            for i in gidx:
-                gngh[i] = []
-                ai = np.array(i)
-                for j in n27:
-                    nj = ai + j
-                    for k in range(3):
-                        mod = amax[k] - amin[k] + 1
-                        if nj[k] < amin[k]:
-                            nj[k] += mod
-                        elif nj[k] > amax[k]:
-                            nj[k] -= mod
-                    gngh[i].append(tuple(nj))
-            # 4) Loop over the atoms and assign each to a grid cell.
-            # Note: I think this step becomes the bottleneck if we choose very small grid sizes.
-            gasn = OrderedDict([(i, []) for i in gidx])
-            for i in range(self.na):
-                xidx = -1
-                yidx = -1
-                zidx = -1
-                for j in xgrd:
-                    xi = self.xyzs[sn][i][0]
-                    while xi < xmin: xi += xext
-                    while xi > xmax: xi -= xext
-                    if xi < j: break
-                    xidx += 1
-                for j in ygrd:
-                    yi = self.xyzs[sn][i][1]
-                    while yi < ymin: yi += yext
-                    while yi > ymax: yi -= yext
-                    if yi < j: break
-                    yidx += 1
-                for j in zgrd:
-                    zi = self.xyzs[sn][i][2]
-                    while zi < zmin: zi += zext
-                    while zi > zmax: zi -= zext
-                    if zi < j: break
-                    zidx += 1
-                gasn[(xidx, yidx, zidx)].append(i)
-
-            # 5) Create list of 2-tuples corresponding to combinations of atomic indices.
-            # This is done by looping over pairs of neighboring grid cells and getting Cartesian products of atom indices inside.
-            # It may be possible to get a 2x speedup by eliminating forward-reverse pairs (e.g. (5, 4) and (4, 5) and duplicates (5,5).)
-            AtomIterator = []
-            for i in gasn:
-                for j in gngh[i]:
-                    apairs = cartesian_product2([gasn[i], gasn[j]])
-                    if len(apairs) > 0: AtomIterator.append(apairs[apairs[:, 0] > apairs[:, 1]])
-            AtomIterator = np.ascontiguousarray(np.vstack(AtomIterator))
-        else:
-            # Create a list of 2-tuples corresponding to combinations of atomic indices.
-            # This is much faster than using itertools.combinations.
-            AtomIterator = np.ascontiguousarray(np.vstack((np.fromiter(
-                itertools.chain(*[[i] * (self.na - i - 1) for i in range(self.na)]), dtype=np.int32), np.fromiter(
-                itertools.chain(*[list(range(i + 1, self.na)) for i in range(self.na)]), dtype=np.int32))).T)
-
-        # Create a list of thresholds for determining whether a certain interatomic distance is considered to be a bond.
-        BT0 = R[AtomIterator[:, 0]]
-        BT1 = R[AtomIterator[:, 1]]
-        BondThresh = (BT0 + BT1) * Fac
-        BondThresh = (BondThresh > mindist) * BondThresh + (BondThresh < mindist) * mindist
-        if hasattr(self, 'boxes') and toppbc:
-            dxij = AtomContact(self.xyzs[sn][np.newaxis, :], AtomIterator,
-                               box=np.array([[self.boxes[sn].a, self.boxes[sn].b, self.boxes[sn].c]]))[0]
-        else:
-            dxij = AtomContact(self.xyzs[sn][np.newaxis, :], AtomIterator)[0]
-
-        # Update topology settings with what we learned
-        self.top_settings['toppbc'] = toppbc
-
-        # Create a list of atoms that each atom is bonded to.
-        atom_bonds = [[] for i in range(self.na)]
-        bond_bool = dxij < BondThresh
-        for i, a in enumerate(bond_bool):
-            if not a: continue
-            (ii, jj) = AtomIterator[i]
-            if ii == jj: continue
-            atom_bonds[ii].append(jj)
-            atom_bonds[jj].append(ii)
-        bondlist = []
-        for i, bi in enumerate(atom_bonds):
-            for j in bi:
-                if i == j: continue
-                # Do not add a bond between resids if fragment is set to True.
-                if self.top_settings['fragment'] and 'resid' in list(self.Data.keys()) and self.resid[i] != self.resid[
-                    j]:
-                    continue
-                elif i < j:
-                    bondlist.append((i, j))
+        # Only pairs of atoms closer than the largest bond threshold are candidates
+        cutoff = max(mindist, 2 * np.max(R) * Fac) if len(R) > 0 else mindist
+        # Do not add a bond between resids if fragment is set to True.
+        fragment = self.top_settings['fragment'] and 'resid' in self.Data
+        if fragment:
+            resid = np.array(self.resid)
+        bonds = []
+        for sn in (range(len(self)) if frames is None else frames):
+            if toppbc:
+                b = self.boxes[sn]
+                if all([i == 90.0 for i in [b.alpha, b.beta, b.gamma]]):
+                    box = np.array([b.a, b.b, b.c])
                 else:
-                    bondlist.append((j, i))
-        bondlist = sorted(list(set(bondlist)))
-        self.Data['bonds'] = sorted(list(set(bondlist)))
-        self.built_bonds = True
+                    box = np.array([b.A, b.B, b.C])
+            else:
+                box = None
+            pairs = cell_list_pairs(self.xyzs[sn], cutoff, box)
+            if fragment:
+                pairs = pairs[resid[pairs[:, 0]] == resid[pairs[:, 1]]]
+            # Threshold for determining whether a certain interatomic distance is considered to be a bond.
+            BondThresh = np.maximum(mindist, (R[pairs[:, 0]] + R[pairs[:, 1]]) * Fac)
+            dxij = AtomContact(self.xyzs[sn][np.newaxis, :], pairs, box=None if box is None else box[np.newaxis])[0]
+            bonds.append([tuple(p) for p in pairs[dxij < BondThresh].tolist()])
+        return bonds
 
     def build_topology(self, force_bonds=True, **kwargs):
         """
@@ -2986,11 +3098,84 @@ class Molecule(object):
         return ret
 
     def read_xyz(self, fnm, **kwargs):
-        """ .xyz files can be TINKER formatted which is why we have the try/except here. """
+        """ .xyz files can be TINKER formatted which is why we have the try/except here.
+
+        If cache=True (or a floating point type such as 'float32') is passed, the parsed
+        file is saved to a binary cache next to it, and later loads of the unchanged file
+        map the cached coordinates into memory instead of parsing the text again.
+        """
+        cache = kwargs.get('cache', False)
+        if cache:
+            dtype = np.dtype(cache if isinstance(cache, str) else float)
+            Answer = self.read_xyz_cache(fnm, dtype)
+            if Answer is not None:
+                return Answer
         try:
-            return self.read_xyz0(fnm, **kwargs)
+            Answer = self.read_xyz0(fnm, **kwargs)
         except ActuallyArcError:
             return self.read_arc(fnm, **kwargs)
+        if cache and self.write_xyz_cache(fnm, Answer, dtype):
+            return self.read_xyz_cache(fnm, dtype)
+        return Answer
+
+    def read_xyz_cache(self, fnm, dtype=float):
+        """ Load the binary cache of a .xyz file written by write_xyz_cache.
+
+        The coordinates are memory-mapped in copy-on-write mode, so loading is nearly free,
+        the frames in xyzs are views into a single (frames, atoms, 3) array (see xyz_array),
+        and changes to the coordinates are not written back to the cache.
+
+        @param[in] fnm The input .xyz file name
+        @param[in] dtype Data type of the cached coordinates
+        @return Dictionary with elem, comms and xyzs like read_xyz0, or None if there is no
+        valid cache for the current size and modification time of the file
+        """
+        cdir = fnm + '.cache'
+        try:
+            with open(os.path.join(cdir, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        stat = os.stat(fnm)
+        if (meta.get('size'), meta.get('mtime')) != (stat.st_size, stat.st_mtime_ns) or meta.get('dtype') != np.dtype(dtype).str:
+            return None
+        xyzarr = np.load(os.path.join(cdir, 'xyzs.npy'), mmap_mode='c').view(np.ndarray)
+        return {'elem': meta['elem'], 'xyzs': list(xyzarr), 'comms': meta['comms']}
+
+    def write_xyz_cache(self, fnm, Answer, dtype=float):
+        """ Write the binary cache of a parsed .xyz file into the fnm.cache folder.
+
+        The cache consists of the coordinates in a contiguous .npy file and a meta.json file
+        with the elements, comments, and the size and modification time of the .xyz file.
+
+        @param[in] fnm The input .xyz file name
+        @param[in] Answer Dictionary returned by read_xyz0
+        @param[in] dtype Data type of the cached coordinates
+        @return Whether the cache was written
+        """
+        xyzs = Answer['xyzs']
+        if len(xyzs) == 0 or any([x.shape != xyzs[0].shape for x in xyzs]):
+            return False
+        cdir = fnm + '.cache'
+        stat = os.stat(fnm)
+        try:
+            if not os.path.exists(cdir):
+                os.makedirs(cdir)
+            # Write the frames one at a time to avoid a second copy of the trajectory in memory
+            xyzarr = np.lib.format.open_memmap(os.path.join(cdir, 'xyzs.npy'), mode='w+', dtype=dtype,
+                                               shape=(len(xyzs),) + xyzs[0].shape)
+            for i, xyz in enumerate(xyzs):
+                xyzarr[i] = xyz
+            xyzarr.flush()
+            del xyzarr
+            # The meta file is written last, so an interrupted write leaves no valid cache
+            with open(os.path.join(cdir, 'meta.json'), 'w') as f:
+                json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'dtype': np.dtype(dtype).str,
+                           'elem': Answer['elem'], 'comms': Answer['comms']}, f)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to write xyz cache for %s: %s\n" % (fnm, e))
+            return False
+        return True
 
     def read_xyz0(self, fnm, **kwargs):
         """ Parse a .xyz file which contains several xyz coordinates, and return their elements.
@@ -4250,13 +4435,16 @@ class Molecule(object):
     def write_xyz(self, **kwargs):
         selection = kwargs.get('selection', list(range(len(self))))
         self.require('elem', 'xyzs')
+        # The element names are the same in every frame, so they are baked into a single
+        # format string and each frame is formatted with one call (same output as format_xyz_coord).
+        # Each frame is returned as three entries: atom count, comment and a multi-line block of coordinates.
+        fmt = '\n'.join(["%-5s" % e.replace('%', '%%') + " % 15.10f % 15.10f % 15.10f" for e in self.elem])
         out = []
         for I in selection:
-            xyz = self.xyzs[I]
             out.append("%-5i" % self.na)
             out.append(self.comms[I])
-            for i in range(self.na):
-                out.append(format_xyz_coord(self.elem[i], xyz[i]))
+            if self.na > 0:
+                out.append(fmt % tuple(np.asarray(self.xyzs[I], dtype=float).ravel().tolist()))
         return out
 
     def get_reaxff_atom_types(self):
@@ -4720,6 +4908,111 @@ class Molecule(object):
                 self.boxes = [mybox for i in range(self.ns)]
 
 
+def select_bonds(bonds, atomslice):
+    """ Renumber the bonds within a selection of atoms, dropping the bonds to atoms outside of it. """
+    # The first occurrence of an atom in the selection determines its new index
+    Map = dict([(a, i) for i, a in reversed(list(enumerate(atomslice)))])
+    return [(Map[b[0]], Map[b[1]]) for b in bonds if (b[0] in Map and b[1] in Map)]
+
+
+class MoleculeView(object):
+    """
+    Lazy selection of frames and atoms of a Molecule, as returned by Molecule.view().
+
+    The view only stores the parent Molecule and the indices of the selected frames and atoms.
+    Slicing the view, selecting atoms from it and extracting its coordinates with xyz_array()
+    only touch the selected data. Any other attribute access or assignment (for example setting
+    comms, or calling align() or write()) first materializes the view into an independent
+    Molecule containing copies of the selected frames and atoms, which is used from then on.
+    The topology is not built for the materialized Molecule.
+    """
+
+    def __init__(self, parent, frames=None, atoms=None):
+        if frames is None:
+            frames = np.arange(len(parent))
+        elif isinstance(frames, (int, np.integer)):
+            frames = np.arange(len(parent))[[frames]]
+        else:
+            frames = np.arange(len(parent))[frames if isinstance(frames, slice) else np.asarray(frames)]
+        if atoms is not None:
+            atoms = np.atleast_1d(np.asarray(atoms))
+        object.__setattr__(self, '_parent', parent)
+        object.__setattr__(self, '_frames', frames)
+        object.__setattr__(self, '_atoms', atoms)
+        object.__setattr__(self, '_mol', None)
+
+    def __len__(self):
+        if self._mol is not None:
+            return len(self._mol)
+        return len(self._frames)
+
+    def __getitem__(self, key):
+        """ Select frames from the view, returning another view. """
+        if self._mol is not None:
+            return self._mol[key]
+        if isinstance(key, (int, np.integer)):
+            key = [key]
+        return MoleculeView(self._parent, self._frames[key], self._atoms)
+
+    def atom_select(self, atomslice):
+        """ Select atoms from the view, returning another view. """
+        if self._mol is not None:
+            return self._mol.atom_select(atomslice)
+        atomslice = np.atleast_1d(np.asarray(atomslice))
+        return MoleculeView(self._parent, self._frames, atomslice if self._atoms is None else self._atoms[atomslice])
+
+    def xyz_array(self):
+        """ Return the selected coordinates as a single (frames, atoms, 3) array. """
+        if self._mol is not None:
+            return self._mol.xyz_array()
+        xyzs = self._parent.xyzs
+        if self._atoms is None:
+            return np.array([xyzs[i] for i in self._frames])
+        return np.array([xyzs[i][self._atoms] for i in self._frames])
+
+    def materialize(self):
+        """ Return the Molecule containing copies of the selected frames and atoms, creating it if needed. """
+        if self._mol is not None:
+            return self._mol
+        parent, frames, atoms = self._parent, self._frames, self._atoms
+        if atoms is not None and 'tinkersuf' in parent.Data:
+            # Tinker suffixes need to be renumbered
+            New = parent[frames].atom_select(atoms, build_topology=False)
+        else:
+            New = Molecule()
+            for key in parent.FrameKeys:
+                if atoms is not None and key in AtomFrameVariableNames:
+                    New.Data[key] = [parent.Data[key][i][atoms] for i in frames]
+                else:
+                    New.Data[key] = [copy.deepcopy(parent.Data[key][i]) for i in frames]
+            for key in parent.AtomKeys:
+                if atoms is None:
+                    New.Data[key] = copy.deepcopy(parent.Data[key])
+                else:
+                    New.Data[key] = list(np.array(parent.Data[key])[atoms])
+            for key in parent.MetaKeys:
+                if atoms is None:
+                    New.Data[key] = copy.deepcopy(parent.Data[key])
+                elif key == 'bonds':
+                    New.Data[key] = select_bonds(parent.bonds, atoms)
+                elif key not in ['topology', 'molecules']:
+                    New.Data[key] = copy.deepcopy(parent.Data[key])
+            New.top_settings = copy.deepcopy(parent.top_settings)
+        object.__setattr__(self, '_mol', New)
+        return New
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return getattr(self.materialize(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self.materialize(), key, value)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.materialize(), memo)
+
+
 def main():
     logger.info("Basic usage as an executable: molecule.py input.format1 output.format2")
     logger.info("where format stands for xyz, pdb, gro, etc.")
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
 # from . import contact
+import hashlib
+import heapq
 import itertools
+import json
+import multiprocessing
 import os
 import re
+import struct
 import time
-from collections import Counter, OrderedDict, defaultdict, namedtuple
+from collections import Counter, OrderedDict
 from copy import deepcopy
 
 import matplotlib.pyplot as plt
@@ -13,10 +18,15 @@ import networkx as nx
 import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 from pkg_resources import parse_version
-from scipy.signal import butter, freqz
+from scipy.fft import dct, idct
+from scipy.signal import butter, freqz, sosfiltfilt
+from scipy.spatial import cKDTree
 
 from .chemistry import Elements, Radii
-from .molecule import AtomContact, BuildLatticeFromLengthsAngles, Molecule, format_xyz_coord
+from .contact import minimum_image
+from .molecule import (AtomContact, BuildLatticeFromLengthsAngles, BuildLatticeFromVectors, HashedGraph,
+                       IsomerRegistry, Molecule, format_xyz_coord)
+from .profiling import StageProfiler
 
 plt.switch_backend('agg')
 
@@ -186,21 +196,136 @@ def exists_at_time(e, t):
     return x
 
 
+def bond_tcl(b):
+    # Print out the bonded partners of a single atom in a format that VMD can understand.
+    if len(b) == 0:
+        return "{}"
+    elif len(b) == 1:
+        return "%i" % b[0]
+    elif len(b) > 12:
+        return "{%s}" % ' '.join(["%i" % j for j in b[:12]])
+    else:
+        return "{%s}" % ' '.join(["%i" % j for j in b])
+
+
 def bondlist_tcl(bondlist):
     # Print out the list of bonds in a format that VMD can understand.
-    Answer = ""
-    for i, b in enumerate(bondlist):
-        if i > 0:
-            Answer += " "
-        if len(b) == 0:
-            Answer += "{}"
-        elif len(b) == 1:
-            Answer += "%i" % b[0]
-        elif len(b) > 12:
-            Answer += "{%s}" % ' '.join(["%i" % j for j in b[:12]])
-        else:
-            Answer += "{%s}" % ' '.join(["%i" % j for j in b])
-    return Answer
+    return ' '.join([bond_tcl(b) for b in bondlist])
+
+
+def frame_records(lines):
+    """
+    Compress a per-frame list of lines into (frame, line) records
+    for the frames where the line differs from the previous frame.
+
+    Parameters
+    ----------
+    lines : list
+        One string per frame
+
+    Returns
+    -------
+    list
+        (first frame, line) tuples; each line applies until the next record
+    """
+    records = []
+    for frame, line in enumerate(lines):
+        if not records or line != records[-1][1]:
+            records.append((frame, line))
+    return records
+
+
+def write_frame_records(fnm, records, nframes, append=False):
+    """
+    Write (frame, line) records as a text file with one line per frame
+    (the color.dat / bonds.dat / charge.dat / spin.dat format read by bin/reactions.vmd).
+    The lines start from the frame of the first record.
+
+    Parameters
+    ----------
+    fnm : str
+        Output file name
+    records : list
+        (first frame, line) tuples in increasing frame order, as from frame_records()
+    nframes : int
+        Total number of frames; the last record is repeated up to this frame
+    append : bool
+        Append the lines to an existing file
+    """
+    with open(fnm, 'a' if append else 'w') as f:
+        for irec, (frame, line) in enumerate(records):
+            nextFrame = records[irec + 1][0] if irec + 1 < len(records) else nframes
+            f.write((line + '\n') * (nextFrame - frame))
+
+
+def write_runlength(fnm, records, na, append=False):
+    """
+    Write (frame, line) records to a compact run-length encoded binary file,
+    which is read by bin/reactions.vmd in place of the corresponding .dat file.
+
+    The file has a 12-byte header containing the characters NRRL, the format version and
+    the number of atoms, followed by one record for each frame where the line changes.
+    Each record is the frame number and the length of the line in bytes (little-endian
+    32-bit integers) followed by the line itself, which applies until the next record.
+    Since the file has no frame count, records may be appended to an existing file.
+
+    Parameters
+    ----------
+    fnm : str
+        Output file name
+    records : list
+        (first frame, line) tuples in increasing frame order, as from frame_records()
+    na : int
+        Number of atoms, stored in the header for checking by the reader
+    append : bool
+        Append the records to an existing file (the header is only written if the file is new)
+    """
+    with open(fnm, 'ab' if append else 'wb') as f:
+        if f.tell() == 0:
+            f.write(b'NRRL' + struct.pack('<ii', 1, na))
+        for frame, line in records:
+            data = line.encode('ascii')
+            f.write(struct.pack('<ii', frame, len(data)) + data)
+
+
+def read_runlength(fnm, nframes=None):
+    """
+    Read a run-length encoded binary file written by write_runlength().
+
+    Parameters
+    ----------
+    fnm : str
+        Input file name
+    nframes : int, optional
+        If provided, expand the records to a list containing one line for each frame
+
+    Returns
+    -------
+    na : int
+        Number of atoms stored in the header
+    records : list
+        (first frame, line) tuples, or a list of nframes lines if nframes is provided
+    """
+    with open(fnm, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'NRRL':
+        raise RuntimeError('%s is not a run-length encoded data file' % fnm)
+    version, na = struct.unpack_from('<ii', data, 4)
+    if version != 1:
+        raise RuntimeError('%s has unsupported format version %i' % (fnm, version))
+    records = []
+    pos = 12
+    while pos < len(data):
+        frame, nbytes = struct.unpack_from('<ii', data, pos)
+        records.append((frame, data[pos + 8:pos + 8 + nbytes].decode('ascii')))
+        pos += 8 + nbytes
+    if nframes is not None:
+        lines = []
+        for irec, (frame, line) in enumerate(records):
+            nextFrame = records[irec + 1][0] if irec + 1 < len(records) else nframes
+            lines += [line] * (nextFrame - frame)
+        return na, lines
+    return na, records
 
 
 def make_monotonic(xyz, others=[]):
@@ -227,7 +352,7 @@ def make_monotonic(xyz, others=[]):
     return new_others
 
 
-class MyG(nx.Graph):
+class MyG(HashedGraph):
     def __init__(self):
         super(MyG, self).__init__()
 
@@ -237,8 +362,8 @@ class MyG(nx.Graph):
 
     def __hash__(self):
         """ The hash function is something we can use to discard two things that are obviously not equal.
-        Here we neglect the hash. """
-        return 1
+        Here we use the Weisfeiler-Lehman hash of the element-labelled graph, computed once per graph. """
+        return int(self.wl_hash()[:15], 16)
 
     def L(self):
         """ Return a list of the sorted atom numbers in this graph. """
@@ -402,73 +527,778 @@ def low_pass_smoothing(all_raw_time_series, sigma, dt_fs, reflect=True):
     return abs(filtered), freqx, ft_original, ft_filtered
 
 
-def load_bondorder(boin, thre, traj_length):
+def lowpass_response(b, a, nfreq):
+    """
+    Magnitude response of a digital filter at the non-negative frequencies of a length-nfreq FFT.
+
+    The response is symmetrized over positive and negative frequencies, which only differ
+    by roundoff error in the evaluation of the filter polynomials.
+
+    Parameters
+    ----------
+    b, a : np.ndarray
+        Numerator and denominator polynomials of the filter
+    nfreq : int
+        Length of the FFT
+
+    Returns
+    -------
+    np.ndarray
+        Magnitude response at frequencies 2*pi*k/nfreq for k = 0 .. nfreq//2
+    """
+    w, h = freqz(b, a, worN=nfreq, whole=True)
+    mag = abs(h)
+    return 0.5 * (mag + np.roll(mag[::-1], 1))[:nfreq // 2 + 1]
+
+
+def lowpass_filter(series, sigma, dt_fs, out=None, method='fft'):
+    """
+    Zero-phase low-pass filter for a block of bond order or interatomic distance time series.
+    Unlike low_pass_smoothing(), no spectra are kept and the result may be written in place
+    into a preallocated (e.g. single precision) array.
+
+    Parameters
+    ----------
+    series : np.ndarray
+        2-D array consisting of time series to be filtered. First dimension is the number
+        of time series to be filtered at once; second dimension is the length of each series
+    sigma : float
+        Filter roll-off frequency expressed in wavenumbers; pass zero to skip filtering
+    dt_fs : float
+        Time step of time series expressed in femtoseconds.
+    out : np.ndarray, optional
+        Array in the same shape as series to be filled with the filtered signal
+    method : str
+        'fft' : Multiply the spectrum of the time series and its reflection by the magnitude response
+                of a 6th order Butterworth filter; this is the same filter as low_pass_smoothing().
+        'overlap-save' : Convolve with the impulse response of the same filter, truncated to eight periods
+                of the cutoff frequency, using FFTs of bounded length. Suitable for very long time series.
+        'sosfiltfilt' : Apply a 3rd order Butterworth filter forward and backward (the attenuation is
+                6th order, but the response at the cutoff frequency is -6 dB instead of -3 dB).
+
+    Returns
+    -------
+    out : np.ndarray
+        Signal after lowpass filter has been applied, in the same shape as series
+    """
+    series = np.asarray(series, dtype=float)
+    traj_length = series.shape[1]
+    if out is None:
+        out = np.empty(series.shape)
+    if sigma <= 0.0 or traj_length < 2:
+        np.abs(series, out=out)
+        return out
+    # Cutoff frequency in units of the Nyquist frequency (see low_pass_smoothing)
+    low_cutoff = float(sigma) / (33355.0 / dt_fs) * 2.0
+    if method == 'fft':
+        b, a = butter(6, low_cutoff, btype='low')
+        # The time series attached end-to-end with its reflection (without the endpoints) is symmetric,
+        # and its Fourier transform is the type-I discrete cosine transform of the original series.
+        ft = dct(series, type=1, axis=1)
+        ft *= lowpass_response(b, a, 2 * traj_length - 2)
+        np.abs(idct(ft, type=1, axis=1, overwrite_x=True), out=out)
+    elif method == 'overlap-save':
+        b, a = butter(6, low_cutoff, btype='low')
+        # Half-width of the impulse response
+        nhalf = int(np.ceil(8 * 33355.0 / (sigma * dt_fs)))
+        if nhalf >= traj_length - 1:
+            return lowpass_filter(series, sigma, dt_fs, out=out, method='fft')
+        nresp = 2 ** int(np.ceil(np.log2(8 * nhalf)))
+        resp = np.fft.irfft(lowpass_response(b, a, nresp), nresp)
+        kernel = np.concatenate((resp[-nhalf:], resp[:nhalf + 1]))
+        nfft = 2 ** int(np.ceil(np.log2(4 * len(kernel))))
+        step = nfft - 2 * nhalf
+        ft_kernel = np.fft.rfft(kernel, nfft)
+        # Reflect the ends of the time series (without the endpoints) as in the 'fft' method
+        padded = np.pad(series, ((0, 0), (nhalf, nhalf)), mode='reflect')
+        for start in range(0, traj_length, step):
+            seg = np.fft.irfft(np.fft.rfft(padded[:, start:start + nfft], nfft, axis=1) * ft_kernel, nfft, axis=1)
+            nkeep = min(step, traj_length - start)
+            np.abs(seg[:, 2 * nhalf:2 * nhalf + nkeep], out=out[:, start:start + nkeep])
+    elif method == 'sosfiltfilt':
+        sos = butter(3, low_cutoff, btype='low', output='sos')
+        # sosfiltfilt needs more frames than its default padding length
+        if traj_length <= 3 * (2 * len(sos) + 1):
+            return lowpass_filter(series, sigma, dt_fs, out=out, method='fft')
+        np.abs(sosfiltfilt(sos, series, axis=1, padtype='even'), out=out)
+    else:
+        raise RuntimeError('Low-pass filter method %s not recognized' % method)
+    return out
+
+
+class SparseSeries(object):
+    """
+    Compact frame x pair sparse matrix of pairwise time series (e.g. bond orders).
+
+    The atom pairs are stored once in a sorted pair index table, and the nonzero
+    values are stored in compressed sparse row (CSR) layout where each row is a frame.
+    Dense time series are only created on request, either for a single pair or for
+    a contiguous block of pairs, so the memory footprint scales with the number of
+    nonzero entries rather than (number of pairs) * (trajectory length).
+
+    Single pairs may be looked up like the OrderedDict returned by earlier versions
+    of load_bondorder, i.e. SparseSeries[(a1, a2)] returns a dense time series.
+
+    Parameters
+    ----------
+    pairs : np.ndarray
+        Array of shape (n_pairs, 2) of zero-indexed atom pairs, sorted, with a2 > a1
+    indptr : np.ndarray
+        Array of length traj_length + 1; the entries for frame i are in indptr[i]:indptr[i+1]
+    indices : np.ndarray
+        Pair index (row of pairs) of each nonzero entry
+    data : np.ndarray
+        Value of each nonzero entry
+    """
+
+    def __init__(self, pairs, indptr, indices, data):
+        self.pairs = pairs
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.traj_length = len(indptr) - 1
+        self._lookup = None
+        self._colptr = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __contains__(self, key):
+        return tuple(key) in self.lookup()
+
+    def __getitem__(self, key):
+        return self.dense(self.lookup()[tuple(key)])[0]
+
+    def lookup(self):
+        """ Return a dictionary that maps atom pairs (a1, a2) to their pair indices. """
+        if self._lookup is None:
+            self._lookup = dict([(tuple(k), i) for i, k in enumerate(self.pairs.tolist())])
+        return self._lookup
+
+    def keys(self):
+        return [tuple(k) for k in self.pairs.tolist()]
+
+    def values(self):
+        for i in range(len(self)):
+            yield self.dense(i)[0]
+
+    def items(self):
+        for i, k in enumerate(self.keys()):
+            yield k, self.dense(i)[0]
+
+    def frames(self):
+        """ Return the frame number of each nonzero entry. """
+        return np.repeat(np.arange(self.traj_length, dtype=np.int32), np.diff(self.indptr))
+
+    def _pair_major(self):
+        """
+        Lazily build the permutation that sorts the nonzero entries by pair
+        (i.e. the compressed sparse column layout), used to extract dense blocks of pairs.
+        """
+        if self._colptr is None:
+            # A stable sort keeps the entries of each pair in frame order
+            self._order = np.argsort(self.indices, kind='stable')
+            self._colptr = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=len(self)), out=self._colptr[1:])
+            self._rows = self.frames()[self._order]
+        return self._order, self._colptr, self._rows
+
+    def dense(self, start, end=None, out=None):
+        """
+        Return the dense time series for the pairs start:end.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first pair
+        end : int, optional
+            One past the index of the last pair; defaults to start + 1
+        out : np.ndarray, optional
+            Array of shape (end - start, traj_length) to be filled in place
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (end - start, traj_length)
+        """
+        if end is None:
+            end = start + 1
+        if out is None:
+            out = np.zeros((end - start, self.traj_length), dtype=self.data.dtype)
+        else:
+            out[:] = 0.0
+        order, colptr, rows = self._pair_major()
+        sel = order[colptr[start]:colptr[end]]
+        out[self.indices[sel] - start, rows[colptr[start]:colptr[end]]] = self.data[sel]
+        return out
+
+    def max(self):
+        """ Return the maximum value of each time series (including the implicit zeros). """
+        pmax = np.zeros(len(self), dtype=self.data.dtype)
+        np.maximum.at(pmax, self.indices, self.data)
+        return pmax
+
+    def select(self, keep):
+        """
+        Return a new SparseSeries containing only the pairs where keep is True.
+
+        Parameters
+        ----------
+        keep : np.ndarray
+            Boolean array of length n_pairs
+        """
+        newidx = np.cumsum(keep) - 1
+        entries = keep[self.indices]
+        indptr = np.zeros_like(self.indptr)
+        np.cumsum(np.bincount(self.frames()[entries], minlength=self.traj_length), out=indptr[1:])
+        return SparseSeries(self.pairs[keep], indptr, newidx[self.indices[entries]].astype(self.indices.dtype),
+                            self.data[entries])
+
+
+class GlobalGraphs(object):
+    """
+    Distinct global graphs (the bonded atom pairs of the whole system), stored compactly.
+
+    Each graph is a bitset over a table of atom pairs packed with np.packbits, with the
+    trailing zero bytes removed so that graphs stored before the table grew compare equal
+    to the same graphs stored afterwards.  The storage is one bit per pair per graph, and
+    the list of bonded pairs of a graph is only created when the graph is accessed,
+    i.e. GlobalGraphs[i] returns a list of (a1, a2) tuples like the lists used before.
+
+    Parameters
+    ----------
+    pairs : np.ndarray
+        Array of shape (n_pairs, 2) of zero-indexed atom pairs that the bits refer to
+    bits : list
+        Packed bitset (bytes) of each graph
+    """
+
+    def __init__(self, pairs=None, bits=[]):
+        self.pairs = np.zeros((0, 2), dtype=np.int64) if pairs is None else np.asarray(pairs, dtype=np.int64)
+        self.pairs = self.pairs.reshape(-1, 2)
+        self.bits = []
+        self.index = {}
+        self._lookup = None
+        for b in bits:
+            self.add_bits(b)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, idx):
+        return [tuple(p) for p in self.pairs[self.bonded(idx)].tolist()]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def bonded(self, idx):
+        """ Return a boolean array marking the pairs that are bonded in a graph. """
+        bits = np.unpackbits(np.frombuffer(self.bits[idx], dtype=np.uint8)).astype(bool)
+        n = min(len(bits), len(self.pairs))
+        bonded = np.zeros(len(self.pairs), dtype=bool)
+        bonded[:n] = bits[:n]
+        return bonded
+
+    def add_bits(self, bits):
+        """ Return the index of the graph with the given packed bitset, storing it if it is new. """
+        bits = bytes(bits).rstrip(b'\x00')
+        idx = self.index.get(bits)
+        if idx is None:
+            idx = len(self.bits)
+            self.bits.append(bits)
+            self.index[bits] = idx
+        return idx
+
+    def add(self, bonded):
+        """ Return the index of the graph given by a boolean array over the pairs, storing it if it is new. """
+        return self.add_bits(np.packbits(bonded).tobytes())
+
+    def pair_indices(self, pairs):
+        """ Return the indices of atom pairs in the pair table, adding the pairs that are not in it. """
+        if self._lookup is None:
+            self._lookup = dict([(tuple(p), i) for i, p in enumerate(self.pairs.tolist())])
+        new = []
+        indices = []
+        for p in map(tuple, np.asarray(pairs).reshape(-1, 2).tolist()):
+            if p not in self._lookup:
+                self._lookup[p] = len(self.pairs) + len(new)
+                new.append(p)
+            indices.append(self._lookup[p])
+        if new:
+            self.pairs = np.concatenate((self.pairs, np.array(new, dtype=np.int64)))
+        return np.array(indices, dtype=np.int64)
+
+
+def read_bondorder_blocks(boin, blocksize=2 ** 26):
+    """
+    Read a bond_order.list file in blocks of lines with bounded memory usage.
+
+    Each frame in the file consists of a line with the number of entries, a comment
+    line, and one line per entry containing the two atom indices and the bond order.
+    The frame headers are walked in Python, but the entries are parsed in bulk for
+    each block. Frames that straddle a block boundary are carried over to the next block.
+
+    Parameters
+    ----------
+    boin : str
+        Name of the bond_order.list file
+    blocksize : int
+        Approximate number of bytes to read at once
+
+    Yields
+    ------
+    frames : np.ndarray
+        Frame number of each entry in the block
+    entries : np.ndarray
+        Array of shape (n_entries, 3) containing atom 1, atom 2, bond order
+    """
+    frame = 0
+    carry = []
+    with open(boin) as f:
+        while True:
+            lines = f.readlines(blocksize)
+            eof = len(lines) == 0
+            lines = carry + lines
+            pos = 0
+            counts = []
+            chunks = []
+            while pos < len(lines):
+                if not lines[pos].strip():
+                    pos += 1
+                    continue
+                nbo = int(lines[pos])
+                if pos + nbo + 2 > len(lines):
+                    break
+                counts.append(nbo)
+                chunks.append(''.join(lines[pos + 2:pos + nbo + 2]))
+                pos += nbo + 2
+            carry = lines[pos:]
+            if counts:
+                entries = np.array(''.join(chunks).split(), dtype=float).reshape(-1, 3)
+                yield np.repeat(np.arange(frame, frame + len(counts)), counts), entries
+                frame += len(counts)
+            if eof:
+                if any([l.strip() for l in carry]):
+                    raise RuntimeError('%s ends with an incomplete frame' % boin)
+                break
+
+
+def pack_global_graphs(global_graphs, gg_frames, BondLists, gg_diffs):
+    """
+    Pack the output of Nanoreactor.makeGlobalGraphs into a dictionary of arrays for saving to a checkpoint.
+    The bond lists are only stored for the frames where the global graph changes.
+    """
+    def flat_pairs(pair_lists):
+        pairs = np.array(list(itertools.chain(*pair_lists)), dtype=np.int64).reshape(-1, 2)
+        return pairs, np.array([len(p) for p in pair_lists], dtype=np.int64)
+
+    gg_bits = np.frombuffer(b''.join(global_graphs.bits), dtype=np.uint8)
+    gg_nbytes = np.array([len(b) for b in global_graphs.bits], dtype=np.int64)
+    added, added_counts = flat_pairs([d[0] for d in gg_diffs])
+    removed, removed_counts = flat_pairs([d[1] for d in gg_diffs])
+    starts = list(gg_frames.keys())
+    bondtext = '\n'.join([BondLists[f] for f in starts]).encode('ascii')
+    return dict(gg_pairs=global_graphs.pairs, gg_bits=gg_bits, gg_nbytes=gg_nbytes, gg_start=np.array(starts, dtype=np.int64),
+                gg_index=np.array([v[0] for v in gg_frames.values()], dtype=np.int64),
+                gg_next=np.array([v[1] for v in gg_frames.values()], dtype=np.int64),
+                bondtext=np.frombuffer(bondtext, dtype=np.uint8), added=added, added_counts=added_counts,
+                removed=removed, removed_counts=removed_counts)
+
+
+def unpack_global_graphs(data, traj_length):
+    """
+    Rebuild the output of Nanoreactor.makeGlobalGraphs from a dictionary of arrays made by pack_global_graphs.
+    """
+    def split_pairs(pairs, counts, convert):
+        if len(counts) == 0:
+            return []
+        return [[convert(p) for p in block] for block in np.split(pairs, np.cumsum(counts)[:-1])]
+
+    offsets = np.concatenate(([0], np.cumsum(data['gg_nbytes']))).tolist()
+    gg_bits = data['gg_bits'].tobytes()
+    global_graphs = GlobalGraphs(data['gg_pairs'], [gg_bits[a:b] for a, b in zip(offsets[:-1], offsets[1:])])
+    int_pair = lambda p: tuple(p.tolist())
+    gg_diffs = list(zip(split_pairs(data['added'], data['added_counts'], int_pair),
+                        split_pairs(data['removed'], data['removed_counts'], int_pair)))
+    starts = data['gg_start'].tolist()
+    gg_frames = OrderedDict(zip(starts, zip(data['gg_index'].tolist(), data['gg_next'].tolist())))
+    bondTcls = data['bondtext'].tobytes().decode('ascii').split('\n') if len(starts) > 0 else []
+    BondLists = []
+    for start, nextFrame, bondTcl in zip(starts, data['gg_next'].tolist(), bondTcls):
+        BondLists += [bondTcl] * (nextFrame - start)
+    return global_graphs, gg_frames, BondLists, gg_diffs
+
+
+def file_signature(fnm):
+    """
+    Return the full path, size and modification time of a file, which identify
+    the input files in the keys of analysis checkpoints (see Nanoreactor.checkpointKey).
+    Returns None if fnm is not a file name, e.g. data that is already in memory.
+    """
+    if not isinstance(fnm, str) or not os.path.exists(fnm):
+        return None
+    stat = os.stat(fnm)
+    return [os.path.realpath(fnm), stat.st_size, stat.st_mtime_ns]
+
+
+def load_bondorder(boin, thre, traj_length, blocksize=2 ** 26, dtype=float):
     """
     Load a bondorder.list file.
 
     This file format only lists bond orders above a threshold (typically 0.1)
     in each frame. Thus, the returned data takes the form of a sparse array.
+    The file is streamed in blocks and the nonzero entries are kept in compact arrays,
+    so peak memory scales with the number of entries rather than with the number of
+    atom pairs times the trajectory length.
 
     Parameters
     ----------
     boin : str
         Name of the bond_order.list file
     thre : float
-        Floating
+        Only keep atom pairs whose bond order exceeds this value in at least one frame
+    traj_length : int
+        Length of the trajectory
+    blocksize : int
+        Approximate number of bytes to read from the file at once
+    dtype : type
+        Data type for storing bond orders; pass np.float32 to halve the memory usage
+
+    Returns
+    -------
+    SparseSeries
+        Frame x pair sparse matrix of bond orders, where the pairs are zero-indexed
+        atom pairs (a1, a2) with a2 > a1 in sorted order
+    """
+    frames = []
+    keys = []
+    values = []
+    for blk_frames, entries in read_bondorder_blocks(boin, blocksize):
+        nodiag, blk_keys = bondorder_keys(entries)
+        keys.append(blk_keys)
+        frames.append(blk_frames[nodiag].astype(np.int32))
+        values.append(entries[nodiag, 2].astype(dtype))
+    frames = np.concatenate(frames) if frames else np.zeros(0, dtype=np.int32)
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.zeros(0, dtype=dtype)
+    if len(frames) > 0 and frames[-1] >= traj_length:
+        raise RuntimeError('%s contains more frames than the trajectory (%i)' % (boin, traj_length))
+    boSparse = bondorder_series(frames, keys, values, traj_length)
+    return boSparse.select(boSparse.max() > thre)
+
+
+def bondorder_keys(entries):
+    """
+    Encode the atom pairs of bond order entries into integer keys.
+
+    Parameters
+    ----------
+    entries : np.ndarray
+        Array of shape (n_entries, 3) containing atom 1, atom 2, bond order
+
+    Returns
+    -------
+    nodiag : np.ndarray
+        Boolean mask of entries between two different atoms
+    keys : np.ndarray
+        Keys (a1<<32)|a2 with a1 < a2 for the entries selected by nodiag
+    """
+    a1 = entries[:, 0].astype(np.int64)
+    a2 = entries[:, 1].astype(np.int64)
+    nodiag = a1 != a2
+    return nodiag, ((np.minimum(a1, a2) << 32) | np.maximum(a1, a2))[nodiag]
+
+
+def bondorder_series(frames, keys, values, traj_length):
+    """
+    Build a sparse bond order time series from a list of entries.
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        Frame number of each entry, in non-decreasing order
+    keys : np.ndarray
+        Atom pair of each entry, encoded by bondorder_keys()
+    values : np.ndarray
+        Bond order of each entry
     traj_length : int
         Length of the trajectory
 
     Returns
     -------
-    OrderedDict
-        Dictionary that maps zero-indexed atom pairs (a1, a2) to numpy array
-        containing the bond order between a1, a2 for each frame.
-        Keys only include a2 > a1
+    SparseSeries
+        Frame x pair sparse matrix of bond orders for all pairs that appear in the entries
+    """
+    ukeys, pidx = np.unique(keys, return_inverse=True)
+    pidx = pidx.reshape(-1).astype(np.int32)
+    # If a pair is listed more than once in the same frame, keep the last value
+    entry = frames.astype(np.int64) * len(ukeys) + pidx
+    if len(entry) > 1 and (np.diff(entry) <= 0).any():
+        last = len(entry) - 1 - np.unique(entry[::-1], return_index=True)[1]
+        frames, pidx, values = frames[last], pidx[last], values[last]
+    indptr = np.zeros(traj_length + 1, dtype=np.int64)
+    np.cumsum(np.bincount(frames, minlength=traj_length), out=indptr[1:])
+    pairs = np.array([ukeys >> 32, ukeys & 0xffffffff], dtype=int).T.reshape(-1, 2)
+    return SparseSeries(pairs, indptr, pidx, values)
+
+
+def make_box(pbc):
+    """
+    Build a periodic box from the box dimensions given by the user.
+
+    Parameters
+    ----------
+    pbc : float or list
+        Cubic box length, three rectilinear box lengths, three box lengths and three angles (in degrees),
+        or the nine components of the box vectors A, B, C, all in Angstrom; zero for no periodic box
+
+    Returns
+    -------
+    Box or None
+        Box named tuple, or None if there is no periodic box
+    """
+    p = np.array(pbc, dtype=float).flatten()
+    if len(p) == 1:
+        if p[0] <= 0.0:
+            return None
+        p = np.repeat(p, 3)
+    if len(p) == 3:
+        return BuildLatticeFromLengthsAngles(p[0], p[1], p[2], 90.0, 90.0, 90.0)
+    elif len(p) == 6:
+        return BuildLatticeFromLengthsAngles(*p)
+    elif len(p) == 9:
+        # Keep the box vectors as given, since the coordinates are expressed in their frame
+        v = p.reshape(3, 3)
+        return BuildLatticeFromVectors(*v)._replace(A=v[0], B=v[1], C=v[2])
+    raise RuntimeError('Periodic box must be given by 1, 3, 6 or 9 numbers, got %i' % len(p))
+
+
+def lattice_from_comment(comm):
+    """
+    Read the periodic box from an extended XYZ comment line, such as:
+    Lattice="20.0 0.0 0.0 0.0 20.0 0.0 0.0 0.0 20.0" Properties=species:S:1:pos:R:3 pbc="T T T"
+
+    Parameters
+    ----------
+    comm : str
+        Comment line of one frame
+
+    Returns
+    -------
+    Box or None
+        Box named tuple, or None if the comment has no lattice or says the system is not periodic
+    """
+    lattice = re.search(r'Lattice="([^"]*)"', comm)
+    if lattice is None:
+        return None
+    periodic = re.search(r'pbc="([^"]*)"', comm)
+    if periodic is not None and not any([p in ('T', 'True', '1') for p in periodic.group(1).split()]):
+        return None
+    return make_box(lattice.group(1).split())
+
+
+def box_array(boxes):
+    """
+    Convert a list of boxes into the array form used by AtomContact and contact.minimum_image.
+
+    Parameters
+    ----------
+    boxes : list
+        Box named tuples, one per frame
+
+    Returns
+    -------
+    np.ndarray
+        N_frames*3 (2D) array of box lengths if all boxes are rectilinear,
+        otherwise N_frames*3*3 (3D) array of box vectors
+    """
+    vectors = np.array([[b.A, b.B, b.C] for b in boxes], dtype=float)
+    lengths = np.array([[b.a, b.b, b.c] for b in boxes], dtype=float)
+    offdiag = vectors * (1 - np.eye(3))
+    if np.all(np.abs(offdiag) <= 1e-8 * np.max(lengths)):
+        return lengths
+    return vectors
+
+
+def lattice_translations(dxyz, box, rounding=np.round):
+    """
+    Return the lattice vectors n.(A, B, C) with integer n = rounding(fractional coordinates of dxyz).
+
+    Subtracting the result with rounding=np.round gives the minimum image of short displacements
+    (shorter than half the width of the box) and with rounding=np.floor wraps positions into the box.
+
+    Parameters
+    ----------
+    dxyz : np.ndarray
+        N_frames*N*3 (3D) array of displacements or positions
+    box : np.ndarray
+        N_frames*3 box lengths or N_frames*3*3 box vectors (see box_array)
+    rounding : function
+        Function that rounds the fractional coordinates to integers
+
+    Returns
+    -------
+    np.ndarray
+        N_frames*N*3 array of lattice vectors
+    """
+    if box.ndim == 2:
+        return box[:, np.newaxis, :] * rounding(dxyz / box[:, np.newaxis, :])
+    n = rounding(np.einsum('fni,fij->fnj', dxyz, np.linalg.inv(box)))
+    return np.einsum('fni,fij->fnj', n, box)
+
+
+def periodic_pairs(xyz, vectors, cutoff):
+    """
+    Find all atom pairs within a cutoff distance of each other in one frame with a triclinic box.
+
+    The atoms are wrapped into the unit cell and compared with their images in the unit cell
+    and the 26 neighboring cells, which finds all pairs if the cutoff is shorter than the
+    distances between opposite faces of the box.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        N_atoms*3 (2D) array of atomic positions
+    vectors : np.ndarray
+        3*3 array whose rows are the box vectors
+    cutoff : float
+        Distance cutoff
+
+    Returns
+    -------
+    np.ndarray
+        N_pairs*2 array of atom pairs (a1, a2) with a2 > a1
+    """
+    na = len(xyz)
+    frac = xyz.dot(np.linalg.inv(vectors))
+    ref = (frac - np.floor(frac)).dot(vectors)
+    shifts = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=float).dot(vectors)
+    images = (ref[np.newaxis, :, :] + shifts[:, np.newaxis, :]).reshape(-1, 3)
+    close = cKDTree(ref).sparse_distance_matrix(cKDTree(images), cutoff, output_type='ndarray')
+    a1, a2 = close['i'], close['j'] % na
+    keep = a1 < a2
+    return np.array([a1[keep], a2[keep]], dtype=int).T.reshape(-1, 2)
+
+
+def close_pairs(xyz, cutoff, box=None, stride=10):
+    """
+    Find all atom pairs that come within a cutoff distance of each other in any frame.
+
+    Rather than computing all N^2 distances in every frame, a KD-tree is built on one
+    reference frame per window of (stride) frames and queried with the cutoff enlarged by
+    twice the largest atomic displacement within the window. This guarantees that every
+    pair closer than the cutoff in any frame of the window is found.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        N_frames*N_atoms*3 (3D) array of atomic positions
+    cutoff : float
+        Distance cutoff
+    box : np.ndarray, optional
+        N_frames*3 (2D) array of rectilinear periodic box lengths, or
+        N_frames*3*3 (3D) array of triclinic box vectors (see box_array)
+    stride : int
+        Number of frames that share one KD-tree
+
+    Returns
+    -------
+    np.ndarray
+        N_pairs*2 array of atom pairs (a1, a2) with a2 > a1, in sorted order
     """
-    boMode = 0
-    boFrame = -1
-    boSparse = OrderedDict()
+    nf, na = xyz.shape[:2]
     keys = []
-    for ln, line in enumerate(open(boin).readlines()):
-        if boMode == 0:
-            nbo = int(line.strip())
-            boLine = ln
-            boMode = 1
-            boFrame += 1
-        elif boMode == 1:
-            if ln > boLine + 1:
-                s = line.split()
-                a1 = int(s[0])
-                a2 = int(s[1])
-                bo = float(s[2])
-                a1, a2 = sorted((a1, a2))
-                if a1 != a2:
-                    if (a1, a2) not in boSparse:
-                        boSparse[(a1, a2)] = np.zeros(traj_length, dtype=float)
-                        keys.append((a1, a2))
-                    boSparse[(a1, a2)][boFrame] = bo
-                if ln == boLine + nbo + 1:
-                    boMode = 0
-    sortkeys = sorted(keys)
-    boSparse_sorted = OrderedDict([(k, boSparse[k]) for k in sortkeys if np.max(boSparse[k]) > thre])
-
-    # LPW 2020-03-24 commented out for now
-    # dm_all = None
-    # for k, v in boSparse_sorted.items():
-    #     amask = np.ma.array(v, mask=(v==0.0))
-    #     am_fut = amask[1:]
-    #     am_now = amask[:-1]
-    #     dm = np.ma.abs(am_fut - am_now)
-    #     if dm_all is None:
-    #         dm_all = dm.copy()
-    #     else:
-    #         dm_all = np.ma.vstack((dm_all, dm.copy()))
-    # maxVals = np.ma.max(dm_all, axis=0)
-    # maxArgs = np.ma.argmax(dm_all, axis=0)
-    # pairs = list(boSparse_sorted.keys())
-    # for i in range(dm_all.shape[1]):
-    #     print "%5i % .4f %i %i" % (i, maxVals[i], pairs[maxArgs[i]][0], pairs[maxArgs[i]][1])
-    return boSparse_sorted
+    frame = 0
+    while frame < nf:
+        end = min(nf, frame + stride)
+        disp = xyz[frame:end] - xyz[frame]
+        if box is not None:
+            disp = minimum_image(disp, box[frame:end])
+        reach = 2 * np.sqrt(np.max(np.sum(disp ** 2, axis=2)))
+        if reach > cutoff and end > frame + 1:
+            # Atoms moved too far to share one tree; go frame by frame in this window
+            windows = [(f, 0.0) for f in range(frame, end)]
+        else:
+            windows = [(frame, reach)]
+        for f, r in windows:
+            # Small margin guards against roundoff differences with the exact distances
+            if box is not None and box.ndim == 3:
+                p = periodic_pairs(xyz[f], box[f], cutoff + r + 1e-6)
+            else:
+                if box is not None:
+                    ref = np.mod(xyz[f], box[f])
+                    ref[ref >= box[f]] = 0.0
+                    tree = cKDTree(ref, boxsize=box[f])
+                else:
+                    tree = cKDTree(xyz[f])
+                p = tree.query_pairs(cutoff + r + 1e-6, output_type='ndarray')
+            keys.append(p[:, 0].astype(np.int64) * na + p[:, 1])
+        frame = end
+    keys = np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+    return np.array([keys // na, keys % na], dtype=int).T.reshape(-1, 2)
+
+
+class RunIndex(object):
+    """
+    Per-atom run-length index of a (frame, atom) boolean array such as traj_stable.
+
+    The runs of True values for every atom are stored in two sorted arrays of keys
+    (atom * (traj_length + 1) + frame) holding the first frame and one past the last frame
+    of each run.  This allows the next or previous True frame for a set of atoms to be
+    found with a single vectorized binary search rather than a frame-by-frame scan.
+
+    The index is built once from the array and is not updated if the array changes afterwards.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Array of shape (traj_length, n_atoms); nonzero entries are True
+    """
+
+    def __init__(self, mask):
+        self.traj_length, self.na = mask.shape
+        self.width = self.traj_length + 1
+        starts = []
+        ends = []
+        # Process atoms in blocks to bound the size of the temporary arrays
+        for a0 in range(0, self.na, 256):
+            n = min(256, self.na - a0)
+            padded = np.zeros((self.traj_length + 2, n), dtype=np.int8)
+            padded[1:-1] = mask[:, a0:a0 + n] != 0
+            edges = np.diff(padded, axis=0).T
+            sa, sf = np.nonzero(edges == 1)
+            ea, ef = np.nonzero(edges == -1)
+            starts.append((sa + a0).astype(np.int64) * self.width + sf)
+            ends.append((ea + a0).astype(np.int64) * self.width + ef)
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        self.ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+
+    def next_true(self, frame, atoms):
+        """
+        For each atom, return the first frame at or after (frame) where it is True,
+        or traj_length if there is none.
+        """
+        atoms = np.asarray(atoms, dtype=np.int64)
+        # The first run that ends after the frame
+        idx = np.searchsorted(self.ends, atoms * self.width + frame, side='right')
+        valid = idx < len(self.ends)
+        idx = np.minimum(idx, len(self.ends) - 1)
+        valid &= (self.starts[idx] // self.width) == atoms
+        return np.where(valid, np.maximum(self.starts[idx] % self.width, frame), self.traj_length)
+
+    def prev_true(self, frame, atoms):
+        """
+        For each atom, return the last frame at or before (frame) where it is True,
+        or -1 if there is none.
+        """
+        atoms = np.asarray(atoms, dtype=np.int64)
+        # The last run that starts before or at the frame
+        idx = np.searchsorted(self.starts, atoms * self.width + frame, side='right') - 1
+        valid = idx >= 0
+        idx = np.maximum(idx, 0)
+        valid &= (self.starts[idx] // self.width) == atoms
+        return np.where(valid, np.minimum(self.ends[idx] % self.width - 1, frame), -1)
 
 
 def formulaSum(efList):
@@ -485,12 +1315,26 @@ def formulaSum(efList):
     return '+'.join(words)
 
 
+# Nanoreactor object shared with forked worker processes (see Nanoreactor.forkMap)
+_shared_reactor = None
+
+
+def _molecule_events(molNums):
+    return _shared_reactor.moleculeEvents(molNums)
+
+
+def _write_output(job):
+    method, args = job
+    getattr(_shared_reactor, method)(*args)
+
+
 class Nanoreactor(Molecule):
     def __init__(self, xyzin=None, qsin=None, properties='properties.txt', dt_fs=0.0, boin='bond_order.list',
                  bothre=0.0,
                  enhance=1.4, mindist=1.0, printlvl=0, known=['all'], exclude=[], learntime=100.0, cutoff=100.0,
                  padtime=0, save_molecules=False, frames=0, saverxn=True,
-                 neutralize=False, radii=[], align=False, pbc=0.0, plot=False):
+                 neutralize=False, radii=[], align=False, pbc=0.0, plot=False, nproc=1, lpmethod='fft',
+                 cache=False, vizformat='text', checkpoint=None, profile=None, memtop=0, cprofile=None):
         # ==========================#
         #         Settings          #
         # ==========================#
@@ -535,27 +1379,70 @@ class Nanoreactor(Molecule):
         # Keep time series that come within this factor of the threshold
         self.sparsePad = 1.2
 
+        # Method for the low-pass filter (see lowpass_filter), data type of the filtered time series
+        # and approximate memory limit in bytes for the temporary arrays of the filter
+        self.filterMethod = lpmethod
+        self.filterDtype = np.float32
+        self.filterMem = 2 ** 28
+
         # Whether to align molecules / reactions prior to output
         self.align = align
 
+        # Number of processes used to search for reaction events
+        self.nproc = max(1, nproc)
+
+        # Format of the frame-by-frame data for VMD visualization (see writeVisualization)
+        if vizformat not in ('text', 'binary', 'both'):
+            raise RuntimeError("vizformat must be one of 'text', 'binary' or 'both'")
+        self.vizFormat = vizformat
+
+        # Directory for checkpoints of the filtered time series and global graphs (see checkpointKey)
+        self.checkpointDir = checkpoint
+
+        # Record the time and memory usage of each stage (see runStage)
+        if profile is not None or cprofile is not None:
+            self.profiler = StageProfiler(profile, memtop, cprofile, self.profileCounts)
+        else:
+            self.profiler = None
+
         # ==========================#
         #   Load in the XYZ file   #
         # ==========================#
         if xyzin is None:
             raise Exception('Nanoreactor must be initialized with an .xyz file as the first argument')
-        self.timing(super(Nanoreactor, self).__init__, "Loading molecule", xyzin)
-        # Rudimentary periodic boundary condition support; cubic box only.
-        # Later we can support more flexible PBCs by passing a trajectory format that supports them
-        # using code already in molecule.py
-        if pbc > 0.0:
-            self.boxes = [BuildLatticeFromLengthsAngles(pbc, pbc, pbc, 90.0, 90.0, 90.0) for i in range(len(self))]
+        if isinstance(xyzin, Molecule):
+            # Frames that are already in memory, e.g. a window of a trajectory that is still being written
+            super(Nanoreactor, self).__init__()
+            self.Data.update(xyzin.Data)
+        else:
+            self.timing(super(Nanoreactor, self).__init__, "Loading molecule", xyzin, cache=cache)
+        # Periodic boundary conditions.  A box given by the user applies to all frames; otherwise the
+        # per-frame boxes are taken from the trajectory, either from formats that store them
+        # or from extended XYZ comment lines (Lattice="...").
+        box = make_box(pbc)
+        if box is not None:
+            self.boxes = [box for i in range(len(self))]
+        elif 'boxes' not in self.Data and 'comms' in self.Data and len(self) > 0 and 'Lattice=' in self.comms[0]:
+            boxes = [lattice_from_comment(comm) for comm in self.comms]
+            if any([b is None for b in boxes]):
+                raise RuntimeError('Periodic box is missing from the comment lines of some frames')
+            self.boxes = boxes
+        elif 'boxes' in self.Data and len(self.boxes) == 1:
+            self.boxes = [self.boxes[0] for i in range(len(self))]
+        # Box lengths (rectilinear) or box vectors (triclinic) of each frame, or None without periodic boxes
+        self.pbcBoxes = box_array(self.boxes) if 'boxes' in self.Data else None
 
         # ===============================#
         #   Load charge and spin data   #
         # ===============================#
-        if qsin is not None and os.path.exists(qsin):
-            QS = self.timing(Molecule, "Loading charge and spin populations", qsin, ftype="xyz")
-            QSarr = np.array(QS.xyzs)
+        if isinstance(qsin, np.ndarray):
+            # Charges and spins already in memory, in the first two columns
+            self.Charges = qsin[:, :, 0]
+            self.Spins = qsin[:, :, 1]
+            self.have_pop = True
+        elif qsin is not None and os.path.exists(qsin):
+            QS = self.timing(Molecule, "Loading charge and spin populations", qsin, ftype="xyz", cache=cache)
+            QSarr = QS.xyz_array()
             self.Charges = QSarr[:, :, 0]
             self.Spins = QSarr[:, :, 1]
             self.have_pop = True
@@ -564,21 +1451,10 @@ class Nanoreactor(Molecule):
             self.Spins = np.array([[0 for i in range(self.na)] for j in range(len(self))])
             self.have_pop = False
 
-        # ==========================#
-        #   Load bond order data   #
-        # ==========================#
-        self.boHave = False
-        if boin is not None and os.path.exists(boin) and bothre > 0.0:
-            self.boHave = True
-            self.boSparse = self.timing(load_bondorder, "Loading pairwise bond orders", boin, bothre / self.sparsePad,
-                                        len(self))
-        elif bothre > 0.0:
-            raise RuntimeError('To use bond order threshold, must provide bond order list via "boin" argument')
-
         # =====================#
         #   Load properties   #
         # =====================#
-        if os.path.exists(properties):
+        if properties is not None and os.path.exists(properties):
             if dt_fs != 0.0:
                 raise RuntimeError("%s exists, don't provide a time step" % properties)
             props = np.loadtxt('properties.txt')
@@ -593,6 +1469,37 @@ class Nanoreactor(Molecule):
         self.PadTime = int(self.PadTime / self.dt_fs)
         self.freqCutoff = cutoff
 
+        # Checkpoint of the filtered time series, if the inputs and parameters are unchanged.
+        # In-memory inputs have no file signature, so they are not checkpointed.
+        if bothre > 0.0:
+            filterParams = dict(xyz=file_signature(xyzin), boin=file_signature(boin), bothre=bothre)
+        else:
+            filterParams = dict(xyz=file_signature(xyzin), enhance=enhance, mindist=mindist, radii=radii,
+                                pbc=np.array(pbc, dtype=float).flatten().tolist())
+        filterParams.update(pad=self.sparsePad, cutoff=cutoff, dt_fs=self.dt_fs, method=self.filterMethod,
+                            dtype=np.dtype(self.filterDtype).str)
+        if filterParams['xyz'] is None or (bothre > 0.0 and filterParams['boin'] is None):
+            filterKey = None
+        else:
+            filterKey = self.checkpointKey('filter', **filterParams)
+        filterCkpt = None if plot else self.loadCheckpoint('filter', filterKey)
+
+        # ==========================#
+        #   Load bond order data   #
+        # ==========================#
+        self.boHave = False
+        if isinstance(boin, SparseSeries) and bothre > 0.0:
+            # Bond orders already in memory
+            self.boHave = True
+            self.boSparse = boin.select(boin.max() > bothre / self.sparsePad)
+        elif boin is not None and os.path.exists(boin) and bothre > 0.0:
+            self.boHave = True
+            if filterCkpt is None:
+                self.boSparse = self.timing(load_bondorder, "Loading pairwise bond orders", boin,
+                                            bothre / self.sparsePad, len(self))
+        elif bothre > 0.0:
+            raise RuntimeError('To use bond order threshold, must provide bond order list via "boin" argument')
+
         if self.printlvl >= 0:
             print("Done loading files")
         print("The simulation timestep is %.1f fs" % self.dt_fs)
@@ -606,17 +1513,20 @@ class Nanoreactor(Molecule):
         # ==========================#
         #   Initialize Variables   #
         # ==========================#
-        # An iterator over all atom pairs, for example: [[0,1],[0,2],[0,3],[1,2],[1,3],[2,3]]
-        self.AtomIterator = np.array(list(itertools.combinations(list(range(self.na)), 2)))
-
         # Set of isomers that are RECORDED.
         self.Recorded = set()
 
         # A time-series of atom-wise isomer labels.
         self.IsoLabels = []
         if self.boHave:
-            self.boFiltered = self.timing(self.tsFilter, "Filtering bond order time series", self.boSparse, self.boThre,
-                                          self.freqCutoff, 'bo', 'plot_bo.pdf' if plot else None)
+            if filterCkpt is not None:
+                self.boFiltered = OrderedDict([(tuple(k), v) for k, v in
+                                               zip(filterCkpt['pairs'], filterCkpt['filtered'])])
+            else:
+                self.boFiltered = self.timing(self.tsFilter, "Filtering bond order time series", self.boSparse,
+                                              self.boThre, self.freqCutoff, 'bo', 'plot_bo.pdf' if plot else None)
+                self.saveCheckpoint('filter', filterKey, pairs=np.array(list(self.boFiltered.keys())).reshape(-1, 2),
+                                    filtered=np.array(list(self.boFiltered.values())))
         else:
             # Replace default radii with custom radii.
             for i in range(0, len(radii), 2):
@@ -624,26 +1534,43 @@ class Nanoreactor(Molecule):
                 custom_rad = float(radii[i + 1])
                 Radii[Elements.index(atom_symbol) - 1] = custom_rad
                 print("Custom covalent radius for %2s : %.3f" % (atom_symbol, custom_rad))
-            # Measure interatomic distances.
-            self.dxSparse, self.dxThre = self.timing(self.measureDistances, "Measuring interatomic distances",
-                                                     self.sparsePad, mindist)
-            self.dxFiltered = self.timing(self.tsFilter, "Filtering distance time series", self.dxSparse, self.dxThre,
-                                          self.freqCutoff, 'dx', 'plot_dx.pdf' if plot else None)
+            if filterCkpt is not None:
+                pairs = [tuple(k) for k in filterCkpt['pairs']]
+                self.dxThre = OrderedDict(zip(pairs, filterCkpt['thre']))
+                self.dxFiltered = OrderedDict(zip(pairs, filterCkpt['filtered']))
+            else:
+                # Measure interatomic distances.
+                self.dxSparse, self.dxThre = self.timing(self.measureDistances, "Measuring interatomic distances",
+                                                         self.sparsePad, mindist)
+                self.dxFiltered = self.timing(self.tsFilter, "Filtering distance time series", self.dxSparse,
+                                              self.dxThre, self.freqCutoff, 'dx', 'plot_dx.pdf' if plot else None)
+                self.saveCheckpoint('filter', filterKey, pairs=np.array(list(self.dxFiltered.keys())).reshape(-1, 2),
+                                    thre=np.array(list(self.dxThre.values()), dtype=float),
+                                    filtered=np.array(list(self.dxFiltered.values())))
 
         # self.global_graphs : A list of all possible ways the atoms are connected in the whole system,
         #                      consisting of a list of 2-tuples.
         # self.gg_frames : An OrderedDict that maps start_time : (index in self.global_graphs, end_time)
         # self.BondLists : A time series of VMD-formatted bond specifications for each frame in the trajectory.
-        self.global_graphs, self.gg_frames, self.BondLists = self.timing(
-            self.makeGlobalGraphs, "Making global graphs",
-            self.boFiltered if self.boHave else self.dxFiltered,
-            self.boThre if self.boHave else self.dxThre,
-            'bo' if self.boHave else 'dx')
+        # self.gg_diffs : A list of (added bonds, removed bonds) at each start_time in self.gg_frames.
+        graphsKey = None if filterKey is None else self.checkpointKey('graphs', filter=filterKey)
+        graphsCkpt = self.loadCheckpoint('graphs', graphsKey)
+        if graphsCkpt is not None:
+            self.global_graphs, self.gg_frames, self.BondLists, self.gg_diffs = unpack_global_graphs(graphsCkpt,
+                                                                                                     len(self))
+        else:
+            self.global_graphs, self.gg_frames, self.BondLists, self.gg_diffs = self.timing(
+                self.makeGlobalGraphs, "Making global graphs",
+                self.boFiltered if self.boHave else self.dxFiltered,
+                self.boThre if self.boHave else self.dxThre,
+                'bo' if self.boHave else 'dx')
+            self.saveCheckpoint('graphs', graphsKey, **pack_global_graphs(self.global_graphs, self.gg_frames,
+                                                                         self.BondLists, self.gg_diffs))
 
         # ========================#
         # | Make molecule graphs #|
         # ========================#
-        # self.Isomers : List of MyG() graph objects for all of the isomers found in the system.
+        # self.Isomers : Registry (list) of MyG() graph objects for all of the isomers found in the system.
         #                "Isomer index" refers to the position of the isomer in this list.
         # self.MolIDs  : List of molecule IDs for all molecules found in the system such as '117-121,138:123'
         #                (i.e. list of atoms in 'comma-dash' format:isomer index).
@@ -655,9 +1582,12 @@ class Nanoreactor(Molecule):
         #                    is currently stable
         # self.known_iidx : List of isomers that are 'known', i.e. matching user-provided empirical formulas
         #                   and excluded from coloring
+        # self.StableRuns : Run-length index of self.traj_stable for finding the next or previous stable frames;
+        #                   it is built here, so traj_stable must not be changed afterwards
         self.Isomers, self.MolIDs, self.TimeSeries, self.traj_iidx, self.traj_midx, self.traj_stable, self.known_iidx = self.timing(
             self.makeMoleculeGraphs, "Making molecule graphs")
-        if hasattr(self, 'boxes'): self.timing(self.makeWhole, "Making molecules whole")
+        self.StableRuns = RunIndex(self.traj_stable)
+        if self.pbcBoxes is not None: self.timing(self.makeWhole, "Making molecules whole")
         self.IsomerData, self.traj_color = self.timing(self.analyzeIsomers, "Analyzing isomers")
 
         # ========================#
@@ -669,6 +1599,81 @@ class Nanoreactor(Molecule):
         #               the list of molecule IDs that are involved and a "chemical equation" string
         self.EventIDs, self.Events = self.timing(self.findReactionEvents, "Finding reaction events")
 
+    def checkpointKey(self, stage, **params):
+        """
+        Return the key of the checkpoint for an analysis stage, which is a hash
+        of the stage name and the inputs and parameters that affect its results.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the analysis stage
+        params : dict
+            JSON-serializable inputs and parameters of the stage; input files
+            are identified by file_signature()
+
+        Returns
+        -------
+        str or None
+            Hexadecimal hash, or None if checkpoints are not enabled
+        """
+        if self.checkpointDir is None:
+            return None
+        params['stage'] = stage
+        params['version'] = 2
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def loadCheckpoint(self, stage, key):
+        """
+        Load the checkpoint of an analysis stage from self.checkpointDir.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the analysis stage
+        key : str or None
+            Key of the checkpoint from checkpointKey()
+
+        Returns
+        -------
+        dict or None
+            Arrays saved by saveCheckpoint(), or None if there is no checkpoint
+        """
+        if key is None:
+            return None
+        fnm = os.path.join(self.checkpointDir, '%s-%s.npz' % (stage, key[:16]))
+        if not os.path.exists(fnm):
+            return None
+        with np.load(fnm) as npz:
+            data = dict(npz.items())
+        if self.printlvl >= 0:
+            print("Loaded %s checkpoint from %s" % (stage, fnm))
+        return data
+
+    def saveCheckpoint(self, stage, key, **arrays):
+        """
+        Save the results of an analysis stage to self.checkpointDir as a .npz file,
+        so they can be loaded when the analysis is rerun with the same inputs and parameters.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the analysis stage
+        key : str or None
+            Key of the checkpoint from checkpointKey(); nothing is saved if None
+        arrays : dict
+            Arrays to be saved
+        """
+        if key is None:
+            return
+        if not os.path.exists(self.checkpointDir):
+            os.makedirs(self.checkpointDir)
+        fnm = os.path.join(self.checkpointDir, '%s-%s.npz' % (stage, key[:16]))
+        # Write to a temporary file first so an interrupted run doesn't leave a truncated checkpoint
+        with open(fnm + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(fnm + '.tmp', fnm)
+
     def timing(self, func, msg, *args, **kwargs):
         """
         Wrapper function that prints out timing information for a function or method.
@@ -686,11 +1691,42 @@ class Nanoreactor(Molecule):
         if self.printlvl >= 0:
             print(msg + " ...", end=' ')
             t0 = time.time()
-        ret = func(*args, **kwargs)
+        ret = self.runStage(func, *args, **kwargs)
         if self.printlvl >= 0:
             print("%.3f s" % (time.time() - t0))
         return ret
 
+    def runStage(self, func, *args, **kwargs):
+        """
+        Call a function or method, recording its time and memory usage if profiling is enabled.
+
+        Parameters
+        ----------
+        func : function or method
+            The function that's being wrapped; its qualified name (e.g. Nanoreactor.tsFilter)
+            is the stage name in the profile
+        *args, **kwargs :
+            Positional and keyword arguments expected by the function
+        """
+        if self.profiler is None:
+            return func(*args, **kwargs)
+        return self.profiler.run(func.__qualname__, func, *args, **kwargs)
+
+    def profileCounts(self):
+        """
+        Return the sizes of the analysis results that exist so far, for the profile records.
+        """
+        counts = OrderedDict()
+        if 'xyzs' in self.Data:
+            counts['frames'] = len(self.xyzs)
+            counts['atoms'] = self.na
+        for name, attr in [('sparse_pairs', 'boSparse'), ('sparse_pairs', 'dxSparse'), ('pairs', 'boFiltered'),
+                           ('pairs', 'dxFiltered'), ('global_graphs', 'global_graphs'), ('molecules', 'MolIDs'),
+                           ('isomers', 'Isomers'), ('events', 'Events')]:
+            if attr in self.__dict__:
+                counts[name] = len(self.__dict__[attr])
+        return counts
+
     def measureDistances(self, pad, mindist=1.0):
         """
         Measure interatomic distances.  Only keep timeseries whose minimum values
@@ -717,8 +1753,13 @@ class Nanoreactor(Molecule):
         """
         # Create an atom-wise list of covalent radii.
         R = np.array([(Radii[Elements.index(i) - 1] if i in Elements else 0.0) for i in self.elem])
-        # A list of threshold distances for each atom pair for determining whether two atoms are bonded
-        self.BondThresh = np.array([max(mindist, (R[i[0]] + R[i[1]]) * self.Fac) for i in self.AtomIterator])
+        xyz = self.xyz_array()
+        boxes = self.pbcBoxes
+        # Only atom pairs that come within the largest possible threshold in any frame are candidates
+        # (Avoids iterating over all n_atom * n_atom pairs)
+        candidates = close_pairs(xyz, max(mindist, 2 * np.max(R) * self.Fac) * pad, box=boxes)
+        # A list of threshold distances for each candidate atom pair for determining whether two atoms are bonded
+        BondThresh = np.maximum(mindist, (R[candidates[:, 0]] + R[candidates[:, 1]]) * self.Fac)
         i = 0
         # Atom pair batch size for computing interatomic distance.
         # The maximum array size is batch_size * traj_length
@@ -727,19 +1768,15 @@ class Nanoreactor(Molecule):
         dxSparse = OrderedDict()
         dxThre = OrderedDict()
         # Build graphs from the distance matrices
-        while i < len(self.AtomIterator):
-            if self.printlvl >= 2: print("%i/%i" % (i, len(self.AtomIterator)))
-            j = min(i + batch, len(self.AtomIterator))
-            if hasattr(self, 'boxes'):
-                boxes = np.array([[self.boxes[s].a, self.boxes[s].b, self.boxes[s].c] for s in range(len(self))])
-                dxij = AtomContact(np.array(self.xyzs), self.AtomIterator[i:j], box=boxes)
-            else:
-                dxij = AtomContact(np.array(self.xyzs), self.AtomIterator[i:j])
+        while i < len(candidates):
+            if self.printlvl >= 2: print("%i/%i" % (i, len(candidates)))
+            j = min(i + batch, len(candidates))
+            dxij = AtomContact(xyz, candidates[i:j], box=boxes)
             dxmin = np.min(dxij, axis=0)
-            thre = self.BondThresh[i:j]
+            thre = BondThresh[i:j]
             for k in np.where(dxmin < (thre * pad))[0]:
-                dxSparse[tuple(self.AtomIterator[i + k])] = dxij[:, k].copy()
-                dxThre[tuple(self.AtomIterator[i + k])] = self.BondThresh[i + k]
+                dxSparse[tuple(candidates[i + k])] = dxij[:, k].copy()
+                dxThre[tuple(candidates[i + k])] = BondThresh[i + k]
             i += batch
         return dxSparse, dxThre
 
@@ -750,7 +1787,7 @@ class Nanoreactor(Molecule):
 
         Parameters
         ----------
-        tsData : OrderedDict
+        tsData : OrderedDict or SparseSeries
             Dictionary that maps zero-indexed atom pairs (a1, a2) to numpy array
             containing numerical time series data between a1, a2 for each frame.
         tsThre : float or OrderedDict
@@ -766,11 +1803,26 @@ class Nanoreactor(Molecule):
         Returns
         -------
         OrderedDict
-            Same structure as tsData, with filter applied
+            Same structure as tsData, with filter applied; the time series are rows of
+            a single array of type self.filterDtype
         """
         tsPairs = list(tsData.keys())
-        tsArr = np.array(list(tsData.values()))
-        tsArr_lp, freqx, ft, ft_lp = low_pass_smoothing(tsArr, freqCut, self.dt_fs)
+        if isinstance(tsData, SparseSeries):
+            def getBlock(start, end):
+                # Expand the sparse time series directly into a dense block
+                return tsData.dense(start, end).astype(float)
+        else:
+            tsValues = list(tsData.values())
+
+            def getBlock(start, end):
+                return np.array(tsValues[start:end], dtype=float)
+        # Filter blocks of pairs so that the temporary arrays (about four double precision
+        # copies of each block) stay below self.filterMem bytes
+        tsArr_lp = np.empty((len(tsPairs), len(self)), dtype=self.filterDtype)
+        blockSize = max(1, int(self.filterMem // (32 * max(1, len(self)))))
+        for start in range(0, len(tsPairs), blockSize):
+            end = min(start + blockSize, len(tsPairs))
+            lowpass_filter(getBlock(start, end), freqCut, self.dt_fs, out=tsArr_lp[start:end], method=self.filterMethod)
         # The bulk of this function is actually for plotting
         if plotFile is not None:
             if mode == 'dx':
@@ -788,10 +1840,48 @@ class Nanoreactor(Molecule):
             else:
                 raise RuntimeError('mode %s not recognized' % mode)
             fout = PdfPages(plotFile)
-
+            # The raw time series are expanded again one block of pairs at a time for plotting
+            blockStarts = list(range(0, len(tsPairs), blockSize))
+
+            def iterBlocks():
+                for start in blockStarts:
+                    end = min(start + blockSize, len(tsPairs))
+                    yield start, end, getBlock(start, end)
+
+            # Construct histograms of bond order or distance data for each element pair,
+            # accumulating the counts over the blocks of pairs
+            pairElem = [tuple(sorted([self.elem[a1], self.elem[a2]])) for a1, a2 in tsPairs]
+            histRange = OrderedDict()
+            if mode == 'bo':
+                for start, end, tsBlock in iterBlocks():
+                    for tsElem, tsMax in zip(pairElem[start:end], tsBlock.max(axis=1)):
+                        histRange[tsElem] = max(histRange.get(tsElem, 0.0), tsMax)
+                histRange = OrderedDict([(k, [0, int(v) + 1]) for k, v in histRange.items()])
+            else:
+                histRange = OrderedDict([(k, y1lim) for k in pairElem])
+            histCounts = OrderedDict()
+            for start, end, tsBlock in iterBlocks():
+                blockElem = pairElem[start:end]
+                for tsElem in set(blockElem):
+                    tsSame = np.array([k for k, j in enumerate(blockElem) if j == tsElem])
+                    tsHist = (tsBlock[tsSame, :] + (tsBlock[tsSame, :] == 0.0) * 1e3).flatten()
+                    weights = tsHist ** -2 if mode == 'dx' else None
+                    counts, bins = np.histogram(tsHist, bins=72, weights=weights, range=histRange[tsElem])
+                    if tsElem in histCounts:
+                        histCounts[tsElem][0] += counts
+                    else:
+                        histCounts[tsElem] = [counts.astype(float), bins]
             histograms = OrderedDict()
-            for i in range(0, len(tsArr)):
-                if self.printlvl >= 2 and i % 100 == 0: print("Plotting timeseries %i/%i" % (i, len(tsArr)))
+            for tsElem, (counts, bins) in histCounts.items():
+                # Same normalization as np.histogram(..., density=True)
+                heights = counts / np.diff(bins) / counts.sum()
+                histograms[tsElem] = (bins[:-1] + (bins[1] - bins[0]) / 2, heights)
+
+            for i in range(0, len(tsPairs)):
+                if self.printlvl >= 2 and i % 100 == 0: print("Plotting timeseries %i/%i" % (i, len(tsPairs)))
+                if i % blockSize == 0:
+                    tsBlock = getBlock(i, min(i + blockSize, len(tsPairs)))
+                tsRow = tsBlock[i % blockSize]
                 fign = i % 10
                 if fign == 0:
                     fig = plt.figure()
@@ -799,7 +1889,7 @@ class Nanoreactor(Molecule):
                 # Plot raw and filtered time series on left panels
                 ax1 = fig.add_axes([0.07, 0.87 - 0.09 * fign, 0.37, 0.09])
                 times = np.arange(len(self)) * self.dt_fs
-                ax1.plot(times, tsArr[i], color='#1e90ff', linewidth=0.75)
+                ax1.plot(times, tsRow, color='#1e90ff', linewidth=0.75)
                 ax1.plot(times, tsArr_lp[i], color='#ff6302', linewidth=0.75)
                 if isinstance(tsThre, OrderedDict):
                     thre = tsThre[tsPairs[i]]
@@ -810,12 +1900,12 @@ class Nanoreactor(Molecule):
                 ax1.set_xlim([min(times), max(times)])
                 # If using bond orders, set separate limits for each time series
                 if mode == 'bo':
-                    if max(tsArr[i]) > 3.0:
+                    if max(tsRow) > 3.0:
                         raise RuntimeError('Did not expect BO above 3.0')
-                    elif max(tsArr[i]) > 2.0:
+                    elif max(tsRow) > 2.0:
                         y1lim = [0, 3]
                         y1ticks = [1, 2]
-                    elif max(tsArr[i]) > 1.0:
+                    elif max(tsRow) > 1.0:
                         y1lim = [0, 2]
                         y1ticks = [0.5, 1, 1.5]
                     else:
@@ -825,8 +1915,11 @@ class Nanoreactor(Molecule):
                 ax1.set_yticks(y1ticks)
                 # Plot spectrum of the BO time series on the right panels
                 ax2 = fig.add_axes([0.58, 0.87 - 0.09 * fign, 0.36, 0.09])
-                ax2.plot(freqx, np.abs(ft[i] ** 2), color='#1e90ff', linewidth=0.5)
-                ax2.plot(freqx, np.abs(ft_lp[i] ** 2), color='#ff6302', linewidth=0.5)
+                # Spectra are only computed one time series at a time, for plotting
+                _, freqx, ft, ft_lp = low_pass_smoothing(tsRow[np.newaxis, :], freqCut, self.dt_fs)
+                ft, ft_lp = ft[0], ft_lp[0]
+                ax2.plot(freqx, np.abs(ft ** 2), color='#1e90ff', linewidth=0.5)
+                ax2.plot(freqx, np.abs(ft_lp ** 2), color='#ff6302', linewidth=0.5)
                 # Dotted vertical line showing frequency cutoff
                 if freqCut > 0.0:
                     ax2.axvline(freqCut, color='k', linestyle='--', linewidth=0.75)
@@ -836,14 +1929,14 @@ class Nanoreactor(Molecule):
                 highFreq = False
                 if highFreq:
                     ax2.set_xlim([0, 5000])
-                    ax2.set_ylim([0, y2fac * 0.01 * (ft[i].shape[0]) ** 2])
+                    ax2.set_ylim([0, y2fac * 0.01 * (ft.shape[0]) ** 2])
                 else:
                     ax2.set_xlim([0, freqCut * 4 if freqCut > 0.0 else 1000])
-                    ax2.set_ylim([0, y2fac * (ft[i].shape[0]) ** 2])
+                    ax2.set_ylim([0, y2fac * (ft.shape[0]) ** 2])
                 ax2.set_yticks([])
 
                 ax2b = ax2.twinx()
-                ax2b.plot(freqx, np.abs(ft_lp[i] ** 2) / np.abs(ft[i] ** 2), color='r', linestyle='--', linewidth=0.75)
+                ax2b.plot(freqx, np.abs(ft_lp ** 2) / np.abs(ft ** 2), color='r', linestyle='--', linewidth=0.75)
                 ax2b.axhline(0.5, color='k', linestyle='--', linewidth=0.75)
                 if highFreq:
                     ax2b.set_xlim([0, 5000])
@@ -856,23 +1949,8 @@ class Nanoreactor(Molecule):
 
                 # Plot histogram of the bond order / distance for this atom pair
                 ax3 = fig.add_axes([0.44, 0.87 - 0.09 * fign, 0.06, 0.09])
-                # Construct histograms of bond order or distance data for each element pair
-                # Do this only once for each element pair because it's time-consuming.
-                tsElem = tuple(sorted([self.elem[tsPairs[i][0]], self.elem[tsPairs[i][1]]]))
-                if tsElem not in histograms:
-                    tsSame = np.array([k for k, j in enumerate(tsPairs) if
-                                       ((self.elem[j[0]], self.elem[j[1]]) == tsElem or
-                                        (self.elem[j[1]], self.elem[j[0]]) == tsElem)])
-                    tsHist = (tsArr[tsSame, :] + (tsArr[tsSame, :] == 0.0) * 1e3).flatten()
-                    if mode == 'bo':
-                        tsMax = int(np.max(tsArr[tsSame, :])) + 1
-                        heights, bins = np.histogram(tsHist, bins=72, range=[0, tsMax], density=True)
-                    elif mode == 'dx':
-                        heights, bins = np.histogram(tsHist, bins=72, weights=tsHist ** -2, range=y1lim, density=True)
-                    histograms[tsElem] = (bins[:-1] + (bins[1] - bins[0]) / 2, heights)
-
                 # To plot a pre-computed histogram, use bin midpoints as x data and heights as y data
-                histx, histy = histograms[tsElem]
+                histx, histy = histograms[pairElem[i]]
                 nbin = len(np.where(histx < y1lim[1])[0])
                 ax3.hist(histx[:nbin], bins=nbin, weights=histy[:nbin], log=True, range=y1lim, color='#6BE140',
                          edgecolor='#6BE140', linewidth=0, orientation='horizontal')
@@ -883,7 +1961,7 @@ class Nanoreactor(Molecule):
                 ax3.text(1.1, thre / ax3.get_ylim()[1], '%.2f' % thre, horizontalalignment='left',
                          verticalalignment='center', transform=ax3.transAxes)
                 # Final formatting
-                if fign == 9 or i == tsArr.shape[0] - 1:
+                if fign == 9 or i == len(tsPairs) - 1:
                     fig.suptitle(title, y=0.985)
                     ax1.set_xlabel('Time (fs)')
                     ax2.set_xlabel('Frequency (cm^-1)')
@@ -919,11 +1997,16 @@ class Nanoreactor(Molecule):
 
         Returns
         -------
-        global_pairGraphs : list
+        global_pairGraphs : GlobalGraphs
             Each element in global_pairGraphs is a list of 2-tuples (bonds) corresponding to
-            one set of atomic connectivities in the whole system
+            one set of atomic connectivities in the whole system; the graphs are stored as bitsets
         gg_frames : OrderedDict
             Mapping of frame numbers to 2-tuple containing (corresponding entry in global_pairGraphs, next frame)
+        BondLists : list
+            VMD-formatted bond specifications for each frame in the trajectory
+        gg_diffs : list
+            For each entry in gg_frames, a 2-tuple containing the lists of 2-tuples (bonds)
+            that are added and removed relative to the previous frame
         """
         tsPairs = np.array(list(tsData.keys()))
         tsArr = np.array(list(tsData.values()))
@@ -942,70 +2025,82 @@ class Nanoreactor(Molecule):
         else:
             raise RuntimeError('mode may only be dx or bo')
 
+        # Frames where the global graph differs from the previous frame (should be much fewer than the
+        # number of frames). These are found with a single vectorized comparison of consecutive frames.
+        changes = [0] + list((np.flatnonzero((bonded[:, 1:] != bonded[:, :-1]).any(axis=0)) + 1).tolist())
+
         # List of global connectivity graphs. The idea is that we should only need to
         # store and analyze the distinct connectivity graphs, which should be smaller
         # in number than the # of frames in the whole trajectory.
-        globalGraphs = []
-        lastGraph = None
+        # Each global graph is stored as a bitset over the atom pairs in tsPairs,
+        # and the index of each bitset is looked up in a hash table.
+        global_pairGraphs = GlobalGraphs(tsPairs)
         # OrderedDict that maps (the frame number where a global graph first appears) to (global graph index)
         gg_frames = OrderedDict()
-        gg_idx = 0
-        for i in range(len(self)):
-            # List of atom pairs indices that are bonded (pointing to atom pairs in tsPairs).
-            gg = tuple(np.where(bonded[:, i])[0])
-            # Skip if the graph hasn't changed since the last frame (should happen often)
-            if (gg == lastGraph):
-                continue
-            # Loop over the existing global graphs that we have
-            for igg in range(len(globalGraphs)):
-                # The global graph that just appeared is a repeat of a previous one
-                if globalGraphs[igg] == gg:
-                    gg_idx = igg
-                    if self.printlvl >= 2:
-                        print("frame %i repeats global graph %i" % (i, gg_idx), end=' ')
-                    gg_frames[i] = gg_idx
-                    break
-            else:
-                # The global graph that just appeared has not been seen previously
-                gg_idx = len(globalGraphs)
-                if self.printlvl >= 2:
+        # Atom pair indices that are added or removed at each change, relative to the previous frame
+        ggDiffs = []
+        for n, i in enumerate(changes):
+            nSeen = len(global_pairGraphs)
+            gg_idx = global_pairGraphs.add(bonded[:, i])
+            if self.printlvl >= 2:
+                if gg_idx < nSeen:
+                    # The global graph that just appeared is a repeat of a previous one
+                    print("frame %i repeats global graph %i" % (i, gg_idx), end=' ')
+                else:
+                    # The global graph that just appeared has not been seen previously
                     print("frame %i found new global graph: %i" % (i, gg_idx), end=' ')
-                globalGraphs.append(gg)
-                gg_frames[i] = gg_idx
+            gg_frames[i] = gg_idx
+            if i > 0:
+                added = np.flatnonzero(bonded[:, i] & ~bonded[:, i - 1])
+                removed = np.flatnonzero(bonded[:, i - 1] & ~bonded[:, i])
+            else:
+                added = np.flatnonzero(bonded[:, i])
+                removed = np.zeros(0, dtype=int)
+            ggDiffs.append((added, removed))
             if i > 0 and self.printlvl >= 2:
-                added = ['%i-%i' % (tsPairs[i, 0] + 1, tsPairs[i, 1] + 1) for i in
-                         sorted(list(set(gg) - set(lastGraph)))]
-                removed = ['%i-%i' % (tsPairs[i, 0] + 1, tsPairs[i, 1] + 1) for i in
-                           sorted(list(set(lastGraph) - set(gg)))]
-                if len(added) > 0: print("added", ','.join(added), end=' ')
-                if len(removed) > 0: print("removed", ','.join(removed), end=' ')
+                added_str = ['%i-%i' % (tsPairs[k, 0] + 1, tsPairs[k, 1] + 1) for k in added]
+                removed_str = ['%i-%i' % (tsPairs[k, 0] + 1, tsPairs[k, 1] + 1) for k in removed]
+                if len(added) > 0: print("added", ','.join(added_str), end=' ')
+                if len(removed) > 0: print("removed", ','.join(removed_str), end=' ')
                 print()
-            lastGraph = gg
 
-        # Make list of global graphs that actually consists of lists of atom pairs
-        # (rather than atom pair indices in tsPairs)
         tsPairs = [tuple(a) for a in tsPairs]
-        global_pairGraphs = [[tsPairs[i] for i in g] for g in globalGraphs]
         # Now gg_frames should map (the frame number where the global graph first appears)
         # to a 2-tuple: (the index to the global graph, the frame number where the next global graph appears)
         for i, (k, v) in enumerate(gg_frames.items()):
             if i == len(gg_frames) - 1:
                 gg_frames[k] = (v, len(self))
             else:
-                gg_frames[k] = (v, list(gg_frames.keys())[i + 1])
+                gg_frames[k] = (v, changes[i + 1])
 
         # Build the BondLists, a "trajectory of bonded pairs" for writing bonds.dat for visualization.
+        # The bond partners of each atom are updated using the added and removed pairs at each change,
+        # so only the atoms involved in a change are formatted again.
         BondLists = []
-        for currFrame, (ggId, nextFrame) in list(gg_frames.items()):
-            bonds = [[] for i in range(self.na)]
-            for (ii, jj) in global_pairGraphs[ggId]:
+        bonds = [[] for i in range(self.na)]
+        bondTcls = [bond_tcl(b) for b in bonds]
+        for (currFrame, (ggId, nextFrame)), (added, removed) in zip(list(gg_frames.items()), ggDiffs):
+            touched = set()
+            for k in removed:
+                ii, jj = tsPairs[k]
+                bonds[ii].remove(jj)
+                bonds[jj].remove(ii)
+                touched.update((ii, jj))
+            for k in added:
+                ii, jj = tsPairs[k]
                 bonds[ii].append(jj)
                 bonds[jj].append(ii)
-            bondTcl = bondlist_tcl(bonds)
+                touched.update((ii, jj))
+            for a in touched:
+                bonds[a].sort()
+                bondTcls[a] = bond_tcl(bonds[a])
+            bondTcl = ' '.join(bondTcls)
             for i in range(nextFrame - currFrame):
                 BondLists.append(bondTcl)
+        intPairs = [(int(ii), int(jj)) for (ii, jj) in tsPairs]
+        gg_diffs = [([intPairs[k] for k in added], [intPairs[k] for k in removed]) for added, removed in ggDiffs]
 
-        return global_pairGraphs, gg_frames, BondLists
+        return global_pairGraphs, gg_frames, BondLists, gg_diffs
 
     def makeMoleculeGraphs(self):
         """
@@ -1014,9 +2109,9 @@ class Nanoreactor(Molecule):
 
         Returns
         -------
-        Isomers : list
-            List of unique isomers (molecular graphs). Two graphs are isomorphic if the atomic symbols and connectivities match.
-            The position of an isomer within this list is called the "isomer index".
+        Isomers : IsomerRegistry
+            List-like registry of unique isomers (molecular graphs). Two graphs are isomorphic if the atomic symbols
+            and connectivities match. The position of an isomer within this list is called the "isomer index".
             Each element in this list is a MyG instance containing the atomic symbols, connectivity, and atom numbers
             (the atom number are not so relevant because they are not part of the isomorphism)
 
@@ -1055,7 +2150,7 @@ class Nanoreactor(Molecule):
             be highlighted in the output visualization
         """
         # Initialize variables
-        Isomers = []
+        Isomers = IsomerRegistry()
         TimeSeries = OrderedDict()
         known_iidx = set()
         traj_midx = np.zeros((len(self), self.na), dtype='int')
@@ -1065,54 +2160,90 @@ class Nanoreactor(Molecule):
         # Sanity checking: Each entry in traj_midx should be set once and only once when looping over molecule IDs
         traj_midx -= 1
 
-        # Dictionary that aggregate isomers, used for optimization
-        isomer_ef_iidx_dict = defaultdict(list)
-
-        for igg, globalGraph in enumerate(self.global_graphs):
-            # Get "alive times" for this global graph
-            aliveIntvls = []
-            for ggFrame, (ggId, nextFrame) in list(self.gg_frames.items()):
-                if igg == ggId:
-                    aliveIntvls.append((ggFrame, nextFrame))
-            # Build the NetworkX graph object for this global graph and split it into
-            # connected subgraphs (molecules)
-            RawG = MyG()
-            for i, a in enumerate(self.elem):
-                RawG.add_node(i)
-                if parse_version(nx.__version__) >= parse_version('2.0'):
-                    nx.set_node_attributes(RawG, {i: a}, name='e')
-                else:
-                    nx.set_node_attributes(RawG, 'e', {i: a})
-            for (ii, jj) in globalGraph:
-                RawG.add_edge(ii, jj)
-            MolGphs = [RawG.subgraph(c).copy() for c in nx.connected_components(RawG)]
-            for G in MolGphs:
-                G.__class__ = MyG
-                ef = G.ef()
-                # iidx means Isomer Index. Compare to the Graph that has the same Empirical Formula
-                for i in isomer_ef_iidx_dict[ef]:
-                    if Isomers[i] == G:
-                        iidx = i
-                        break
-                else:
-                    iidx = len(Isomers)
-                    Isomers.append(G)
-                    isomer_ef_iidx_dict[ef].append(iidx)
+        # Dictionary that maps the exact atoms and bonds of a molecule graph to its isomer index,
+        # so that graphs that reappear (e.g. due to bond flickering) don't need isomorphism checks
+        subgraph_iidx_dict = {}
+        knownAll = 'ALL' in [i.upper() for i in self.KnownFormulas]
+
+        # The molecules are tracked incrementally by applying the bond changes between consecutive
+        # global graphs in chronological order.  Only the molecules containing an added or removed bond
+        # are split up or merged, and only these are assigned molecule IDs again.
+        # adjacency : Set of bonded atoms for each atom in the current global graph
+        # atom_comp : Key of the connected component (molecule) that contains each atom
+        # comp_atoms : Dictionary that maps component keys to sorted lists of atoms
+        # comp_alive : Dictionary that maps component keys to (molecule ID, frame where it appeared)
+        adjacency = [set() for i in range(self.na)]
+        atom_comp = list(range(self.na))
+        comp_atoms = OrderedDict([(i, [i]) for i in range(self.na)])
+        comp_alive = {}
+        comp_key = self.na
+
+        for (ggFrame, (igg, nextFrame)), (added, removed) in zip(list(self.gg_frames.items()), self.gg_diffs):
+            if ggFrame == 0:
+                touched = set(comp_atoms.keys())
+            else:
+                touched = set()
+            for (ii, jj) in removed:
+                adjacency[ii].discard(jj)
+                adjacency[jj].discard(ii)
+                touched.add(atom_comp[ii])
+            for (ii, jj) in added:
+                adjacency[ii].add(jj)
+                adjacency[jj].add(ii)
+                touched.add(atom_comp[ii])
+                touched.add(atom_comp[jj])
+            # Molecules that are changed by this global graph no longer exist; record their alive times
+            affected = []
+            for c in touched:
+                if c in comp_alive:
+                    molID, aliveFrame = comp_alive.pop(c)
+                    TimeSeries[molID]['raw_signal'][aliveFrame:ggFrame] = 1
+                affected += comp_atoms.pop(c)
+            # Split the affected atoms into connected components, ordered by their lowest atom number
+            visited = set()
+            for a in sorted(affected):
+                if a in visited: continue
+                visited.add(a)
+                stack = [a]
+                atoms = [a]
+                while stack:
+                    for b in adjacency[stack.pop()]:
+                        if b not in visited:
+                            visited.add(b)
+                            stack.append(b)
+                            atoms.append(b)
+                atoms.sort()
+                edges = tuple([(ii, jj) for ii in atoms for jj in sorted(adjacency[ii]) if jj > ii])
+                subkey = (tuple(atoms), edges)
+                if subkey not in subgraph_iidx_dict:
+                    # Build the NetworkX graph object for this molecule
+                    G = MyG()
+                    G.add_nodes_from([(i, {'e': self.elem[i]}) for i in atoms])
+                    G.add_edges_from(edges)
+                    # iidx means Isomer Index. Compare to the isomers that have the same graph hash
+                    iidx = Isomers.add(G)
+                    subgraph_iidx_dict[subkey] = (iidx, G)
+                iidx, G = subgraph_iidx_dict[subkey]
                 # Check if the empirical formula of this graph matches the known formulas provided by user
-                if (ef in self.KnownFormulas or wildmatch(ef, self.KnownFormulas) or (
-                        igg == 0 and 'ALL' in [i.upper() for i in self.KnownFormulas])):
+                ef = Isomers[iidx].ef()
+                if (ef in self.KnownFormulas or wildmatch(ef, self.KnownFormulas) or (igg == 0 and knownAll)):
                     known_iidx.add(iidx)
                 # Create the molecule ID and check if it's in the dictionary
-                molID = G.AStr() + ":%i" % iidx
+                molID = commadash(atoms) + ":%i" % iidx
                 if molID not in TimeSeries:
                     raw_signal = np.zeros(len(self), dtype=int)
                     # This line is very important: it creates the entry in the TimeSeries dictionary
                     # that is the main repository of information for molecular graphs.
                     TimeSeries[molID] = OrderedDict([('graph', G), ('iidx', iidx), ('midx', len(TimeSeries)),
                                                      ('raw_signal', raw_signal), ('stable_times', OrderedDict())])
-                else:
-                    raw_signal = TimeSeries[molID]['raw_signal']
-                for i, j in aliveIntvls: raw_signal[i:j] = 1
+                comp_atoms[comp_key] = atoms
+                comp_alive[comp_key] = (molID, ggFrame)
+                for i in atoms:
+                    atom_comp[i] = comp_key
+                comp_key += 1
+        # Record the alive times of the molecules that exist at the end of the trajectory
+        for molID, aliveFrame in list(comp_alive.values()):
+            TimeSeries[molID]['raw_signal'][aliveFrame:len(self)] = 1
 
         MolIDs = list(TimeSeries.keys())
 
@@ -1146,22 +2277,41 @@ class Nanoreactor(Molecule):
         return Isomers, MolIDs, TimeSeries, traj_iidx, traj_midx, traj_stable, known_iidx
 
     def makeWhole(self):
-        if not hasattr(self, 'boxes'): return
+        """
+        Make each molecule whole across the periodic boundaries and place its center inside the box,
+        modifying the coordinates in place.
+
+        The atoms of a molecule are unwrapped along its bonds in breadth-first order starting from
+        the lowest-numbered atom, each bonded atom being moved to the image closest to the atom it
+        is bonded to.  This is done for all frames in which the molecule exists at once.
+        (intended to be called by the constructor)
+        """
+        if self.pbcBoxes is None: return
+        xyz = self.xyz_array()
         for molID, ts in list(self.TimeSeries.items()):
-            frame = 0
+            frames = np.flatnonzero(ts['raw_signal'])
+            if len(frames) == 0: continue
             G = ts['graph']
             atoms = np.array(G.L())
-            for intvl, on_off in encode(ts['raw_signal']):
-                if on_off:
-                    for s in range(frame, frame + intvl):
-                        xdict = dict([(i, self.xyzs[s][i]) for i in atoms])
-                        if parse_version(nx.__version__) >= parse_version('2.0'):
-                            nx.set_node_attributes(G, xdict, 'x')
-                        else:
-                            nx.set_node_attributes(G, 'x', xdict)
-                        G.make_whole(self.boxes[s].a, self.boxes[s].b, self.boxes[s].c)
-                        self.xyzs[s][atoms] = np.array(G.x())
-                frame += intvl
+            index = dict([(a, i) for i, a in enumerate(atoms)])
+            # Group the bonds of a breadth-first traversal by the depth of the atom they lead to,
+            # so the atoms at each depth are unwrapped together
+            depth = {atoms[0]: 0}
+            levels = []
+            for a1, a2 in nx.bfs_edges(G, atoms[0]):
+                depth[a2] = depth[a1] + 1
+                if depth[a2] > len(levels):
+                    levels.append(([], []))
+                levels[depth[a2] - 1][0].append(index[a1])
+                levels[depth[a2] - 1][1].append(index[a2])
+            boxes = self.pbcBoxes[frames]
+            x = xyz[np.ix_(frames, atoms)]
+            for parents, children in levels:
+                x[:, children] -= lattice_translations(x[:, children] - x[:, parents], boxes)
+            # Move the center of the molecule into the box
+            x -= lattice_translations(x.mean(axis=1, keepdims=True), boxes, rounding=np.floor)
+            xyz[np.ix_(frames, atoms)] = x
+        self.xyzs = list(xyz)
 
     def allStable(self, frame, atoms, direction):
         """
@@ -1188,20 +2338,23 @@ class Nanoreactor(Molecule):
         """
         if direction not in [1, -1]:
             raise RuntimeError('Direction must be +1 or -1')
-        # Scan forward or backward until a new stable frame is found
+        # Jump forward or backward until a new stable frame is found.  Each jump goes to the
+        # furthest of the atoms' next (or previous) stable frames, until they coincide.
+        frame += direction
         while True:
-            frame += direction
-            # print "Scanning %s" % ("forward" if direction > 0 else "backward"), frame
             if frame <= 0:
                 frame = 0
-                # print "Scanned past start"
                 break
             if frame >= len(self) - 1:
-                # print "Scanned past end"
                 frame = len(self) - 1
                 break
-            if self.traj_stable[frame, atoms].all():
+            if direction > 0:
+                nextFrame = np.max(self.StableRuns.next_true(frame, atoms))
+            else:
+                nextFrame = np.min(self.StableRuns.prev_true(frame, atoms))
+            if nextFrame == frame:
                 break
+            frame = int(nextFrame)
         # The set of molecule indices that the atoms belong to at the new stable frame
         stable_midx = set(self.traj_midx[frame, atoms])
         # All of the atoms belonging to the above set of molecules
@@ -1316,23 +2469,18 @@ class Nanoreactor(Molecule):
         int, int
             The "padded" first and final frames of the reaction event
         """
-        midxMin = set(self.traj_midx[rxMin, atoms])
-        midxMax = set(self.traj_midx[rxMax, atoms])
         # Scan back in time until the "molecules of these atoms" are no longer stable
-        # or the molecule indices have changed.
-        for minPad in range(self.PadTime + 1):
-            if rxMin - minPad == 0: break
-            if not self.traj_stable[rxMin - minPad, atoms].all() or set(
-                    self.traj_midx[rxMin - minPad, atoms]) != midxMin:
-                minPad -= 1
-                break
-        # Scan forward in time, as above
-        for maxPad in range(self.PadTime + 1):
-            if rxMax + maxPad == 0: break
-            if not self.traj_stable[rxMax + maxPad, atoms].all() or set(
-                    self.traj_midx[rxMax + maxPad, atoms]) != midxMax:
-                maxPad -= 1
-                break
+        # or the molecule indices have changed.  The first frame is included without checking.
+        frames = np.arange(rxMin, max(rxMin - self.PadTime, 0) - 1, -1)
+        keep = (self.traj_stable[frames[:, np.newaxis], atoms].all(axis=1) &
+                (self.traj_midx[frames[:, np.newaxis], atoms] == self.traj_midx[rxMin, atoms]).all(axis=1))
+        keep[frames == 0] = True
+        minPad = int(np.argmin(keep)) - 1 if not keep.all() else len(frames) - 1
+        # Scan forward in time, as above (stopping at the last frame)
+        frames = np.arange(rxMax, min(rxMax + self.PadTime, len(self) - 1) + 1)
+        keep = (self.traj_stable[frames[:, np.newaxis], atoms].all(axis=1) &
+                (self.traj_midx[frames[:, np.newaxis], atoms] == self.traj_midx[rxMax, atoms]).all(axis=1))
+        maxPad = int(np.argmin(keep)) - 1 if not keep.all() else len(frames) - 1
         return rxMin - minPad, rxMax + maxPad
 
     def makeEvent(self, frame1, frame2, atoms):
@@ -1424,6 +2572,131 @@ class Nanoreactor(Molecule):
             print("Frames: %i-%i" % (frame1Pad, frame2Pad), "Molecule IDs: %s -> %s" % (molid1, molid2))
         return EventID, Event
 
+    def moleculeEvents(self, molNums):
+        """
+        Find the reaction events at the edges of the stable intervals of selected molecules.
+        (intended to be called by findReactionEvents(), possibly from a worker process)
+
+        Parameters
+        ----------
+        molNums : list
+            Indices of molecules in self.TimeSeries to be searched
+
+        Returns
+        -------
+        list
+            (EventID, Event) tuples in order of discovery; may contain duplicates
+        """
+        molItems = list(self.TimeSeries.items())
+        foundEvents = []
+        for molNum in molNums:
+            molID, ts = molItems[molNum]
+            if self.printlvl >= 2:
+                print("=============")
+                print("Molecule", molNum, molID, ts['graph'].ef())
+            atoms = np.array(ts['graph'].L())
+            for fstart, intvl in list(ts['stable_times'].items()):
+                fend = fstart + intvl - 1
+                if self.printlvl >= 2:
+                    print("Start Intvl End", fstart, intvl, fend)
+                if fstart > 0:
+                    # Look for reaction event that led to formation of this molecule
+                    rstart, rend, ratoms = self.completeEvent(fstart, atoms, -1)
+                    evid, event = self.makeEvent(rstart, rend, ratoms)
+                    if evid is not None:
+                        foundEvents.append((evid, event))
+                if fend < len(self) - 1:
+                    # Look for reaction event that led to destruction of this molecule
+                    rstart, rend, ratoms = self.completeEvent(fend, atoms, 1)
+                    evid, event = self.makeEvent(rstart, rend, ratoms)
+                    if evid is not None:
+                        foundEvents.append((evid, event))
+        return foundEvents
+
+    def parallelMoleculeEvents(self, molNums):
+        """
+        Distribute moleculeEvents() over a pool of self.nproc worker processes.
+
+        The workers are forked from this process, so they share the trajectory-level
+        arrays (traj_stable, traj_midx, coordinates) with it through copy-on-write
+        memory instead of receiving copies.  Only molecule indices are sent to the
+        workers and only the events are sent back.  Results are returned in the
+        same order as the serial search, so the output does not depend on nproc.
+
+        Parameters
+        ----------
+        molNums : list
+            Indices of molecules in self.TimeSeries to be searched
+
+        Returns
+        -------
+        list
+            (EventID, Event) tuples in the same order as moleculeEvents(molNums)
+        """
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            if self.printlvl >= 0:
+                print("Process forking is not available; searching for reaction events in serial")
+            return self.moleculeEvents(molNums)
+        # Build the molecule index for neutralization once so the workers inherit it
+        # (like the stability index self.StableRuns)
+        if self.neutralize and not hasattr(self, 'MolAtomPtr'):
+            self.indexMolecules()
+        # Several small chunks per worker to balance the load
+        nchunk = min(len(molNums), 8 * self.nproc)
+        chunks = [c.tolist() for c in np.array_split(molNums, nchunk)]
+        return list(itertools.chain(*self.forkMap(_molecule_events, chunks)))
+
+    def forkMap(self, func, items):
+        """
+        Map a module-level function over a list of items using a pool of
+        self.nproc worker processes forked from this process.
+
+        The function reaches this object through the module variable _shared_reactor,
+        which the forked workers inherit together with the trajectory data.
+        Falls back to a serial loop if process forking is not available.
+
+        Parameters
+        ----------
+        func : function
+            Module-level function taking one item as argument
+        items : list
+            Arguments to be passed to func; must be picklable
+
+        Returns
+        -------
+        list
+            Return values of func in the same order as items
+        """
+        global _shared_reactor
+        _shared_reactor = self
+        try:
+            if self.nproc == 1 or len(items) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+                return [func(item) for item in items]
+            pool = multiprocessing.get_context('fork').Pool(min(self.nproc, len(items)))
+            try:
+                return pool.map(func, items, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _shared_reactor = None
+
+    def writeOutputs(self, jobs):
+        """
+        Write a list of output files, in parallel if self.nproc > 1.
+
+        Parameters
+        ----------
+        jobs : list
+            (method name, argument tuple) pairs, where the method belongs to
+            this object and writes one or more files
+        """
+        if self.nproc > 1:
+            self.forkMap(_write_output, jobs)
+        else:
+            for method, args in jobs:
+                getattr(self, method)(*args)
+
     def findReactionEvents(self):
         """
         Top level function for finding reaction events.
@@ -1452,28 +2725,16 @@ class Nanoreactor(Molecule):
         """
 
         # The search for reaction events start at the edges of stable intervals
+        molNums = list(range(len(self.TimeSeries)))
+        if self.nproc > 1 and len(molNums) > 1:
+            foundEvents = self.parallelMoleculeEvents(molNums)
+        else:
+            foundEvents = self.moleculeEvents(molNums)
+        # Keep the first occurrence of each event in order of discovery
         unsortedEvents = {}
-        for molNum, (molID, ts) in enumerate(self.TimeSeries.items()):
-            if self.printlvl >= 2:
-                print("=============")
-                print("Molecule", molNum, molID, ts['graph'].ef())
-            atoms = np.array(ts['graph'].L())
-            for fstart, intvl in list(ts['stable_times'].items()):
-                fend = fstart + intvl - 1
-                if self.printlvl >= 2:
-                    print("Start Intvl End", fstart, intvl, fend)
-                if fstart > 0:
-                    # Look for reaction event that led to formation of this molecule
-                    rstart, rend, ratoms = self.completeEvent(fstart, atoms, -1)
-                    evid, event = self.makeEvent(rstart, rend, ratoms)
-                    if evid is not None and evid not in unsortedEvents:
-                        unsortedEvents[evid] = event
-                if fend < len(self) - 1:
-                    # Look for reaction event that led to destruction of this molecule
-                    rstart, rend, ratoms = self.completeEvent(fend, atoms, 1)
-                    evid, event = self.makeEvent(rstart, rend, ratoms)
-                    if evid is not None and evid not in unsortedEvents:
-                        unsortedEvents[evid] = event
+        for evid, event in foundEvents:
+            if evid not in unsortedEvents:
+                unsortedEvents[evid] = event
 
         sortkeys = []
         lookup = {}
@@ -1616,6 +2877,7 @@ class Nanoreactor(Molecule):
 
         # Save longest stable intervals to the 'isomers' folder
         if self.save_molecules:
+            jobs = []
             for key in sorted(sortKeys):
                 iidx = key[1]
                 IData = IsomerData[iidx]
@@ -1623,7 +2885,6 @@ class Nanoreactor(Molecule):
                     iintvl = np.argmax([s[1] for s in IData['stableIntervals']])
                     frame, intvl = IData['stableIntervals'][iintvl]
                     atoms = IData['stableIndices'][iintvl]
-                    traj_slice = self.atom_select(atoms)[frame:frame + intvl]
                     odir = 'molecules'
                     if not os.path.exists(odir): os.makedirs(odir)
                     fout = 'molecule_%03i.xyz' % nsave
@@ -1634,24 +2895,9 @@ class Nanoreactor(Molecule):
                     elif self.printlvl >= 1:
                         print("Writing isomer %i/%i, frames %i-%i to file %s : %s" % (
                             nsave + 1, nFound, frame, frame + intvl, fout, formula))
-                    traj_slice.comms = ["%s atoms %s frame %i charge %+.3f sz %+.3f sz^2 %.3f"
-                                        % (formula, commadash(atoms), f, sum(self.Charges[f][atoms]),
-                                           sum(self.Spins[f][atoms]), sum([j ** 2 for j in self.Spins[f][atoms]])) for f
-                                        in range(frame, frame + intvl)]
-                    if self.align:
-                        traj_slice.center()
-                        traj_slice.align()
-                    traj_slice.write(os.path.join(odir, fout))
-                    if self.have_pop:
-                        # Write .xyz-like file containing Mulliken charge and spin populations
-                        # in the first and second columns
-                        traj_slice_pop = deepcopy(traj_slice)
-                        pop_arr = np.zeros((len(traj_slice_pop), len(atoms), 3), dtype=float)
-                        pop_arr[:, :, 0] = self.Charges[frame:frame + intvl, atoms]
-                        pop_arr[:, :, 1] = self.Spins[frame:frame + intvl, atoms]
-                        traj_slice_pop.xyzs = list(pop_arr)
-                        traj_slice_pop.write(os.path.join(odir, fout.replace('.xyz', '.pop')), ftype='xyz')
+                    jobs.append(('writeMolecule', (frame, intvl, atoms, formula, os.path.join(odir, fout))))
                     nsave += 1
+            self.writeOutputs(jobs)
 
         # Return trajectory of VMD color indices for visualization.
         traj_color = np.zeros((len(self), self.na), dtype='int')
@@ -1669,6 +2915,43 @@ class Nanoreactor(Molecule):
         if (traj_color == -1).any(): raise RuntimeError('traj_color is not fully assigned')
         return IsomerData, traj_color
 
+    def writeMolecule(self, frame, intvl, atoms, formula, fout):
+        """
+        Write a stable interval of a single isomer to an .xyz file
+        and the charge and spin populations to a matching .pop file.
+
+        Parameters
+        ----------
+        frame : int
+            First frame of the interval
+        intvl : int
+            Number of frames in the interval
+        atoms : list
+            Atom indices of the molecule
+        formula : str
+            Empirical formula written to the comment lines
+        fout : str
+            Name of the .xyz file to be written
+        """
+        traj_slice = self.view(slice(frame, frame + intvl), atoms)
+        traj_slice.comms = ["%s atoms %s frame %i charge %+.3f sz %+.3f sz^2 %.3f"
+                            % (formula, commadash(atoms), f, sum(self.Charges[f][atoms]),
+                               sum(self.Spins[f][atoms]), sum([j ** 2 for j in self.Spins[f][atoms]])) for f
+                            in range(frame, frame + intvl)]
+        if self.align:
+            traj_slice.center()
+            traj_slice.align()
+        traj_slice.write(fout)
+        if self.have_pop:
+            # Write .xyz-like file containing Mulliken charge and spin populations
+            # in the first and second columns
+            traj_slice_pop = deepcopy(traj_slice)
+            pop_arr = np.zeros((len(traj_slice_pop), len(atoms), 3), dtype=float)
+            pop_arr[:, :, 0] = self.Charges[frame:frame + intvl, atoms]
+            pop_arr[:, :, 1] = self.Spins[frame:frame + intvl, atoms]
+            traj_slice_pop.xyzs = list(pop_arr)
+            traj_slice_pop.write(fout.replace('.xyz', '.pop'), ftype='xyz')
+
     def writeReactionEvents(self):
         """
         Write stored reaction events to files.
@@ -1704,6 +2987,8 @@ class Nanoreactor(Molecule):
             os.makedirs(odir)
         # This is a double loop, first over the unique reactant/product isomer indices,
         # then over all of the reaction events that match these isomer indices.
+        # The files are written afterwards, in parallel if nproc > 1.
+        jobs = []
         for iout in range(len(output_iidx)):
             repeat = 0
             subd = os.path.join(odir, 'reaction_%03i' % iout)
@@ -1715,81 +3000,174 @@ class Nanoreactor(Molecule):
                         fout = 'reaction_%03i.xyz' % iout
                     else:
                         fout = 'reaction_%03i_%02i.xyz' % (iout, repeat)
-                    # Figure out the first and last frame by parsing the event ID
-                    fstart, fend = self.Events[evid]['frames']  # [int(i) for i in evid.split(':')[0].split('-')]
-                    atoms = self.Events[evid]['atoms']  # np.array(uncommadash(evid.split(':')[1]))
-                    traj_slice = self.atom_select(atoms)[fstart:fend + 1]
                     if self.printlvl >= 2:
-                        print(
-                            "Writing event ID %s, number %i, frames %i-%i to file %s" % (evid, iev, fstart, fend, fout))
+                        print("Writing event ID %s, number %i, frames %i-%i to file %s" % (
+                            evid, iev, event['frames'][0], event['frames'][1], fout))
                     elif self.printlvl >= 1:
                         print("Writing event number %i/%i, frames %i-%i to file %s : %s" % (
-                            iev + 1, len(self.Events), fstart, fend, fout, self.Events[evid]['equation']))
-                    a = event['atoms']
-                    traj_slice.comms = ["%s atoms %s frame %i charge %+.3f sz %+.3f sz^2 %.3f"
-                                        % (event['equation'], commadash(a), f, sum(self.Charges[f][a]),
-                                           sum(self.Spins[f][a]), sum([j ** 2 for j in self.Spins[f][a]])) for f in
-                                        range(fstart, fend + 1)]
-                    if self.align:
-                        traj_slice.center()
-                        traj_slice.align()
-                    traj_slice.write(os.path.join(subd, fout))
-                    if self.have_pop:
-                        # Write .xyz-like file containing Mulliken charge and spin populations
-                        # in the first and second columns
-                        traj_slice_pop = deepcopy(traj_slice)
-                        pop_arr = np.zeros((len(traj_slice_pop), len(atoms), 3), dtype=float)
-                        pop_arr[:, :, 0] = self.Charges[fstart:fend + 1, atoms]
-                        pop_arr[:, :, 1] = self.Spins[fstart:fend + 1, atoms]
-                        traj_slice_pop.xyzs = list(pop_arr)
-                        traj_slice_pop.write(os.path.join(subd, fout.replace('.xyz', '.pop')), ftype='xyz')
+                            iev + 1, len(self.Events), event['frames'][0], event['frames'][1], fout,
+                            event['equation']))
+                    jobs.append(('writeEvent', (event, os.path.join(subd, fout))))
                     repeat += 1
+        self.writeOutputs(jobs)
+
+    def writeEvent(self, event, fout, offset=0):
+        """
+        Write the trajectory of a single reaction event to an .xyz file
+        and the charge and spin populations to a matching .pop file.
+
+        Parameters
+        ----------
+        event : dict
+            Reaction event as stored in self.Events
+        fout : str
+            Name of the .xyz file to be written
+        offset : int
+            Added to the frame numbers in the comment lines, for when this
+            object only contains a window of a longer trajectory
+        """
+        # Figure out the first and last frame by parsing the event ID
+        fstart, fend = event['frames']  # [int(i) for i in evid.split(':')[0].split('-')]
+        atoms = event['atoms']  # np.array(uncommadash(evid.split(':')[1]))
+        traj_slice = self.view(slice(fstart, fend + 1), atoms)
+        a = event['atoms']
+        traj_slice.comms = ["%s atoms %s frame %i charge %+.3f sz %+.3f sz^2 %.3f"
+                            % (event['equation'], commadash(a), f + offset, sum(self.Charges[f][a]),
+                               sum(self.Spins[f][a]), sum([j ** 2 for j in self.Spins[f][a]])) for f in
+                            range(fstart, fend + 1)]
+        if self.align:
+            traj_slice.center()
+            traj_slice.align()
+        traj_slice.write(fout)
+        if self.have_pop:
+            # Write .xyz-like file containing Mulliken charge and spin populations
+            # in the first and second columns
+            traj_slice_pop = deepcopy(traj_slice)
+            pop_arr = np.zeros((len(traj_slice_pop), len(atoms), 3), dtype=float)
+            pop_arr[:, :, 0] = self.Charges[fstart:fend + 1, atoms]
+            pop_arr[:, :, 1] = self.Spins[fstart:fend + 1, atoms]
+            traj_slice_pop.xyzs = list(pop_arr)
+            traj_slice_pop.write(fout.replace('.xyz', '.pop'), ftype='xyz')
 
     def WriteChargeSpinLabels(self):
         """
         Write charge and spin labels to charge.dat and spin.dat for use in VMD visualization.
         """
+        ChargeLines, SpinLines = self.chargeSpinLabels()
+        write_frame_records('charge.dat', frame_records(ChargeLines), len(self))
+        write_frame_records('spin.dat', frame_records(SpinLines), len(self))
+
+    def chargeSpinLabels(self):
+        """
+        Build the charge and spin labels for each frame, as written to charge.dat and spin.dat.
+
+        A charge label is written for each recorded molecule with a net charge of at least
+        the threshold, e.g. "100 101 102! 103, +0.25;" which contains the atoms in the molecule,
+        the net charge, and the atom with the greatest charge marked by an exclamation point.
+        A spin label "atom spin" is written for each atom with a spin population of at least the threshold.
+
+        Returns
+        -------
+        ChargeLines : list
+            Line of charge labels for each frame
+        SpinLines : list
+            Line of spin labels for each frame
+        """
         # LPW 2019-03-04 Increasing threshold to 0.25 de-clutters visualization
         Threshold = 0.25
-        ChargeLabels = [[] for i in range(self.ns)]
-        # print self.Recorded
-        RecSeries = {}
+        ChargeLabels = [[] for i in range(len(self))]
         for molID, ts in list(self.TimeSeries.items()):  # Loop over graph IDs and time series
-            if ts['iidx'] in self.Recorded:
-                RecSeries[molID] = ts
-
-        for molID, ts in list(RecSeries.items()):
+            if ts['iidx'] not in self.Recorded: continue
             idx = np.array(ts['graph'].L())
-            decoded = decode(ts['raw_signal'])
-            for i in range(self.ns):
-                if decoded[i]:
-                    ChgArr = np.array(self.Charges[i][idx])
-                    SumChg = sum(ChgArr)
-                    # AtomLabel = idx[np.argmax(ChgArr*np.sign(SumChg))]
-                    AtomLabel = idx
-                    MaxIdx = idx[np.argmax(ChgArr * np.sign(SumChg))]
-                    if abs(SumChg) >= Threshold:
-                        AtomChgTuple = (AtomLabel, "%+.2f" % SumChg, MaxIdx)
-                        ChargeLabels[i].append(AtomChgTuple)
-
-        qout = open('charge.dat', 'w')
-        for Label in ChargeLabels:
-            for AtomChgTuple in Label:
-                # This generates a string like 100 101 102! 103, 0.25; which indicates the atoms in a molecule, the net charge on that molecule, and the atom
-                # with the greatest charge marked by an exclamation point
-                print("%s, %s;" % (
-                    ' '.join(["%i%s" % (i, "!" if i == AtomChgTuple[2] else "") for i in AtomChgTuple[0]]),
-                    AtomChgTuple[1]), end=' ', file=qout)
-            print(file=qout)
+            frames = np.nonzero(decode(ts['raw_signal']))[0]
+            ChgArr = np.asarray(self.Charges)[frames][:, idx]
+            # Accumulate the atomic charges in order so the sums are the same as sum(ChgArr[i])
+            SumChg = ChgArr[:, 0].astype(float)
+            for k in range(1, len(idx)):
+                SumChg += ChgArr[:, k]
+            MaxIdx = idx[np.argmax(ChgArr * np.sign(SumChg)[:, np.newaxis], axis=1)]
+            AtomLabels = {}
+            for i in np.nonzero(np.abs(SumChg) >= Threshold)[0]:
+                maxIdx = MaxIdx[i]
+                if maxIdx not in AtomLabels:
+                    AtomLabels[maxIdx] = ' '.join(["%i%s" % (j, "!" if j == maxIdx else "") for j in idx])
+                ChargeLabels[frames[i]].append("%s, %+.2f; " % (AtomLabels[maxIdx], SumChg[i]))
+        ChargeLines = [''.join(Labels) for Labels in ChargeLabels]
+
+        Spins = np.asarray(self.Spins)
+        frames, atoms = np.nonzero(np.abs(Spins) >= Threshold)
+        SpinLabels = ["%i %+.2f " % (a, s) for a, s in zip(atoms.tolist(), Spins[frames, atoms].tolist())]
+        bounds = np.searchsorted(frames, np.arange(len(self) + 1))
+        SpinLines = [''.join(SpinLabels[bounds[i]:bounds[i + 1]]) for i in range(len(self))]
+        return ChargeLines, SpinLines
+
+    def colorRecords(self):
+        """
+        Return the atom colors as (frame, line) records for the frames where any color changes,
+        where the line contains the space-separated VMD color index of each atom (see frame_records).
+        """
+        changed = np.nonzero(np.any(self.traj_color[1:] != self.traj_color[:-1], axis=1))[0] + 1
+        return [(f, ' '.join(map(str, self.traj_color[f].tolist()))) for f in [0] + changed.tolist()]
 
-        Threshold = 0.25
-        sout = open('spin.dat', 'w')
-        for i in range(self.ns):
-            for a in range(self.na):
-                if abs(self.Spins[i][a]) >= Threshold:
-                    print("%i %+.2f" % (a, self.Spins[i][a]), end=' ', file=sout)
-            print(file=sout)
-        qout.close()
+    def bondRecords(self):
+        """
+        Return the bonds as (frame, line) records for the frames where the global graph changes,
+        where the line contains the bond partners of each atom in VMD format (see bondlist_tcl).
+        """
+        return [(frame, self.BondLists[frame]) for frame in self.gg_frames.keys()]
+
+    def writeVisualization(self):
+        """
+        Write the frame-by-frame atom colors, bonds, charge labels and spin labels for bin/reactions.vmd.
+
+        Depending on self.vizFormat, these are written as text files with one line per frame
+        (color.dat, bonds.dat, charge.dat, spin.dat), as run-length encoded binary files containing
+        only the frames where the data changes (color.bin, bonds.bin, charge.bin, spin.bin), or both.
+        """
+        ChargeLines, SpinLines = self.chargeSpinLabels()
+        Records = OrderedDict([('color', self.colorRecords()), ('bonds', self.bondRecords()),
+                               ('charge', frame_records(ChargeLines)), ('spin', frame_records(SpinLines))])
+        for name, records in Records.items():
+            if self.vizFormat in ('text', 'both'):
+                write_frame_records(name + '.dat', records, len(self))
+            if self.vizFormat in ('binary', 'both'):
+                write_runlength(name + '.bin', records, self.na)
+
+    def indexMolecules(self):
+        """
+        Index the atoms of the molecules in self.TimeSeries, so that quantities of many molecules
+        can be gathered at once (see moleculeAtoms).  Sets self.MolAtomIdx (the atoms of all molecules
+        concatenated in molecule index order), self.MolAtomPtr (the position of the first atom of each
+        molecule in MolAtomIdx, plus the total number of atoms at the end) and self.MolProtons
+        (the number of protons in each molecule).
+        """
+        molAtoms = [ts['graph'].L() for ts in self.TimeSeries.values()]
+        self.MolAtomPtr = np.zeros(len(molAtoms) + 1, dtype=int)
+        self.MolAtomPtr[1:] = np.cumsum([len(a) for a in molAtoms])
+        self.MolAtomIdx = np.array(list(itertools.chain(*molAtoms)), dtype=int)
+        self.MolProtons = np.array([sum([Elements.index(self.elem[i]) for i in a]) for a in molAtoms], dtype=int)
+
+    def moleculeAtoms(self, midx):
+        """
+        Return the atoms of a list of molecules, concatenated.
+
+        Parameters
+        ----------
+        midx : np.ndarray
+            Molecule indices
+
+        Returns
+        -------
+        atoms : np.ndarray
+            Atoms of the molecules, concatenated in the order of midx
+        start : np.ndarray
+            Position of the first atom of each molecule in atoms (as used by np.add.reduceat)
+        """
+        counts = self.MolAtomPtr[midx + 1] - self.MolAtomPtr[midx]
+        start = np.zeros(len(midx), dtype=int)
+        start[1:] = np.cumsum(counts)[:-1]
+        atoms = self.MolAtomIdx[np.repeat(self.MolAtomPtr[midx] - start, counts) + np.arange(counts.sum())]
+        return atoms, start
 
     def getNeutralizing(self, frame1, frame2, atoms, tol=0.25):
         """
@@ -1826,52 +3204,77 @@ class Nanoreactor(Molecule):
             return [], []
         if self.printlvl >= 2: print(
             "Attempting to neutralize atoms %s (charge %+.3f spin %+.3f)" % (commadash(atoms), chg, spn))
-        xyz = np.array(self.atom_select(atoms)[frames].xyzs)
+        if not hasattr(self, 'MolAtomPtr'):
+            self.indexMolecules()
+
+        # Candidate molecules must exist for ALL frames in the frame selection and must not overlap
+        # with ANY atoms in our atom selection.  The molecules that exist in the first frame are read off
+        # traj_midx, and each of them exists in all frames if it owns its first atom in all frames.
+        cand = np.unique(self.traj_midx[frame1])
+        cand = cand[(self.traj_midx[frame1:frame2 + 1][:, self.MolAtomIdx[self.MolAtomPtr[cand]]] == cand).all(axis=0)]
+        cand = cand[~np.isin(cand, self.traj_midx[frame1, atoms])]
+        # Charge and spin time series of each candidate, summed over its atoms
+        c_sel, c_start = self.moleculeAtoms(cand)
+        if len(cand) > 0:
+            c_chgs = np.add.reduceat(self.Charges[frame1:frame2 + 1][:, c_sel], c_start, axis=1)
+            c_spns = np.add.reduceat(self.Spins[frame1:frame2 + 1][:, c_sel], c_start, axis=1)
+        else:
+            c_chgs = c_spns = np.zeros((len(frames), 0))
+        c_chg = np.ascontiguousarray(c_chgs.T).mean(axis=1)
+        # The molecule must have a large enough charge/spin of the correct sign to neutralize the original atoms
+        keep = np.flatnonzero((np.abs(c_chg) > tol / 2) & (c_chg * chg < 0))
+        cand, c_chgs, c_spns = cand[keep], c_chgs[:, keep], c_spns[:, keep]
+        c_sel, c_start = self.moleculeAtoms(cand)
+
+        # Candidates are considered in order of increasing maximum distance of closest contact
+        # with the atom selection over the frames.  Computing the closest contacts for every candidate
+        # is expensive, so the candidates are ranked lazily: a lower bound of the maximum distance comes from
+        # the centroid distances minus the radii of the atom selection and the candidates, and the exact distance
+        # is computed only when the candidate reaches the front of the queue.
+        queue = []
+        if len(cand) > 0:
+            xyz = self.view(frames, atoms).xyz_array()
+            c_xyz = self.view(frames, c_sel).xyz_array()
+            c_counts = np.diff(np.append(c_start, len(c_sel)))
+            cen = xyz.mean(axis=1)
+            rad = np.sqrt(((xyz - cen[:, np.newaxis, :]) ** 2).sum(axis=2)).max(axis=1)
+            c_cen = np.add.reduceat(c_xyz, c_start, axis=1) / c_counts[np.newaxis, :, np.newaxis]
+            c_rad = np.maximum.reduceat(np.sqrt(((c_xyz - np.repeat(c_cen, c_counts, axis=1)) ** 2).sum(axis=2)),
+                                        c_start, axis=1)
+            c_dist = np.sqrt(((c_cen - cen[:, np.newaxis, :]) ** 2).sum(axis=2))
+            bound = (c_dist - c_rad - rad[:, np.newaxis]).max(axis=0)
+            queue = [(bound[i], i, False) for i in range(len(cand))]
+            heapq.heapify(queue)
+
+        def ranked():
+            while queue:
+                dist, i, exact = heapq.heappop(queue)
+                if exact:
+                    yield i
+                else:
+                    # Closest contact time series from the squared distance matrix of all atom pairs
+                    block = c_xyz[:, c_start[i]:c_start[i] + c_counts[i]]
+                    sq_dmat = ((xyz[:, :, np.newaxis, :] - block[:, np.newaxis, :, :]) ** 2).sum(axis=3)
+                    c_contact = np.min(sq_dmat, axis=(1, 2)) ** 0.5
+                    heapq.heappush(queue, (max(c_contact), i, True))
 
-        # Ordered dictionary of candidate molecules to be added to the list
-        Candidates = OrderedDict()
-        Candidate = namedtuple('Candidate', ['mindx', 'maxdx', 'chg', 'spn'])
-        # Loop over all molecules in the time series
-        for molID, ts in list(self.TimeSeries.items()):
-            # Check to make sure that this molecule exists for ALL frames in the frame selection
-            # and does not overlap with ANY atoms in our atom selection.
-            if set(ts['graph'].L()).intersection(set(atoms)): continue
-            if not ts['raw_signal'][frames].all(): continue
-            # List of atoms in this molecule
-            c_atoms = ts['graph'].L()
-            c_chg = np.mean(np.sum(self.Charges[frame1:frame2 + 1, c_atoms], axis=1))
-            c_spn = np.mean(np.sum(self.Spins[frame1:frame2 + 1, c_atoms], axis=1))
-            # The molecule must have a large enough charge/spin of the correct sign to neutralize the original atoms
-            if np.abs(c_chg) > tol / 2 and c_chg * chg < 0:
-                c_xyz = np.array(self.atom_select(c_atoms)[frames].xyzs)
-                # Get the squared distance matrix for every charged molecule with opposite sign
-                sq_dmat = np.zeros((xyz.shape[1], c_xyz.shape[1], len(frames)))
-                for a in range(xyz.shape[1]):
-                    for b in range(c_xyz.shape[1]):
-                        sq_dmat[a, b, :] = np.sum((xyz[:, a, :] - c_xyz[:, b, :]) ** 2, axis=1)
-                # Build a closest contact time series
-                c_contact = np.array(np.min(sq_dmat, axis=(0, 1))) ** 0.5
-                # Record the closest that the molecule got, and how far it drifted away
-                Candidates[molID] = Candidate(min(c_contact), max(c_contact), c_chg, c_spn)
-
-        # Now loop over all candidates in order of increasing closest contact distance
-        molID_sorted_maxdist = [list(Candidates.keys())[i] for i in
-                                np.argsort([c.maxdx for c in list(Candidates.values())])]
         keep_molID = []
+        keep_cand = []
         success = False
         curr_chg = chg
         curr_spn = spn
+        chgs = np.sum(self.Charges[frame1:frame2 + 1, atoms], axis=1)
+        spns = np.sum(self.Spins[frame1:frame2 + 1, atoms], axis=1)
+        nprot0 = sum([Elements.index(self.elem[j]) for j in atoms])
         limit = 3
-        for molID in molID_sorted_maxdist:
+        for i in ranked():
             valid = False
+            molID = self.MolIDs[cand[i]]
             formula = self.TimeSeries[molID]['graph'].ef()
-            c_atoms = self.TimeSeries[molID]['graph'].L()
-            keep_atoms = list(itertools.chain(*[self.TimeSeries[m]['graph'].L() for m in keep_molID]))
-            new_atoms = sorted(c_atoms + keep_atoms + list(atoms))
-            new_chg = np.mean(np.sum(self.Charges[frame1:frame2 + 1, new_atoms], axis=1))
-            new_spn = np.mean(np.sum(self.Spins[frame1:frame2 + 1, new_atoms], axis=1))
+            new_chg = np.mean(chgs + c_chgs[:, i])
+            new_spn = np.mean(spns + c_spns[:, i])
             # Check for charge and spin consistency.
-            nprot = sum([Elements.index(i) for i in [self.elem[j] for j in new_atoms]])
+            nprot = nprot0 + sum([self.MolProtons[cand[k]] for k in keep_cand + [i]])
             nelec = int(nprot + round(new_chg))
             nspin = int(round(new_spn))
             # The number of electrons should be odd iff the spin is odd.
@@ -1892,6 +3295,9 @@ class Nanoreactor(Molecule):
                 curr_spn = new_spn
                 valid = True
                 keep_molID.append(molID)
+                keep_cand.append(i)
+                chgs = chgs + c_chgs[:, i]
+                spns = spns + c_spns[:, i]
             if valid and abs(new_chg) < tol:
                 success = True
                 break
@@ -1909,7 +3315,7 @@ class Nanoreactor(Molecule):
         return keep_molID, success
 
     def writeColors(self):
-        ColorNow = [-1 for i in range(self.na)]
+        ColorNow = np.full(self.na, -1)
         # Print header stuff
         header = """axes location Off
 display rendermode GLSL
@@ -1949,19 +3355,14 @@ mol modstyle %i 0 VDW 0.150000 27.000000
             print("display resetview", file=self.moviefile)
             print("display height 4.0", file=self.moviefile)
             print("rotate y by %.1f" % ((0.1 * renderf) % 360), file=self.moviefile)
-            for an, color in enumerate(ColorByAtom):
-                if an + 1 != ColorByAtom.size:
-                    print(color, end=" ", file=self.colortab)
+            for an in np.nonzero(ColorByAtom != ColorNow)[0]:
+                color = ColorByAtom[an]
+                print("mol modcolor %i 0 ColorID %i" % (an, color), file=self.moviefile)
+                if color == 8:
+                    print("mol modmaterial %i 0 Ghost" % an, file=self.moviefile)
                 else:
-                    print(color, end="", file=self.colortab)
-                if ColorNow[an] != color:
-                    ColorNow[an] = color
-                    print("mol modcolor %i 0 ColorID %i" % (an, color), file=self.moviefile)
-                    if color == 8:
-                        print("mol modmaterial %i 0 Ghost" % an, file=self.moviefile)
-                    else:
-                        print("mol modmaterial %i 0 Transparent" % an, file=self.moviefile)
-            print(file=self.colortab)
+                    print("mol modmaterial %i 0 Transparent" % an, file=self.moviefile)
+            ColorNow = ColorByAtom
             if self.Render:
                 print("render snapshot frame%04i.tga" % renderf, file=self.moviefile)
             renderf += 1
@@ -1969,12 +3370,9 @@ mol modstyle %i 0 VDW 0.150000 27.000000
     def Output(self):
         # Print final data to file.
         self.moviefile = open('/dev/null', 'w')
-        self.colortab = open('color.dat', 'w')
-        self.writeColors()
-        self.writeReactionEvents()
+        self.runStage(self.writeColors)
+        self.runStage(self.writeReactionEvents)
         # self.GetReactions()
-        with open('bonds.dat', 'w') as bondtab:
-            bondtab.write('\n'.join(self.BondLists) + '\n')
-        self.WriteChargeSpinLabels()
-        if hasattr(self, 'boxes'):
-            self.write('whole.xyz')
+        self.runStage(self.writeVisualization)
+        if self.pbcBoxes is not None:
+            self.runStage(self.write, 'whole.xyz')
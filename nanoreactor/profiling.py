@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is not reported
+    resource = None
+
+
+def rss_mb():
+    """
+    Return the current and peak resident set size of this process in MB.
+    Either value is None if it cannot be determined on this platform.
+    """
+    current, peak = None, None
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0 ** 20
+    if resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / 2.0 ** 20 if os.uname()[0] == 'Darwin' else maxrss / 2.0 ** 10
+        if current is not None:
+            # The two sources are sampled differently and may disagree slightly
+            peak = max(peak, current)
+    return current, peak
+
+
+class StageProfiler(object):
+    """
+    Record the resource usage of each stage of an analysis as one line of JSON per stage.
+
+    Each record contains the stage name, wall and CPU time (including child processes that
+    have finished, such as worker pools), current and peak resident set size, and the counts
+    returned by the optional counts function.  Optionally, the records also contain the
+    memory allocated during the stage and its largest allocation sites as measured by tracemalloc,
+    and the stages are run under cProfile with the statistics written to a file.
+    """
+
+    def __init__(self, fnm=None, memtop=0, cprofile=None, counts=None):
+        """
+        Parameters
+        ----------
+        fnm : str, optional
+            JSON lines file to which the records are appended; if None, no records are written
+        memtop : int
+            Number of largest allocation sites to record; if nonzero, tracemalloc is started,
+            which slows down the analysis
+        cprofile : str, optional
+            File to which the cProfile statistics of all stages so far are written after each stage,
+            for reading with the pstats module or a viewer such as snakeviz
+        counts : function, optional
+            Function returning a dictionary of counts (e.g. number of frames or events)
+            to be included in each record
+        """
+        self.fnm = fnm
+        self.memtop = memtop
+        self.cprofile = cprofile
+        self.counts = counts
+        self.profile = cProfile.Profile() if cprofile is not None else None
+        if self.memtop > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def run(self, stage, func, *args, **kwargs):
+        """
+        Call a function and record the resource usage of the call.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage in the record
+        func : function or method
+            The function that's being profiled
+        *args, **kwargs :
+            Positional and keyword arguments expected by the function
+
+        Returns
+        -------
+        Return value of the function
+        """
+        tracing = tracemalloc.is_tracing() and self.memtop > 0
+        if tracing:
+            traced0 = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.time()
+        t0 = time.perf_counter()
+        c0 = os.times()
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            ret = func(*args, **kwargs)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+        c1 = os.times()
+        record = OrderedDict()
+        record['stage'] = stage
+        record['start'] = start
+        record['wall'] = time.perf_counter() - t0
+        record['cpu'] = sum(c1[:4]) - sum(c0[:4])
+        record['rss_mb'], record['peak_rss_mb'] = rss_mb()
+        if tracing:
+            traced, peak = tracemalloc.get_traced_memory()
+            record['traced_mb'] = (traced - traced0) / 2.0 ** 20
+            record['traced_peak_mb'] = (peak - traced0) / 2.0 ** 20
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:self.memtop]
+            record['top'] = [OrderedDict([('where', '%s:%i' % (s.traceback[0].filename, s.traceback[0].lineno)),
+                                          ('size_mb', s.size / 2.0 ** 20), ('count', s.count)]) for s in stats]
+        if self.counts is not None:
+            record['counts'] = self.counts()
+        if self.fnm is not None:
+            with open(self.fnm, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.profile is not None:
+            self.profile.dump_stats(self.cprofile)
+        return ret
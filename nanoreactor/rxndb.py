@@ -5,11 +5,17 @@
 # ===========================================#
 
 # json is used for saving dictionaries to file.
+import atexit
+import hashlib
+import heapq
 import json
 import os
 import shutil
+import sqlite3
+import subprocess
+import tarfile
 import time
-from collections import Counter, OrderedDict
+from collections import Counter, OrderedDict, deque
 from copy import deepcopy
 
 import numpy as np
@@ -28,6 +34,14 @@ except:
 
 # Global variable for the Work Queue
 WQ = None
+# Global variable for the result cache
+CACHE = None
+# Global variable for the calculation status database
+STATUSDB = None
+# Number of submitted tasks that have not finished, for each stage (calctype) of the workflow
+STAGES = Counter()
+# Global variable for batching geometry optimizations
+BATCH = None
 
 
 def create_work_queue(port):
@@ -45,6 +59,517 @@ def create_work_queue(port):
     logger.info('Work Queue listening on %d' % (WQ.port))
 
 
+class LocalTask(object):
+    """
+    A task to be run by LocalQueue, with the same interface as the parts of work_queue.Task used here.
+    """
+
+    def __init__(self, command, cwd):
+        self.command = command
+        self.cwd = cwd
+        self.tag = command
+        self.priority = 0
+        self.id = None
+        self.hostname = 'localhost'
+        # Set when the task is finished; result is nonzero if the command could not be run,
+        # and return_status is the exit code of the command
+        self.result = None
+        self.return_status = None
+        # Execution time in microseconds
+        self.cmd_execution_time = 0
+
+    def specify_priority(self, priority):
+        self.priority = priority
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+    def specify_input_file(self, *args, **kwargs):
+        # The command runs in the working directory, so files are used in place
+        pass
+
+    def specify_output_file(self, *args, **kwargs):
+        pass
+
+
+class LocalQueueStats(object):
+    """ Counters with the same names as work_queue.WorkQueue.stats. """
+
+    def __init__(self, workers):
+        self.workers_busy = 0
+        self.total_workers_joined = workers
+        self.total_workers_removed = 0
+        self.total_tasks_complete = 0
+        self.total_tasks_dispatched = 0
+
+
+class LocalQueue(object):
+    """
+    Runs tasks as processes on the local machine, with the same interface as the parts of
+    work_queue.WorkQueue used in make_task and wq_reactor (submit, wait, empty and stats).
+
+    Up to (workers) tasks run at the same time, the ones with the highest priority first
+    (first-in first-out for equal priorities).  Each task gets (cores) threads
+    through the OMP_NUM_THREADS environment variable.
+    """
+
+    def __init__(self, workers=None, cores=None):
+        """
+        Parameters
+        ----------
+        workers : int, optional
+            Maximum number of tasks that run at the same time;
+            by default, the number of CPU cores divided by (cores)
+        cores : int, optional
+            Number of cores of each task; by default, taken from OMP_NUM_THREADS or 1
+        """
+        self.cores = cores if cores else int(os.environ.get('OMP_NUM_THREADS', 1))
+        self.workers = workers if workers else max(1, (os.cpu_count() or 1) // self.cores)
+        self.stats = LocalQueueStats(self.workers)
+        # Heap of (-priority, task id, task) waiting to run
+        self.pending = []
+        # Running processes mapped to (task, start time)
+        self.running = OrderedDict()
+        # Finished tasks not yet returned by wait()
+        self.finished = deque()
+        self.next_id = 1
+
+    def submit(self, task):
+        task.id = self.next_id
+        self.next_id += 1
+        heapq.heappush(self.pending, (-task.priority, task.id, task))
+        return task.id
+
+    def empty(self):
+        return not (self.pending or self.running or self.finished)
+
+    def start(self):
+        """ Start the highest priority tasks while there are free workers. """
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.cores))
+        while self.pending and len(self.running) < self.workers:
+            task = heapq.heappop(self.pending)[2]
+            logger.info("Starting local task '%s' (id %i) in %s" % (task.tag, task.id, task.cwd), printlvl=3)
+            try:
+                # The commands use bash syntax such as &> for redirection
+                proc = subprocess.Popen(task.command, shell=True, executable='/bin/bash', cwd=task.cwd, env=env,
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logger.warning("Failed to start local task '%s': %s" % (task.tag, e))
+                # Report the task as run with a failing exit status (like a missing command in the shell),
+                # so the calculation handles the missing results instead of the task being resubmitted forever.
+                task.result = 0
+                task.return_status = 127
+                task.cmd_execution_time = 0
+                self.stats.total_tasks_dispatched += 1
+                self.stats.total_tasks_complete += 1
+                self.finished.append(task)
+                continue
+            self.running[proc] = (task, time.time())
+            self.stats.total_tasks_dispatched += 1
+        self.stats.workers_busy = len(self.running)
+
+    def wait(self, timeout):
+        """
+        Wait up to (timeout) seconds for a task to finish, starting waiting tasks as workers become free.
+
+        Returns
+        -------
+        LocalTask or None
+            A finished task, or None if no task finished within the timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            for proc, (task, start) in list(self.running.items()):
+                if proc.poll() is not None:
+                    del self.running[proc]
+                    task.result = 0
+                    task.return_status = proc.returncode
+                    task.cmd_execution_time = int((time.time() - start) * 1e6)
+                    self.stats.total_tasks_complete += 1
+                    self.finished.append(task)
+            self.start()
+            if self.finished:
+                return self.finished.popleft()
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.running:
+                return None
+            time.sleep(min(0.1, remaining))
+
+
+def create_local_queue(workers=None):
+    """
+    Run the calculations on the local machine, up to (workers) at a time (see LocalQueue).
+    The queue takes the place of the Work Queue, so the calculations are run by wq_reactor.
+    """
+    global WQ
+    WQ = LocalQueue(workers)
+    logger.info('Running up to %i calculations at a time on this machine, %i cores each' % (WQ.workers, WQ.cores))
+
+
+class ResultCache(object):
+    """
+    Content-addressed store of calculation results shared between trajectories and runs.
+
+    Each task is identified by a hash of its command (which contains the method, basis set,
+    charge and multiplicity) and its input files; the geometries in .xyz inputs are
+    canonicalized to the elements and the coordinates rounded to the tolerance, so the same
+    structure written out by different trajectories gives the same key.  The output files of
+    successful tasks are stored in (root)/ab/abcdef.../ and copied into the working
+    directory when the same task is submitted again.
+    """
+
+    def __init__(self, root, tol=1e-4):
+        """
+        Parameters
+        ----------
+        root : str
+            Folder containing the stored results; it may be shared by several runs
+        tol : float
+            Coordinates are rounded to this precision (in Angstrom) before hashing
+        """
+        self.root = os.path.abspath(root)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.tol = tol
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def key(self, cmd, cwd, inputs):
+        """
+        Return the hash of a task, or None if the task can't be cached because it reads
+        no declared input files (its results would depend on files not in the key).
+        """
+        if len(inputs) == 0:
+            return None
+        sha = hashlib.sha256(cmd.encode('utf-8'))
+        for f in inputs:
+            path = os.path.join(cwd, f)
+            if not os.path.exists(path):
+                return None
+            sha.update(('\n%s\n' % f).encode('utf-8'))
+            if f.endswith('.xyz'):
+                # Comments and formatting of the coordinates are ignored
+                M = Molecule(path)
+                sha.update(' '.join(M.elem).encode('utf-8'))
+                sha.update(np.round(np.array(M.xyzs) / self.tol).astype(np.int64).tobytes())
+            else:
+                with open(path, 'rb') as fin:
+                    sha.update(fin.read())
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, cwd, outputs):
+        """
+        Copy the stored outputs of a task into its working directory.
+        Returns True on a cache hit and False otherwise.
+        """
+        if key is None:
+            return False
+        src = self.path(key)
+        if not all([os.path.exists(os.path.join(src, f)) for f in outputs]):
+            self.misses += 1
+            return False
+        for f in outputs:
+            shutil.copy2(os.path.join(src, f), os.path.join(cwd, f))
+        self.hits += 1
+        return True
+
+    def succeeded(self, cwd, outputs, results):
+        """
+        Return whether all of the result files are present in the working directory
+        or inside one of the .tar archives among the outputs.
+        """
+        found = set([f for f in results if os.path.exists(os.path.join(cwd, f))])
+        for f in outputs:
+            if len(found) == len(results):
+                break
+            if '.tar' in f and tarfile.is_tarfile(os.path.join(cwd, f)):
+                with tarfile.open(os.path.join(cwd, f), 'r') as arch:
+                    found.update([os.path.normpath(n) for n in arch.getnames()])
+        return all([f in found for f in results])
+
+    def store(self, key, cwd, outputs, results=[]):
+        """
+        Store the outputs of a finished task.  Tasks that did not write all of their
+        outputs (for example, a log file but no tar file because the job crashed) are not stored,
+        and neither are tasks missing any of the result files that show the calculation succeeded
+        (for example, a failed optimization archives its log but produces no optimize.xyz).
+        """
+        if key is None or os.path.exists(self.path(key)):
+            return
+        if not all([os.path.exists(os.path.join(cwd, f)) for f in outputs]):
+            return
+        if not self.succeeded(cwd, outputs, results):
+            return
+        # Copy to a temporary folder and rename, so other runs never see a partial result
+        tmp = os.path.join(self.root, '.tmp.%s.%i' % (key, os.getpid()))
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for f in outputs:
+            shutil.copy2(os.path.join(cwd, f), os.path.join(tmp, f))
+        if not os.path.exists(os.path.dirname(self.path(key))):
+            os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        try:
+            os.rename(tmp, self.path(key))
+            self.stored += 1
+        except OSError:
+            # Another run stored the same result first
+            shutil.rmtree(tmp)
+
+    def report(self):
+        logger.info("Result cache %s: %i hits, %i misses, %i results stored" %
+                    (self.root, self.hits, self.misses, self.stored))
+
+
+def create_result_cache(root, tol=1e-4):
+    """
+    Reuse the results of identical calculations stored in the (root) folder,
+    and store the results of new calculations there (see ResultCache).
+    """
+    global CACHE
+    CACHE = ResultCache(root, tol)
+    logger.info('Using the result cache in %s' % CACHE.root)
+    return CACHE
+
+
+class StatusDB(object):
+    """
+    Calculation statuses of a refinement, stored in one SQLite file instead of a
+    .status.<calctype> file in the home folder of each calculation.
+
+    All of the statuses are read into memory with one query when the database is opened.
+    Changes are kept in memory and written in a single transaction once (batch) changes
+    have accumulated or (interval) seconds have passed, and when commit() is called.
+    Calculations are identified by their home folder relative to the root and their calctype.
+    """
+
+    def __init__(self, root='.', fnm='.status.db', batch=1000, interval=10.0):
+        """
+        Parameters
+        ----------
+        root : str
+            Root folder of the refinement, which contains the database file
+        fnm : str
+            Name of the database file in the root folder
+        batch : int
+            Number of changed statuses that triggers a write
+        interval : float
+            Maximum time in seconds that a changed status is kept only in memory
+        """
+        self.root = os.path.abspath(root)
+        self.fnm = os.path.join(self.root, fnm)
+        self.batch = batch
+        self.interval = interval
+        new = not os.path.exists(self.fnm)
+        self.conn = sqlite3.connect(self.fnm)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS status (home TEXT NOT NULL, calctype TEXT NOT NULL, "
+                          "status TEXT NOT NULL, pid INTEGER, message TEXT NOT NULL DEFAULT '', "
+                          "PRIMARY KEY (home, calctype))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS status_status ON status (status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS status_calctype ON status (calctype)")
+        self.conn.commit()
+        # (home, calctype) -> (status, pid, message)
+        self.table = dict(((row[0], row[1]), tuple(row[2:]))
+                          for row in self.conn.execute("SELECT home, calctype, status, pid, message FROM status"))
+        self.pending = {}
+        self.t0 = time.time()
+        if new:
+            self.import_files()
+
+    def _key(self, home, calctype):
+        return os.path.relpath(os.path.abspath(home), self.root), calctype.lower()
+
+    def get(self, home, calctype):
+        """
+        Return the status line of a calculation in the format of the .status files
+        (e.g. "complete", "busy.12345" or "failed gave up after 3 tries"), or None if it has no status.
+        """
+        row = self.table.get(self._key(home, calctype))
+        if row is None:
+            return None
+        status, pid, message = row
+        statline = status if pid is None else '%s.%i' % (status, pid)
+        return (statline + ' ' + message) if message else statline
+
+    def set(self, home, calctype, statline):
+        """ Set the status of a calculation from a status line in the format of the .status files. """
+        words = statline.split(None, 1)
+        status, message = words[0], (words[1] if len(words) > 1 else '')
+        pid = None
+        if '.' in status and status.rsplit('.', 1)[1].isdigit():
+            status, pid = status.rsplit('.', 1)
+            pid = int(pid)
+        key = self._key(home, calctype)
+        self.table[key] = (status, pid, message)
+        self.pending[key] = (status, pid, message)
+        if len(self.pending) >= self.batch or (time.time() - self.t0) > self.interval:
+            self.commit()
+
+    def commit(self):
+        """ Write the changed statuses to the database file. """
+        if self.pending:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO status (home, calctype, status, pid, message) "
+                                      "VALUES (?, ?, ?, ?, ?)", [k + v for k, v in self.pending.items()])
+            self.pending = {}
+        self.t0 = time.time()
+
+    def query(self, status=None, calctype=None):
+        """
+        Return the home folders (relative to the root) of the calculations
+        with the given status and/or calctype.
+        """
+        self.commit()
+        sql, args = "SELECT home FROM status", []
+        conds = []
+        if status is not None:
+            conds.append("status = ?")
+            args.append(status)
+        if calctype is not None:
+            conds.append("calctype = ?")
+            args.append(calctype.lower())
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        return [row[0] for row in self.conn.execute(sql + " ORDER BY home", args)]
+
+    def import_files(self):
+        """
+        Import the .status.<calctype> files under the root folder into the database.
+        The files are left in place.
+        """
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for f in filenames:
+                if not f.startswith('.status.') or f == os.path.basename(self.fnm):
+                    continue
+                path = os.path.join(dirpath, f)
+                if os.path.getsize(path) == 0:
+                    continue
+                with open(path) as fin:
+                    statline = fin.readline().strip()
+                if statline:
+                    self.set(dirpath, f[len('.status.'):], statline)
+                    count += 1
+        self.commit()
+        if count > 0:
+            logger.info('Imported %i status files into %s' % (count, self.fnm))
+
+
+def create_status_db(root='.', fnm='.status.db'):
+    """
+    Store the calculation statuses in an SQLite file in the (root) folder
+    instead of the .status files (see StatusDB).  If the file does not exist,
+    it is created and the existing .status files are imported.
+    """
+    global STATUSDB
+    STATUSDB = StatusDB(root, fnm)
+    atexit.register(STATUSDB.commit)
+    logger.info('Using the status database %s' % STATUSDB.fnm)
+    return STATUSDB
+
+
+class BatchQueue(object):
+    """
+    Packs geometry optimizations with the same method and basis set into tasks that run
+    optimize-batch.py, so that many small optimizations share the start-up cost of one task.
+
+    Each optimization still runs in its own folder and produces its own optimize.log and
+    optimize.tar.bz2, and the status of each Optimization object is kept as usual.
+    A batch is submitted when it has (size) optimizations, and partial batches
+    are submitted when the outermost Calculation.launch() call finishes.
+    """
+
+    def __init__(self, size=10, parallel=1):
+        """
+        Parameters
+        ----------
+        size : int
+            Maximum number of optimizations in a batch
+        parallel : int
+            Number of optimizations of a batch that run at the same time
+        """
+        self.size = size
+        self.parallel = parallel
+        # (method, basis) -> OrderedDict of home folder -> (Optimization, cache key)
+        self.pending = OrderedDict()
+
+    def add(self, calc, cmd, method, basis):
+        """
+        Add an optimization to a batch.
+
+        Parameters
+        ----------
+        calc : Optimization
+            The calculation, whose home folder contains initial.xyz
+        cmd : str
+            The optimize-geometry.py command that would run the optimization by itself;
+            the result cache is shared with optimizations that are not batched
+        method, basis : str
+            Electronic structure method and basis set
+        """
+        outputs = ['optimize.log', 'optimize.tar.bz2']
+        key = CACHE.key(cmd, calc.home, ['initial.xyz']) if CACHE != None else None
+        if key is not None and CACHE.fetch(key, calc.home, outputs):
+            logger.info("\x1b[92mCache hit\x1b[0m for '%s'" % calc.name, printlvl=2)
+            calc.launch()
+            return
+        items = self.pending.setdefault((method, basis), OrderedDict())
+        items[calc.home] = (calc, key)
+        if len(items) >= self.size:
+            self.flush((method, basis))
+
+    def flush(self, group=None):
+        """ Submit the batch with the given (method, basis), or all of the batches. """
+        for grp in ([group] if group is not None else list(self.pending.keys())):
+            items = list(self.pending.pop(grp, OrderedDict()).values())
+            if len(items) > 0:
+                self.submit(grp, items)
+
+    def submit(self, group, items):
+        method, basis = group
+        calcs = [calc for calc, key in items]
+        # The batch runs in the folder containing all of the optimizations
+        cwd = os.path.dirname(calcs[0].home) if len(calcs) == 1 else os.path.commonpath([c.home for c in calcs])
+        homes = [os.path.relpath(calc.home, cwd) for calc in calcs]
+        label = 'batch.%s' % homes[0].replace('/', '_')
+        if len(homes) > 1:
+            label += '-%s' % homes[-1].replace('/', '_')
+        batch = OrderedDict([('method', method), ('basis', basis), ('cycles', 100), ('items', [])])
+        for home, calc in zip(homes, calcs):
+            batch['items'].append(OrderedDict([('home', home), ('charge', calc.charge), ('mult', calc.mult)]))
+        with open(os.path.join(cwd, label + '.json'), 'w') as f:
+            json.dump(batch, f, indent=2)
+        outputs = [label + '.log']
+        for home in homes:
+            outputs += [os.path.join(home, 'optimize.log'), os.path.join(home, 'optimize.tar.bz2')]
+        make_task("optimize-batch.py %s.json --parallel %i &> %s.log" % (label, self.parallel, label),
+                  cwd, inputs=[label + '.json'] + [os.path.join(home, 'initial.xyz') for home in homes],
+                  outputs=outputs, tag='%s (%i optimizations)' % (calcs[0].name, len(calcs)), calc=calcs,
+                  verbose=calcs[0].verbose,
+                  cache_items=[(key, calc.home, ['optimize.log', 'optimize.tar.bz2'], ['optimize.xyz'])
+                               for calc, key in items if key is not None])
+        # Like Calculation.launch(), mark the calculations with running tasks as busy.
+        for calc in calcs:
+            if len(calc.wqids) > 0:
+                calc.saveStatus('busy', display=(calc.verbose >= 4))
+
+
+def create_batches(size=10, parallel=1):
+    """
+    Run geometry optimizations in batches of up to (size), with (parallel)
+    running at the same time in each batch (see BatchQueue).
+    """
+    global BATCH
+    BATCH = BatchQueue(size, parallel)
+    logger.info('Running geometry optimizations in batches of up to %i' % size)
+    return BATCH
+
+
 def get_trajectory_home(pth):
     """ Get a home directory for the dynamics trajectory file. """
     if os.getcwd() not in os.path.abspath(pth):
@@ -498,7 +1023,7 @@ def parse_input_files(inps):
 
 def wq_reactor(wait_time=1, newline_time=3600, success_time=3600, iters=np.inf):
     """
-    Reactor Loop: Waits for tasks to finish in the Work Queue and
+    Reactor Loop: Waits for tasks to finish in the Work Queue (or the LocalQueue) and
     executes follow-up functions if necessary.  When running in Work Queue mode, this
 
     Parameters
@@ -516,9 +1041,13 @@ def wq_reactor(wait_time=1, newline_time=3600, success_time=3600, iters=np.inf):
         task = WQ.wait(wait_time)
         niter += 1
         nbusy = WQ.stats.workers_busy
-        logger.info("%s : %i/%i workers busy; %i/%i jobs complete\r" %
+        if task and task.result == 0 and getattr(task, 'stage', None) is not None:
+            STAGES[task.stage] -= 1
+        logger.info("%s : %i/%i workers busy; %i/%i jobs complete; queued %s\r" %
                     (time.ctime(), nbusy, (WQ.stats.total_workers_joined - WQ.stats.total_workers_removed),
-                     WQ.stats.total_tasks_complete, WQ.stats.total_tasks_dispatched), newline=False)
+                     WQ.stats.total_tasks_complete, WQ.stats.total_tasks_dispatched,
+                     ' '.join(['%s:%i' % (k, v) for k, v in sorted(STAGES.items()) if v > 0]) or 'none'),
+                    newline=False)
         if time.time() - wq_reactor.t0 > newline_time:
             wq_reactor.t0 = time.time()
             logger.info('')
@@ -528,22 +1057,26 @@ def wq_reactor(wait_time=1, newline_time=3600, success_time=3600, iters=np.inf):
                 oldid = task.id
                 oldhost = task.hostname
                 taskid = WQ.submit(task)
-                if hasattr(task, 'calc'):
-                    task.calc.wqids.append(taskid)
+                for calc in getattr(task, 'calcs', []):
+                    calc.wqids.append(taskid)
                 logger.warning("Task '%s' (id %i) failed on host %s (%i seconds), resubmitted:"
                                "id %i" % (task.tag, oldid, oldhost, exectime, taskid))
             else:
                 logger.info("Task '%s' (id %i) returned from %s (%i seconds)"
                             % (task.tag, task.id, task.hostname, exectime),
                             printlvl=(1 if exectime > success_time else 2))
+                for key, cwd, outputs, results in getattr(task, 'cache_items', []):
+                    CACHE.store(key, cwd, outputs, results)
                 # Launch the next calculation!
-                if hasattr(task, 'calc'):
-                    task.calc.saveStatus('ready', display=False)
-                    task.calc.wqids.remove(task.id)
-                    task.calc.launch()
+                for calc in getattr(task, 'calcs', []):
+                    calc.saveStatus('ready', display=False)
+                    calc.wqids.remove(task.id)
+                    calc.launch()
                 del task
         elif (niter >= iters):
             break
+    if STATUSDB != None:
+        STATUSDB.commit()
     if iters == np.inf:
         logger.info("Reactor loop has no more tasks!")
     else:
@@ -553,9 +1086,10 @@ def wq_reactor(wait_time=1, newline_time=3600, success_time=3600, iters=np.inf):
 wq_reactor.t0 = time.time()
 
 
-def make_task(cmd, cwd, inputs=[], outputs=[], tag=None, calc=None, verbose=0, priority=None):
+def make_task(cmd, cwd, inputs=[], outputs=[], tag=None, calc=None, verbose=0, priority=None, results=[],
+              cache_items=None):
     """
-    Run a task locally or submit it to the Work Queue.
+    Run a task locally or submit it to the Work Queue (or the LocalQueue, see create_local_queue).
 
     Parameters
     ----------
@@ -568,17 +1102,26 @@ def make_task(cmd, cwd, inputs=[], outputs=[], tag=None, calc=None, verbose=0, p
     outputs : list
         (For WQ) Names of output files, to be written back to the working directory
         (Not for WQ) The locally run calculation will have
+        If the result cache is enabled, these are the files stored in and copied from the cache
     tag : str
         (For WQ) Descriptive name for the task, if None then use the command.
-    calc : Calculation
+    calc : Calculation or list
         (For WQ) The calculation object is an attribute of the WQ task object,
         and will allow a completed task to execute the next step.
+        A list is given for a task that runs several calculations (see BatchQueue).
     verbose : int
         Print information out to the screen
     priority : int
         The priority of this task when waiting in the queue
+    results : list
+        Files that are only written if the calculation succeeds, either in the working directory or
+        inside a .tar archive among the outputs; the outputs are only stored in the result cache
+        if all of them are present
+    cache_items : list, optional
+        (key, folder, outputs, results) of the results to be stored in the result cache when the task finishes;
+        by default, the task itself is looked up in the cache and its outputs are stored
     """
-    global WQ
+    global WQ, CACHE
     # if calc != None and calc.read_only:
     #     logger.error("I should never get here - make_task called with read enabled")
     #     raise RuntimeError
@@ -589,41 +1132,58 @@ def make_task(cmd, cwd, inputs=[], outputs=[], tag=None, calc=None, verbose=0, p
     # Actually print the command to the output folder. :)
     with open(os.path.join(cwd, 'command.sh'), 'w') as f:
         print(cmd, file=f)
+    calcs = calc if isinstance(calc, list) else ([calc] if calc != None else [])
+    if cache_items is None:
+        # If the same calculation was done before, copy its results and go to the next step.
+        cache_key = CACHE.key(cmd, cwd, inputs) if CACHE != None else None
+        if cache_key is not None and CACHE.fetch(cache_key, cwd, outputs):
+            logger.info("\x1b[92mCache hit\x1b[0m for '%s'" % (tag if tag != None else cmd), printlvl=2)
+            for c in calcs: c.launch()
+            return
+        cache_items = [(cache_key, os.path.abspath(cwd), outputs, results)] if cache_key is not None else []
     if WQ != None:
         # Create and submit Work Queue Task object.
-        task = work_queue.Task(cmd)
+        if isinstance(WQ, LocalQueue):
+            task = LocalTask(cmd, os.path.abspath(cwd))
+        else:
+            task = work_queue.Task(cmd)
+            task.specify_algorithm(work_queue.WORK_QUEUE_SCHEDULE_FCFS)
         # The task priority is either an argument or a field of the calculation object
         if priority == None:
-            if calc != None:
-                priority = calc.priority
+            if len(calcs) > 0:
+                priority = max([c.priority for c in calcs])
             else:
                 priority = 0
         task.specify_priority(priority)
-        input_paths = [os.path.abspath(os.path.join(cwd, f)) for f in inputs]
-        output_paths = [os.path.abspath(os.path.join(cwd, f)) for f in outputs]
-        for f in input_paths:
-            task.specify_input_file(f, os.path.basename(f), cache=False)
-        for f in output_paths:
-            task.specify_output_file(f, os.path.basename(f), cache=False)
-        task.specify_algorithm(work_queue.WORK_QUEUE_SCHEDULE_FCFS)
+        # The remote file names keep the subfolders (if any) of the file names relative to the working directory
+        for f in inputs:
+            task.specify_input_file(os.path.abspath(os.path.join(cwd, f)), os.path.normpath(f), cache=False)
+        for f in outputs:
+            task.specify_output_file(os.path.abspath(os.path.join(cwd, f)), os.path.normpath(f), cache=False)
         if tag != None:
             task.specify_tag(tag)
         else:
             task.specify_tag(cmd)
+        task.cache_items = cache_items
+        # Count the queued tasks of each stage of the workflow
+        task.stage = calcs[0].calctype if len(calcs) > 0 else 'Other'
+        STAGES[task.stage] += 1
         taskid = WQ.submit(task)
         # Keep track of the work queue task IDs belonging to each task
-        if calc != None:
-            task.calc = calc
-            task.calc.wqids.append(taskid)
-            task.calc.saveStatus('launch')
+        task.calcs = calcs
+        for c in calcs:
+            c.wqids.append(taskid)
+            c.saveStatus('launch')
         logger.info("\x1b[94mWQ task\x1b[0m '%s'; taskid %i priority %i" % (task.tag, taskid, priority), printlvl=3)
     else:
         # Run the calculation locally.
-        if calc != None: calc.saveStatus('launch')
+        for c in calcs: c.saveStatus('launch')
         _exec(cmd, print_command=(verbose >= 3), persist=True, cwd=cwd)
+        for key, folder, files, results in cache_items:
+            CACHE.store(key, folder, files, results)
         # After executing the task, run launch() again
         # because launch() is designed to be multi-pass.
-        if calc != None: calc.launch()
+        for c in calcs: c.launch()
 
 
 class Calculation(object):
@@ -632,6 +1192,9 @@ class Calculation(object):
     """
     calctype = "Calculation"
     statlvl = 1
+    # Calculations waiting to be launched, see launch()
+    launchQueue = deque()
+    launching = False
 
     def __init__(self, initial, home, **kwargs):
         """
@@ -710,6 +1273,11 @@ class Calculation(object):
         self.bases = kwargs['bases'][:]
         # Save a list of Work Queue IDs belonging to this calculation.
         self.wqids = []
+        # Whether the calculation is waiting in the launch queue.
+        self.queued = False
+        # Number of child calculations with each (calctype, status), kept up to date by saveStatus
+        # so the parent doesn't need to loop over its children every time one of them finishes.
+        self.childStatus = Counter()
         # If more methods are provided than bases, then assume the biggest basis
         # is used for the later calculations (and vice versa).
         if len(self.methods) > len(self.bases):
@@ -725,7 +1293,8 @@ class Calculation(object):
     def initStatus(self):
         """
         Read calculation status from the .status file
-        which lives in the home folder of the calculation.
+        which lives in the home folder of the calculation,
+        or from the status database if there is one (see create_status_db).
 
         Possible states on disk are:
         complete: Calculation is complete, don't descend into this branch unless forced
@@ -738,7 +1307,9 @@ class Calculation(object):
         """
         self.message = ''
         statpath = os.path.join(self.home, '.status.%s' % self.calctype.lower())
-        if os.path.exists(statpath) and os.path.getsize(statpath) > 0:
+        if STATUSDB != None:
+            statline = STATUSDB.get(self.home, self.calctype) or 'ready'
+        elif os.path.exists(statpath) and os.path.getsize(statpath) > 0:
             statline = open(statpath).readlines()[0].strip()
         else:
             statline = 'ready'
@@ -759,13 +1330,18 @@ class Calculation(object):
     def saveStatus(self, status, ansi="\x1b[93m", message=None, display=True, to_disk=True):
         """
         Set calculation status and also write to status file
-        which lives in the home folder of the calculation.
+        which lives in the home folder of the calculation
+        (or to the status database if there is one).
         """
         statpath = os.path.join(self.home, '.status.%s' % self.calctype.lower())
         statout = status
 
         if (hasattr(self, 'status') and self.status == status):
             display = False
+        elif self.parent != None:
+            if hasattr(self, 'status'):
+                self.parent.childStatus[(self.calctype, self.status)] -= 1
+            self.parent.childStatus[(self.calctype, status)] += 1
         self.status = status
         # If calculation is busy, append the pid to the status.
         if status == 'busy':
@@ -777,8 +1353,11 @@ class Calculation(object):
         # Save status to disk if desired.
         if self.read_only: to_disk = False
         if to_disk:
-            with open(statpath, 'w') as f:
-                print(statout, file=f)
+            if STATUSDB != None:
+                STATUSDB.set(self.home, self.calctype, statout)
+            else:
+                with open(statpath, 'w') as f:
+                    print(statout, file=f)
         # Print status to the terminal.
         if display:
             self.printStatus(ansi=ansi)
@@ -833,7 +1412,46 @@ class Calculation(object):
             M.charge = self.charge
             M.mult = self.mult
 
+    def countChildren(self, calctype, statuses):
+        """ Return the number of child calculations of the given calctype that have one of the statuses. """
+        return sum([self.childStatus[(calctype, status)] for status in statuses])
+
     def launch(self):
+        """
+        Launch the next step of the calculation.
+
+        Calls made while another calculation is being launched (for example, a finished
+        calculation notifying its parent) are put in a queue, which is run in order by the
+        outermost call.  This keeps the workflow from recursing through the calculation tree,
+        and a calculation notified several times while it is waiting is only launched once.
+        Partial batches of geometry optimizations (see BatchQueue) are submitted at the end.
+        """
+        if Calculation.launching:
+            if not self.queued:
+                self.queued = True
+                Calculation.launchQueue.append(self)
+            return
+        Calculation.launching = True
+        try:
+            self.launchNow()
+            while True:
+                while Calculation.launchQueue:
+                    calc = Calculation.launchQueue.popleft()
+                    calc.queued = False
+                    calc.launchNow()
+                # Submit the partial batches of optimizations, which may queue more launches
+                # if they are run right away.
+                if BATCH != None:
+                    BATCH.flush()
+                if not Calculation.launchQueue:
+                    break
+        finally:
+            Calculation.launching = False
+            for calc in Calculation.launchQueue:
+                calc.queued = False
+            Calculation.launchQueue.clear()
+
+    def launchNow(self):
         # Check various statuses and don't continue for certain ones.
         if self.status == 'failed':
             logger.info("%s returning because failed" % self.name, printlvl=3)
@@ -937,7 +1555,7 @@ class FragmentID(Calculation):
             "identify-fragments.py initial.xyz --method %s --basis \"%s\" --charge %i --mult %i &> fragmentid.log" %
             (self.methods[0], self.bases[0], self.charge, self.mult),
             self.home, inputs=["initial.xyz"], outputs=["fragmentid.log", "fragmentid.tar.bz2"],
-            tag=self.name, calc=self, verbose=self.verbose)
+            results=["fragmentid.txt"], tag=self.name, calc=self, verbose=self.verbose)
 
 
 class FragmentOpt(Calculation):
@@ -987,7 +1605,7 @@ class FragmentOpt(Calculation):
         # Note that the "last" method and basis set is used for the fragment optimization
         make_task("optimize-fragments.py --method %s --basis \"%s\" &> fragmentopt.log" %
                   (self.methods[-1], self.bases[-1]),
-                  self.home, outputs=["fragmentopt.log", "fragmentopt.tar.bz2"],
+                  self.home, outputs=["fragmentopt.log", "fragmentopt.tar.bz2"], results=["fragmentopt.nrg"],
                   tag=self.name, calc=self, verbose=self.verbose)
 
 
@@ -1057,10 +1675,13 @@ class Optimization(Calculation):
             raise RuntimeError
         M.write(os.path.join(self.home, 'initial.xyz'))
         # Note that the "first" method and basis set is used for the geometry optimization.
-        make_task("optimize-geometry.py initial.xyz --method %s --basis \"%s\" --charge %i --mult %i &> optimize.log" %
-                  (self.methods[0], self.bases[0], self.charge, self.mult),
-                  self.home, inputs=["initial.xyz"], outputs=["optimize.log", "optimize.tar.bz2"],
-                  tag=self.name, calc=self, verbose=self.verbose)
+        cmd = ("optimize-geometry.py initial.xyz --method %s --basis \"%s\" --charge %i --mult %i &> optimize.log" %
+               (self.methods[0], self.bases[0], self.charge, self.mult))
+        if BATCH != None:
+            BATCH.add(self, cmd, self.methods[0], self.bases[0])
+        else:
+            make_task(cmd, self.home, inputs=["initial.xyz"], outputs=["optimize.log", "optimize.tar.bz2"],
+                      results=["optimize.xyz"], tag=self.name, calc=self, verbose=self.verbose)
 
 
 class TransitionState(Calculation):
@@ -1157,7 +1778,7 @@ class TransitionState(Calculation):
                 (' '.join(["\"%s\"" % i for i in self.methods]), ' '.join(["\"%s\"" % i for i in self.bases]),
                  self.charge, self.mult),
                 self.home, inputs=["initial.xyz", "initpath.xyz"],
-                outputs=["transition-state.log", "transition-state.tar.bz2"],
+                outputs=["transition-state.log", "transition-state.tar.bz2"], results=["irc.xyz"],
                 tag=self.name, calc=self, verbose=self.verbose)
 
 
@@ -1233,7 +1854,7 @@ class FreezingString(Calculation):
                 (' '.join(["\"%s\"" % i for i in self.methods]), ' '.join(["\"%s\"" % i for i in self.bases]),
                  self.charge, self.mult),
                 self.home, inputs=["initial.xyz"], outputs=["freezing-string.log", "freezing-string.tar.bz2"],
-                tag=self.name, calc=self, verbose=self.verbose)
+                results=["irc.xyz", "stringfile.txt"], tag=self.name, calc=self, verbose=self.verbose)
 
 
 # class GrowingString(Calculation):
@@ -1459,7 +2080,7 @@ class Interpolation(Calculation):
         make_task(
             "Nebterpolate.py --morse 1e-2 --repulsive --allpairs --anchor 2 .interpolate.in.xyz interpolated.xyz &> interpolate.log",
             self.home, inputs=[".interpolate.in.xyz"], outputs=["interpolate.log", "interpolated.xyz"],
-            tag=self.name + "_interpolate", calc=self, verbose=self.verbose)
+            results=["interpolated.xyz"], tag=self.name + "_interpolate", calc=self, verbose=self.verbose)
 
 
 class Pathway(Calculation):
@@ -1470,16 +2091,13 @@ class Pathway(Calculation):
     calctype = "Pathway"
 
     def countFragmentIDs(self):
-        return sum([calc.status == 'converged' for calc in list(self.FragmentIDs.values())]), len(
-            list(self.FragmentIDs.values()))
+        return self.countChildren('FragmentID', ['converged']), len(self.FragmentIDs)
 
     def countFragmentOpts(self):
-        return sum([calc.status == 'converged' for calc in list(self.FragmentOpts.values())]), len(
-            list(self.FragmentOpts.values()))
+        return self.countChildren('FragmentOpt', ['converged']), len(self.FragmentOpts)
 
     def countOptimizations(self):
-        return sum([calc.status == 'converged' for calc in list(self.Optimizations.values())]), len(
-            list(self.Optimizations.values()))
+        return self.countChildren('Optimization', ['converged']), len(self.Optimizations)
 
     def launch_(self):
         """
@@ -1510,8 +2128,7 @@ class Pathway(Calculation):
                     calc.launch()
                 return
 
-            if (len(self.Optimizations) == 2) and all(
-                    [calc.status == 'converged' for calc in list(self.Optimizations.values())]):
+            if (len(self.Optimizations) == 2) and self.countChildren('Optimization', ['converged']) == 2:
                 OptMols = OrderedDict()
                 for frm, calc in list(self.Optimizations.items()):
                     OptMols[frm] = Molecule(os.path.join(calc.home, 'optimize.xyz'), topframe=-1)
@@ -1533,8 +2150,7 @@ class Pathway(Calculation):
                 Joined.write(os.path.join(self.home, 'rejoined.xyz'))
                 Spaced.write(os.path.join(self.home, 'respaced.xyz'))
                 self.M1 = Spaced
-            elif (len(self.Optimizations) == 2) and any(
-                    [calc.status == 'failed' for calc in list(self.Optimizations.values())]):
+            elif (len(self.Optimizations) == 2) and self.countChildren('Optimization', ['failed']) > 0:
                 self.saveStatus('failed', message='At least one endpoint optimization has failed')
                 return
             else:
@@ -1913,13 +2529,13 @@ class Trajectory(Calculation):
         del OptMols
 
     def countFragmentIDs(self):
-        return sum([calc.status == 'converged' for calc in list(self.FragmentIDs.values())]), len(self.frames)
+        return self.countChildren('FragmentID', ['converged']), len(self.frames)
 
     def countFragmentOpts(self):
-        return sum([calc.status == 'converged' for calc in list(self.FragmentOpts.values())]), len(self.optlist)
+        return self.countChildren('FragmentOpt', ['converged']), len(self.optlist)
 
     def countOptimizations(self):
-        return sum([calc.status == 'converged' for calc in list(self.Optimizations.values())]), len(self.frames)
+        return self.countChildren('Optimization', ['converged']), len(self.frames)
 
     def launchOptimizations(self):
         # Create geometry optimizations if we haven't done so already.
@@ -1931,13 +2547,14 @@ class Trajectory(Calculation):
         # need to cycle through again.
         else:
             for calc in list(self.Optimizations.values()):
+                if calc.status in ['converged', 'failed']: continue
                 if os.path.exists(os.path.join(calc.home, 'optimize.xyz')):
                     complete, total = self.countOptimizations()
                     calc.saveStatus('converged', display=(self.verbose >= 2), to_disk=False,
                                     message='%i/%i complete' % (complete + 1, total))
 
-        if (len(self.Optimizations) == len(self.frames)) and all(
-                [calc.status in ['converged', 'failed'] for calc in list(self.Optimizations.values())]):
+        if (len(self.Optimizations) == len(self.frames)) and \
+                self.countChildren('Optimization', ['converged', 'failed']) == len(self.Optimizations):
             if not hasattr(self, 'Pathways'):
                 self.makePathways()
 
@@ -1977,26 +2594,28 @@ class Trajectory(Calculation):
                 self.makeFragments()
             else:
                 for calc in list(self.FragmentIDs.values()):
+                    if calc.status in ['converged', 'failed']: continue
                     if os.path.exists(os.path.join(calc.home, 'fragmentid.txt')):
                         complete, total = self.countFragmentIDs()
                         calc.saveStatus('converged', display=(self.verbose >= 2), to_disk=False,
                                         message='%i/%i complete' % (complete + 1, total))
             # Optimize fragments if we haven't done so already
-            if (len(self.FragmentIDs) == len(self.frames)) and all(
-                    [calc.status in ['converged', 'failed'] for calc in list(self.FragmentIDs.values())]):
+            if (len(self.FragmentIDs) == len(self.frames)) and \
+                    self.countChildren('FragmentID', ['converged', 'failed']) == len(self.FragmentIDs):
                 if not hasattr(self, 'FragmentOpts'):
                     self.makeFragOpts()
                 else:
                     for calc in list(self.FragmentOpts.values()):
+                        if calc.status in ['converged', 'failed']: continue
                         if os.path.exists(os.path.join(calc.home, 'fragmentopt.txt')):
                             complete, total = self.countFragmentOpts()
                             calc.saveStatus('converged', display=(self.verbose >= 2), to_disk=False,
                                             message='%i/%i complete' % (complete + 1, total))
 
-            if (len(self.FragmentIDs) == len(self.frames)) and all(
-                    [calc.status in ['converged', 'failed'] for calc in list(self.FragmentIDs.values())]):
-                if (len(self.FragmentOpts) == len(self.optlist)) and all(
-                        [calc.status in ['converged', 'failed'] for calc in list(self.FragmentOpts.values())]):
+            if (len(self.FragmentIDs) == len(self.frames)) and \
+                    self.countChildren('FragmentID', ['converged', 'failed']) == len(self.FragmentIDs):
+                if (len(self.FragmentOpts) == len(self.optlist)) and \
+                        self.countChildren('FragmentOpt', ['converged', 'failed']) == len(self.FragmentOpts):
                     # Calculate Delta-G's of the reaction from fragments if we haven't done so already
                     if not hasattr(self, 'DeltaG'):
                         self.calcDeltaGs()
@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .molecule import IsomerRegistry, Molecule
+from .nanoreactor import (GlobalGraphs, Nanoreactor, bondorder_keys, bondorder_series, encode, frame_records,
+                          read_runlength, write_frame_records, write_runlength)
+
+# Visualization data written for bin/reactions.vmd, as name.dat and/or name.bin
+VizNames = ['color', 'bonds', 'charge', 'spin']
+
+
+class FrameFollower(object):
+    """
+    Read the frames that have been appended to a growing file since the previous read.
+
+    Works for .xyz files and bond_order.list files, where each frame consists of a line
+    containing the number of entries, a comment line, and one line per entry.
+    Incomplete frames at the end of the file are left for the next read.
+    """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        # Byte offset of the first frame that has not been read yet
+        self.offset = 0
+        # Number of frames read so far
+        self.nframes = 0
+
+    def read(self):
+        """
+        Read the complete frames that were appended to the file.
+
+        Returns
+        -------
+        list
+            (comment, entries) for each new frame, where entries is a list of strings
+        """
+        if not os.path.exists(self.fnm):
+            return []
+        with open(self.fnm, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # The last element is either empty or a line that is still being written
+        lines = data.split(b'\n')[:-1]
+        frames = []
+        pos = 0
+        nbytes = 0
+        while pos < len(lines):
+            if not lines[pos].strip():
+                nbytes += len(lines[pos]) + 1
+                pos += 1
+                continue
+            nent = int(lines[pos])
+            if pos + nent + 2 > len(lines):
+                break
+            block = lines[pos:pos + nent + 2]
+            frames.append((block[1].decode(), [l.decode() for l in block[2:]]))
+            nbytes += sum([len(l) + 1 for l in block])
+            pos += nent + 2
+        self.offset += nbytes
+        self.nframes += len(frames)
+        return frames
+
+
+class NanoreactorStream(object):
+    """
+    Reaction event learning for a trajectory that is still being written by a running MD simulation.
+
+    New frames are read from the end of the coordinate, charge/spin and bond order files
+    each time update() is called. The analysis is then repeated on a window that covers
+    the newly arrived frames and enough of the preceding history; this is an overlap-save
+    scheme where the frames near either edge of the window only serve as context for the
+    low-pass filter and the stability criteria. Frames that are at least the filter length
+    plus LearnTime + PadTime away from the end of the trajectory are finalized:
+    their bonds, global graphs and molecule time series are appended to the global
+    record, their atom colors, bonds, charge and spin labels are appended to the
+    visualization files, and reaction events that end among them are written to the reactions folder.
+
+    The number of frames in the visualization files is kept in stream.json, so that a stream
+    that is restarted on the same trajectory continues these files instead of starting over.
+    """
+
+    def __init__(self, xyzin, qsin=None, boin='bond_order.list', properties='properties.txt', dt_fs=0.0,
+                 bothre=0.0, learntime=100.0, padtime=0, cutoff=100.0, printlvl=0, odir='reactions',
+                 progress='stream.json', **kwargs):
+        """
+        Parameters
+        ----------
+        xyzin : str
+            Coordinate file that is being written by the MD simulation
+        qsin : str, optional
+            xyz formatted file with charges on x-coordinate and spins on y-coordinate;
+            only used if it already exists when the stream is created
+        boin : str, optional
+            File containing pairwise bond orders, used if bothre is nonzero
+        properties : str, optional
+            Properties file from which the time step is read, if it exists
+        dt_fs : float
+            Time step in femtoseconds (if properties file does not exist)
+        bothre : float
+            Bond order threshold (set nonzero to use)
+        learntime : float
+            Molecules that exist for at least this number of femtoseconds are recognized as stable
+        padtime : float
+            Padding time for each reaction event in femtoseconds; defaults to learntime
+        cutoff : float
+            Cutoff frequency for lowpass filter in cm^-1
+        printlvl : int
+            The print level; the analysis of each window is printed at one level lower
+        odir : str
+            Folder where the reaction events are written
+        progress : str
+            File where the number of frames written to the visualization files is kept
+        **kwargs :
+            Other arguments passed to the Nanoreactor analysis of each window
+        """
+        self.xyzin = xyzin
+        self.qsin = qsin if (qsin is not None and os.path.exists(qsin)) else None
+        self.boThre = bothre
+        self.printlvl = printlvl
+        self.odir = odir
+        self.progress = progress
+        self.kwargs = kwargs
+        self.vizFormat = kwargs.get('vizformat', 'text')
+        self.kwargs.update({'learntime': learntime, 'padtime': padtime, 'cutoff': cutoff, 'bothre': bothre})
+        # Spectra are not plotted for partial trajectories
+        self.kwargs['plot'] = False
+        if properties is not None and os.path.exists(properties):
+            if dt_fs != 0.0:
+                raise RuntimeError("%s exists, don't provide a time step" % properties)
+            with open(properties) as f:
+                keys = f.readline().split()[1:]
+                t0, t1 = [float(f.readline().split()[keys.index('Time(fs)')]) for i in range(2)]
+            self.dt_fs = t1 - t0
+        elif dt_fs == 0.0:
+            raise RuntimeError("%s doesn't exist, provide a nonzero time step" % properties)
+        else:
+            self.dt_fs = dt_fs
+        self.LearnTime = int(learntime / self.dt_fs)
+        self.PadTime = int((padtime if padtime != 0 else learntime) / self.dt_fs)
+        # Number of frames at either edge of a window that are affected by the boundaries of the low-pass filter;
+        # the impulse response of the filter is negligible after about eight periods of the cutoff frequency
+        self.FilterPad = int(np.ceil(8 * 33355.0 / (cutoff * self.dt_fs))) if cutoff > 0.0 else 0
+        # Frames are finalized when they are this far away from the end of the trajectory
+        self.Lag = self.LearnTime + self.PadTime + self.FilterPad
+        # Frames before the first frame to be finalized that are included in the analysis window
+        self.History = 2 * (self.LearnTime + self.PadTime) + self.FilterPad
+
+        # Readers for the files being written
+        self.xyzFollow = FrameFollower(xyzin)
+        self.qsFollow = FrameFollower(self.qsin) if self.qsin is not None else None
+        self.boFollow = FrameFollower(boin) if bothre > 0.0 else None
+        # Buffers of frames that may still be needed; the first one is frame number self.bufStart
+        self.bufStart = 0
+        self.elem = None
+        self.xyzBuf = []
+        self.commBuf = []
+        self.qsBuf = []
+        self.boBuf = []
+
+        # Number of frames whose analysis is final
+        self.finalized = 0
+        # Global record of the finalized frames, in the same format as the Nanoreactor attributes
+        self.Isomers = IsomerRegistry()
+        self.global_graphs = GlobalGraphs()
+        self.gg_frames = OrderedDict()
+        self.BondLists = []
+        self.TimeSeries = OrderedDict()
+        self.EventIDs = []
+        self.Events = OrderedDict()
+        # Reactant and product isomer indices of each reaction output folder, and the number of files in each
+        self.output_iidx = []
+        self.output_count = []
+        # VMD color of each global isomer, and the number of colors given to "Found" isomers so far
+        self.isoColor = {}
+        self.nColors = 0
+
+        if not os.path.exists(self.odir):
+            os.makedirs(self.odir)
+        self.resumeVisualization()
+
+    @property
+    def nframes(self):
+        """ Number of frames for which all of the input data has been read. """
+        n = len(self.xyzBuf)
+        if self.qsFollow is not None:
+            n = min(n, len(self.qsBuf))
+        if self.boFollow is not None:
+            n = min(n, len(self.boBuf))
+        return self.bufStart + n
+
+    def read(self):
+        """
+        Read newly written frames into the buffers.
+
+        Returns
+        -------
+        int
+            Number of frames that became available
+        """
+        n0 = self.nframes
+        for comm, lines in self.xyzFollow.read():
+            tokens = np.array(' '.join(lines).split()).reshape(-1, 4)
+            if self.elem is None:
+                self.elem = list(tokens[:, 0])
+            elif len(tokens) != len(self.elem):
+                raise RuntimeError('Number of atoms changed in %s' % self.xyzin)
+            self.xyzBuf.append(tokens[:, 1:].astype(float))
+            self.commBuf.append(comm)
+        if self.qsFollow is not None:
+            for comm, lines in self.qsFollow.read():
+                self.qsBuf.append(np.array(' '.join(lines).split()).reshape(-1, 4)[:, 1:].astype(float))
+        if self.boFollow is not None:
+            for comm, lines in self.boFollow.read():
+                entries = np.array(' '.join(lines).split(), dtype=float).reshape(-1, 3)
+                nodiag, keys = bondorder_keys(entries)
+                self.boBuf.append((keys, entries[nodiag, 2]))
+        return self.nframes - n0
+
+    def analyze(self, wstart, wend):
+        """
+        Run the Nanoreactor analysis on a window of buffered frames.
+
+        Parameters
+        ----------
+        wstart, wend : int
+            First and last (exclusive) frame of the window
+
+        Returns
+        -------
+        Nanoreactor
+            Analysis of the window, where frame 0 is frame wstart of the trajectory
+        """
+        i0, i1 = wstart - self.bufStart, wend - self.bufStart
+        M = Molecule()
+        M.elem = list(self.elem)
+        # Copies, because making molecules whole modifies the coordinates in place
+        M.xyzs = [x.copy() for x in self.xyzBuf[i0:i1]]
+        M.comms = self.commBuf[i0:i1]
+        qs = np.array(self.qsBuf[i0:i1]) if self.qsFollow is not None else None
+        bo = None
+        if self.boFollow is not None:
+            blocks = self.boBuf[i0:i1]
+            frames = np.repeat(np.arange(len(blocks), dtype=np.int32), [len(k) for k, v in blocks])
+            keys = np.concatenate([k for k, v in blocks])
+            values = np.concatenate([v for k, v in blocks])
+            bo = bondorder_series(frames, keys, values, len(blocks))
+        return Nanoreactor(M, qsin=qs, boin=bo, properties=None, dt_fs=self.dt_fs, printlvl=self.printlvl - 1,
+                           **self.kwargs)
+
+    def update(self, final=False):
+        """
+        Read new frames, analyze the window around the frames that can be finalized,
+        and extend the global record with them.
+
+        Parameters
+        ----------
+        final : bool
+            Set to True when the simulation has finished, to finalize all remaining frames
+
+        Returns
+        -------
+        list
+            Event IDs of the reaction events that were written in this update
+        """
+        self.read()
+        nframes = self.nframes
+        horizon = nframes if final else nframes - self.Lag
+        if horizon <= self.finalized:
+            return []
+        wstart = max(self.bufStart, self.finalized - self.History)
+        R = self.analyze(wstart, nframes)
+        # Map isomer indices of the window to the global isomer registry
+        iso_map = [self.Isomers.add(G) for G in R.Isomers]
+        self.extendGraphs(R, wstart, horizon)
+        self.extendTimeSeries(R, wstart, horizon, iso_map)
+        self.extendVisualization(R, wstart, horizon, iso_map)
+        newEvents = self.extendEvents(R, wstart, horizon, iso_map)
+        if self.printlvl >= 0:
+            print("Frames %i-%i finalized, %i new reaction events" % (self.finalized, horizon - 1, len(newEvents)))
+        self.finalized = horizon
+        # Drop frames that will not be part of any later window
+        drop = max(0, self.finalized - self.History - self.bufStart)
+        del self.xyzBuf[:drop], self.commBuf[:drop], self.qsBuf[:drop], self.boBuf[:drop]
+        self.bufStart += drop
+        return newEvents
+
+    def globalMolID(self, molID, iso_map):
+        """ Convert a molecule ID from a window analysis to the global isomer numbering. """
+        atomWord, iidx = molID.split(':')
+        return "%s:%i" % (atomWord, iso_map[int(iidx)])
+
+    def extendGraphs(self, R, wstart, horizon):
+        """ Append the global graphs and bond lists of the newly finalized frames. """
+        lf0, lf1 = self.finalized - wstart, horizon - wstart
+        # Positions of the atom pairs of the window in the pair table of the global record
+        pidx = self.global_graphs.pair_indices(R.global_graphs.pairs)
+        for start, (gidx, end) in R.gg_frames.items():
+            fs, fe = max(start, lf0) + wstart, min(end, lf1) + wstart
+            if fs >= fe:
+                continue
+            bonded = np.zeros(len(self.global_graphs.pairs), dtype=bool)
+            bonded[pidx[R.global_graphs.bonded(gidx)]] = True
+            g = self.global_graphs.add(bonded)
+            last = next(reversed(self.gg_frames)) if self.gg_frames else None
+            if last is not None and self.gg_frames[last] == (g, fs):
+                self.gg_frames[last] = (g, fe)
+            else:
+                self.gg_frames[fs] = (g, fe)
+        self.BondLists.extend(R.BondLists[lf0:lf1])
+
+    def extendTimeSeries(self, R, wstart, horizon, iso_map):
+        """
+        Append the lifetimes of molecules in the newly finalized frames.
+        self.TimeSeries[molID]['intervals'] is a list of [first frame, last frame + 1]
+        for each interval where the molecule exists.
+        """
+        lf0, lf1 = self.finalized - wstart, horizon - wstart
+        for molID, ts in R.TimeSeries.items():
+            signal = ts['raw_signal'][lf0:lf1]
+            if not signal.any():
+                continue
+            gmolID = self.globalMolID(molID, iso_map)
+            if gmolID not in self.TimeSeries:
+                self.TimeSeries[gmolID] = OrderedDict([('graph', R.Isomers[ts['iidx']]),
+                                                       ('iidx', iso_map[ts['iidx']]), ('intervals', [])])
+            intervals = self.TimeSeries[gmolID]['intervals']
+            frame = self.finalized
+            for intvl, on_off in encode(signal):
+                if on_off:
+                    if intervals and intervals[-1][1] == frame:
+                        intervals[-1][1] = frame + intvl
+                    else:
+                        intervals.append([frame, frame + intvl])
+                frame += intvl
+
+    def resumeVisualization(self):
+        """
+        Find the number of frames that an earlier run of the stream wrote to the visualization files
+        and remove anything after that point, so new frames are appended without gaps or repeats.
+        Sets self.vizFrames and self.lastLine (the last line written to each file).
+        """
+        self.vizFrames = 0
+        self.lastLine = {}
+        if os.path.exists(self.progress):
+            with open(self.progress) as f:
+                self.vizFrames = json.load(f)['frames']
+        text = self.vizFormat in ('text', 'both')
+        binary = self.vizFormat in ('binary', 'both')
+        Lines = OrderedDict()
+        Records = OrderedDict()
+        for name in VizNames:
+            if text:
+                if os.path.exists(name + '.dat'):
+                    with open(name + '.dat') as f:
+                        Lines[name] = f.read().splitlines()
+                else:
+                    Lines[name] = []
+                self.vizFrames = min(self.vizFrames, len(Lines[name]))
+            if binary:
+                Records[name] = read_runlength(name + '.bin') if os.path.exists(name + '.bin') else (0, [])
+                if len(Records[name][1]) == 0:
+                    self.vizFrames = 0
+        for name in VizNames:
+            if text:
+                if len(Lines[name]) != self.vizFrames:
+                    with open(name + '.dat', 'w') as f:
+                        f.write(''.join([l + '\n' for l in Lines[name][:self.vizFrames]]))
+                if self.vizFrames > 0:
+                    self.lastLine[name] = Lines[name][self.vizFrames - 1]
+            if binary:
+                na, allRecords = Records[name]
+                records = [r for r in allRecords if r[0] < self.vizFrames]
+                if len(records) != len(allRecords) or self.vizFrames == 0:
+                    if os.path.exists(name + '.bin'):
+                        os.remove(name + '.bin')
+                    if records:
+                        write_runlength(name + '.bin', records, na)
+                if records:
+                    self.lastLine[name] = records[-1][1]
+        if self.printlvl >= 0 and self.vizFrames > 0:
+            print("Continuing the visualization files after frame %i" % (self.vizFrames - 1))
+
+    def extendVisualization(self, R, wstart, horizon, iso_map):
+        """
+        Append the atom colors, bonds, charge and spin labels of the newly finalized frames
+        to the visualization files, in the format given by vizformat.
+        Frames that were written by an earlier run of the stream are skipped.
+        """
+        lf0, lf1 = self.finalized - wstart, horizon - wstart
+        # Colors belong to global isomers, so they stay the same from one window to the next
+        for iidx, IData in R.IsomerData.items():
+            g = iso_map[iidx]
+            if self.isoColor.get(g, 1) != 1:
+                continue
+            if IData['flag'] == "Found":
+                self.isoColor[g] = R.CoolColors[self.nColors % len(R.CoolColors)]
+                self.nColors += 1
+            elif IData['flag'] in ["Known", "Excluded"]:
+                self.isoColor[g] = 8
+            else:
+                self.isoColor[g] = 1
+        start = max(self.finalized, self.vizFrames)
+        if horizon <= start:
+            return
+        traj_color = np.ones((horizon - start, R.na), dtype=int)
+        for ts in R.TimeSeries.values():
+            atoms = np.array(ts['graph'].L())
+            frame = lf0
+            for intvl, on_off in encode(ts['raw_signal'][lf0:lf1]):
+                if on_off:
+                    f0, f1 = max(frame + wstart, start) - start, frame + intvl + wstart - start
+                    if f1 > f0:
+                        traj_color[f0:f1, atoms] = self.isoColor[iso_map[ts['iidx']]]
+                frame += intvl
+        ChargeLines, SpinLines = R.chargeSpinLabels()
+        skip = start - wstart
+        Lines = OrderedDict([('color', [' '.join(map(str, c)) for c in traj_color.tolist()]),
+                             ('bonds', R.BondLists[skip:lf1]), ('charge', ChargeLines[skip:lf1]),
+                             ('spin', SpinLines[skip:lf1])])
+        for name, lines in Lines.items():
+            if self.vizFormat in ('text', 'both'):
+                write_frame_records(name + '.dat', list(enumerate(lines)), len(lines), append=True)
+            if self.vizFormat in ('binary', 'both'):
+                records = [(frame + start, line) for frame, line in frame_records(lines)]
+                if records and records[0][1] == self.lastLine.get(name):
+                    records = records[1:]
+                write_runlength(name + '.bin', records, R.na, append=True)
+            self.lastLine[name] = lines[-1]
+        self.vizFrames = horizon
+        with open(self.progress, 'w') as f:
+            json.dump({'frames': self.vizFrames}, f)
+
+    def extendEvents(self, R, wstart, horizon, iso_map):
+        """
+        Write the reaction events that end in the newly finalized frames.
+        Output folders are numbered by unique reactant and product isomers as in Nanoreactor.writeReactionEvents.
+        """
+        newEvents = []
+        for evid, event in R.Events.items():
+            fstart, fend = event['frames'][0] + wstart, event['frames'][1] + wstart
+            if fend < self.finalized or fend >= horizon:
+                continue
+            gevid = "%i-%i:%s" % (fstart, fend, evid.split(':')[1])
+            if gevid in self.Events:
+                continue
+            molIDs = tuple([[self.globalMolID(m, iso_map) for m in side] for side in event['molIDs']])
+            r_iidx = sorted([int(m.split(':')[1]) for m in molIDs[0]])
+            p_iidx = sorted([int(m.split(':')[1]) for m in molIDs[1]])
+            for iout, (r_out, p_out) in enumerate(self.output_iidx):
+                if (r_iidx == r_out and p_iidx == p_out) or (r_iidx == p_out and p_iidx == r_out):
+                    break
+            else:
+                iout = len(self.output_iidx)
+                self.output_iidx.append((r_iidx, p_iidx))
+                self.output_count.append(0)
+            repeat = self.output_count[iout]
+            subd = os.path.join(self.odir, 'reaction_%03i' % iout)
+            if not os.path.exists(subd):
+                os.makedirs(subd)
+            if repeat == 0:
+                fout = 'reaction_%03i.xyz' % iout
+            else:
+                fout = 'reaction_%03i_%02i.xyz' % (iout, repeat)
+            if self.printlvl >= 1:
+                print("Reaction event found : frames %i-%i : %s, writing to %s" % (
+                    fstart, fend, event['equation'], fout))
+            R.writeEvent(event, os.path.join(subd, fout), offset=wstart)
+            self.output_count[iout] += 1
+            self.EventIDs.append(gevid)
+            self.Events[gevid] = OrderedDict([('molIDs', molIDs), ('frames', (fstart, fend)),
+                                              ('equation', event['equation']), ('atoms', event['atoms']),
+                                              ('output_id', iout)])
+            newEvents.append(gevid)
+        return newEvents
+
+    def follow(self, interval=60.0, stopfile=None, timeout=None):
+        """
+        Keep analyzing the trajectory as it grows until the simulation is finished.
+
+        Parameters
+        ----------
+        interval : float
+            Time in seconds between checks for new frames
+        stopfile : str, optional
+            The simulation is considered finished when this file exists
+        timeout : float, optional
+            The simulation is considered finished when no new frames arrived for this many seconds
+        """
+        idle = 0.0
+        while True:
+            # Check before reading, so that all frames written before the stop file are included
+            stop = stopfile is not None and os.path.exists(stopfile)
+            nframes = self.nframes
+            self.update()
+            if self.nframes > nframes:
+                idle = 0.0
+            elif timeout is not None and idle >= timeout:
+                stop = True
+            if stop:
+                break
+            time.sleep(interval)
+            idle += interval
+        self.update(final=True)